@@ -61,6 +61,7 @@ python3 setup.py install --prefix=${RPM_BUILD_ROOT}/usr \
 %config(noreplace) /etc/omdclient/config.yaml
 %config(noreplace) /etc/omdclient/place.holder
 %{_bindir}/omd-*
+%{_bindir}/omdclientd
 /usr/share/man/man1/*
 /usr/libexec/omdclient/git-hooks/*
 %{python3_sitelib}/omdclient/*py*
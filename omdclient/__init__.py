@@ -12,11 +12,11 @@ config = {}
 ### Declarations ########################################################
 #########################################################################
 
-import datetime, json, optparse, re, sys, urllib.request, \
-    urllib.parse, urllib.error, urllib.request, urllib.error, \
-    urllib.parse, yaml
-from bs4 import BeautifulSoup
-from pprint import pprint
+## Only what we need on every run is loaded here; yaml, optparse,
+## http.client, ssl, bs4 etc. are loaded by the functions that use them,
+## to keep the startup time of the scripts down.
+import codecs, collections, fcntl, json, os, re, socket, sys, threading, \
+    time, urllib.parse
 
 #########################################################################
 ### Script Helpers ######################################################
@@ -24,21 +24,42 @@ from pprint import pprint
 
 def loadCfg(config_file):
     """
-    Load a .yaml configuration file into the config hash.
+    Load a .yaml configuration file into the config hash.  If omdclientd
+    is running, we get the parsed file from it instead (see DaemonClient),
+    unless the daemon is turned off (see configDaemonSocket()).
     """
 
-    try:
-        config = yaml.safe_load(open(config_file, 'r'))
-    except IOError as exc:
-        raise Exception('%s' % exc)
-    except yaml.YAMLError as exc:
-        raise Exception('yaml error: %s' % exc)
-        sys.exit(3)
-    except Exception as exc:
-        raise Exception('unknown error: %s' % exc)
-        sys.exit(3)
-
-    return config
+    global _session, _daemon
+
+    ## if omdclientd is running, it has probably parsed this already
+    _daemon = None
+    cfg = None
+    path = configDaemonSocket(config_file)
+    if path is not None and os.path.exists(path):
+        cfg = DaemonClient(path).config(config_file, daemon_config_timeout)
+
+    if cfg is None:
+        import yaml
+
+        try:
+            cfg = yaml.safe_load(open(config_file, 'r'))
+        except IOError as exc:
+            raise Exception('%s' % exc)
+        except yaml.YAMLError as exc:
+            raise Exception('yaml error: %s' % exc)
+            sys.exit(3)
+        except Exception as exc:
+            raise Exception('unknown error: %s' % exc)
+            sys.exit(3)
+
+    ## keep a copy for the connection pool settings, and start over with
+    ## a new pool in case they changed
+    config.clear()
+    config.update(cfg)
+    if _session is not None: _session.close()
+    _session = None
+
+    return cfg
 
 def generateParser(text, usage_text, config):
     """
@@ -46,20 +67,31 @@ def generateParser(text, usage_text, config):
     something consistent so we can use the same server/site/user options
     globally.
     """
+    import optparse
+
     p = optparse.OptionParser(usage=usage_text, description=text)
     p.add_option('--debug', dest='debug', action='store_true',
         default=False, help='set to print debugging information')
+    p.add_option('--profile', action='callback', callback=_profileOption,
+        help='print a summary of request timings on exit')
+    p.add_option('--profile_file', type='string', metavar='FILE',
+        action='callback', callback=_profileOption,
+        help='write request timings to FILE as JSON lines')
+    p.add_option('--no_daemon', action='callback', callback=_daemonOption,
+        help='talk to the server directly, even if omdclientd is running')
     group = optparse.OptionGroup(p, "connection options")
-    group.add_option('--server', dest='server', default=config['server'],
+    group.add_option('--server', dest='server', default=config.get('server'),
         help='server name (default: %default)')
-    group.add_option('--site', dest='site', default=config['site'],
+    group.add_option('--site', dest='site', default=config.get('site'),
         help='site name (default: %default)')
-    group.add_option('--user', dest='user', default=config['user'],
+    group.add_option('--user', dest='user', default=config.get('user'),
         help='user name (default: %default)')
-    group.add_option('--apikey', dest='apikey', default=config['apikey'],
+    group.add_option('--apikey', dest='apikey', default=config.get('apikey'),
         help='api key (not printing the default)')
     group.add_option('--remove', action="store_true", dest='remove', default=False,
         help='removes a downtime')
+    group.add_option('--refresh', action="store_true", dest='refresh',
+        default=False, help='ignore the local host cache')
     p.add_option_group(group)
     return p
 
@@ -75,14 +107,988 @@ def parserArgDict(opthash):
         'server': opthash.server,
         'site':   opthash.site,
         'user':   opthash.user,
-        'remove': opthash.remove
+        'remove': opthash.remove,
+        'refresh': opthash.refresh
     }
     return args
 
+def addFilterOptions(p):
+    """
+    Add the options for picking hosts and services with Multisite view
+    filters (see generateNagiosUrl()) to an OptionParser object from
+    generateParser().  Use parserFilters() to read them back.
+    """
+    import optparse
+
+    group = optparse.OptionGroup(p, "filter options")
+    group.add_option('--host_regex', dest='host_regex', default=None,
+        help='hosts matching this regular expression')
+    group.add_option('--service_regex', dest='service_regex', default=None,
+        help='services matching this regular expression')
+    group.add_option('--hostgroup', dest='hostgroup', default=None,
+        help='hosts in this host group')
+    group.add_option('--state', dest='states', action='append', default=[],
+        help='hosts or services in this state (may be repeated)')
+    p.add_option_group(group)
+
+def parserFilters(opthash):
+    """
+    Converts the options from addFilterOptions() into a dictionary of
+    filters.  Returns an empty dictionary if none were set.
+    """
+    filters = {}
+    for key in ('host_regex', 'service_regex', 'hostgroup', 'states'):
+        value = getattr(opthash, key, None)
+        if value: filters[key] = value
+    return filters
+
+def readTargets(lines):
+    """
+    Read a list of hosts and services, one per line, as 'HOST' or
+    'HOST/SERVICE' (split at the first '/', since hostnames can't have
+    one and service names can).  Blank lines and comments are skipped.
+    Returns a list of (host, service) pairs, where the service is None
+    for a host.
+    """
+    targets = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'): continue
+        if '/' in line:
+            host, service = line.split('/', 1)
+            targets.append((host.strip(), service.strip()))
+        else:
+            targets.append((line, None))
+    return targets
+
+def targetName(target):
+    """
+    The reverse of readTargets(): 'HOST' or 'HOST/SERVICE'.
+    """
+    host, service = target
+    if service is None: return host
+    return '%s/%s' % (host, service)
+
+def addSiteOptions(p):
+    """
+    Add the options for querying several of the 'sites' from config.yaml
+    at once (see siteArgs() and fanOut()) to an OptionParser object from
+    generateParser().  Use parserSites() to read them back.
+    """
+    import optparse
+
+    group = optparse.OptionGroup(p, "multi-site options")
+    group.add_option('--sites', dest='sites', default=None,
+        help="query these sites from the configuration file at once "
+            "(comma-separated, or 'all')")
+    group.add_option('--site_timeout', dest='site_timeout', type='float',
+        default=config.get('site_timeout', site_timeout_default),
+        metavar='SECONDS', help='give up on a site after this long '
+            '(default: %default)')
+    p.add_option_group(group)
+
+def parserSites(opthash, argdict):
+    """
+    Converts the options from addSiteOptions() into a dictionary of site
+    name -> argument dict (see siteArgs()), based on 'argdict' (from
+    parserArgDict()).  Returns None if --sites wasn't set.
+    """
+    if not getattr(opthash, 'sites', None): return None
+    return siteArgs(argdict, opthash.sites)
+
+def addSnapshotOptions(p, filters=True):
+    """
+    Add the options for answering from the local snapshot instead of the
+    server (see omdclient.snapshot) to an OptionParser object from
+    generateParser().  If 'filters' is set, also add --folder and --tag,
+    which pick hosts by their WATO settings (read --tag back with
+    parserTags()).
+    """
+    import optparse
+
+    group = optparse.OptionGroup(p, "snapshot options")
+    group.add_option('--from-snapshot', dest='from_snapshot',
+        action='store_true', default=False,
+        help='answer from the local snapshot (see omd-snapshot-sync)')
+    group.add_option('--snapshot_file', dest='snapshot_file', default=None,
+        metavar='FILE', help='snapshot file (default: from config)')
+    if filters:
+        group.add_option('--folder', dest='folder', default=None,
+            help='with --from-snapshot, only hosts in this WATO folder')
+        group.add_option('--tag', dest='tags', action='append', default=[],
+            help='with --from-snapshot, only hosts with this tag, as '
+                'KEY=VALUE (e.g. role=db); may be repeated')
+    p.add_option_group(group)
+
+def parserSnapshot(opthash, argdict):
+    """
+    Opens the snapshot for the options from addSnapshotOptions() (see
+    omdclient.snapshot.Snapshot), for the server/site in 'argdict'.
+    Returns None if --from-snapshot wasn't set; raises an Exception if
+    there is no snapshot.
+    """
+    if not getattr(opthash, 'from_snapshot', False): return None
+    from omdclient import snapshot
+    return snapshot.Snapshot(snapshot.snapshotFile(argdict,
+        opthash.snapshot_file))
+
+def addJournalOptions(p):
+    """
+    Add the --journal and --resume options (see Journal) to an
+    OptionParser object from generateParser().  Use parserJournal() to
+    read them back.
+    """
+    import optparse
+
+    group = optparse.OptionGroup(p, "journal options")
+    group.add_option('--journal', dest='journal', default=None,
+        metavar='FILE', help='record progress in FILE, to --resume later')
+    group.add_option('--resume', dest='resume', action='store_true',
+        default=False, help='resume the job in the --journal, retrying '
+            'only what did not finish')
+    p.add_option_group(group)
+
+def parserJournal(opthash, job, params=None):
+    """
+    Opens the Journal for the options from addJournalOptions(): a new
+    journal for 'job', with its 'params', or (with --resume) the job in
+    the journal so far, whose params are then in journal.params.  Returns
+    None if --journal wasn't set; raises an Exception on trouble.
+    """
+    if not getattr(opthash, 'journal', None):
+        if getattr(opthash, 'resume', False):
+            raise Exception('--resume needs a --journal')
+        return None
+    return Journal(opthash.journal, job, params, resume=opthash.resume)
+
+def parserTags(tags):
+    """
+    Converts a list of KEY=VALUE host tags (as from --tag) into a
+    dictionary.  Raises an Exception on a tag without a value.
+    """
+    result = {}
+    for tag in tags:
+        if '=' not in tag:
+            raise Exception("invalid tag '%s', should be KEY=VALUE" % tag)
+        key, value = tag.split('=', 1)
+        result[key] = value
+    return result
+
+#########################################################################
+### Connection Pool #####################################################
+#########################################################################
+
+## Defaults for the connection pool; can be overridden in config.yaml.
+pool_size_default = 8
+timeout_default = 60
+connect_timeout_default = 10
+
+## Default number of parallel requests for scripts that work on many
+## hosts at once; can be overridden with 'workers' in config.yaml.
+workers_default = 8
+
+_session = None
+
+_connection_classes = {}
+
+def _connectionClass(scheme='https'):
+    """
+    Returns the connection class for the given scheme ('https', or 'http'
+    for test servers; see t/mockserver.py).  These use a separate
+    (shorter) timeout while connecting and then switch to the regular
+    timeout.  http.client is slow to import, so we don't define these
+    until we actually need to talk to a server.
+    """
+    if _connection_classes: return _connection_classes[scheme]
+    import http.client
+
+    def _socket(conn):
+        """
+        Like socket.create_connection(), but noting how long the DNS
+        lookup and the TCP connection took in conn.timing.
+        """
+        start = time.time()
+        addresses = socket.getaddrinfo(conn.host, conn.port, 0,
+            socket.SOCK_STREAM)
+        conn.timing['dns'] = time.time() - start
+
+        start = time.time()
+        sock, error = None, None
+        for family, type, proto, canonname, address in addresses:
+            try:
+                sock = socket.socket(family, type, proto)
+                sock.settimeout(conn.connect_timeout)
+                if conn.source_address: sock.bind(conn.source_address)
+                sock.connect(address)
+                break
+            except OSError as err:
+                error = err
+                if sock is not None: sock.close()
+                sock = None
+        if sock is None:
+            raise error or OSError('no addresses for %s' % conn.host)
+        conn.timing['connect'] = time.time() - start
+
+        sock.settimeout(conn.timeout)
+        ## as http.client does; otherwise the request body can sit in
+        ## the kernel waiting for the ACK of the headers
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    class _HTTPConnection(http.client.HTTPConnection):
+        def __init__(self, host, connect_timeout, **kwargs):
+            http.client.HTTPConnection.__init__(self, host, **kwargs)
+            self.connect_timeout = connect_timeout
+            self.timing = {}
+
+        def connect(self):
+            self.sock = _socket(self)
+
+    class _HTTPSConnection(http.client.HTTPSConnection):
+        def __init__(self, host, connect_timeout, **kwargs):
+            http.client.HTTPSConnection.__init__(self, host, **kwargs)
+            self.connect_timeout = connect_timeout
+            self.timing = {}
+
+        def connect(self):
+            sock = _socket(self)
+            start = time.time()
+            self.sock = self._context.wrap_socket(sock,
+                server_hostname=self.host)
+            self.timing['tls'] = time.time() - start
+
+    _connection_classes['http'] = _HTTPConnection
+    _connection_classes['https'] = _HTTPSConnection
+    return _connection_classes[scheme]
+
+class _PooledResponse(object):
+    """
+    Wraps an http.client.HTTPResponse.  Once the body has been completely
+    read, the connection is handed back to the pool for the next request;
+    if we close the response early, the connection is thrown away instead.
+
+    If the server compressed the body (Content-Encoding 'gzip' or
+    'deflate'), read() decompresses it as it comes in, so the callers
+    always see the plain body.  'encoding' is the Content-Encoding (or
+    None), and 'raw_bytes' and 'decoded_bytes' count the body as it came
+    over the wire and after decompression.
+
+    If we're profiling, 'metrics' is this request's record (see Profile).
+    """
+    def __init__(self, session, key, conn, response, metrics=None):
+        self._session = session
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self.status = response.status
+        self.metrics = metrics
+        self.raw_bytes = 0
+        self.decoded_bytes = 0
+
+        self.encoding = (response.getheader('Content-Encoding', '')
+            or '').strip().lower() or None
+        self._decoder = None
+        self._head = None
+        if self.encoding in ('gzip', 'x-gzip'):
+            import zlib
+            self._decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self.encoding == 'deflate':
+            import zlib
+            self._decoder = zlib.decompressobj()
+            self._head = b''
+        if metrics is not None and self.encoding:
+            metrics['encoding'] = self.encoding
+
+    def getheader(self, name, default=None):
+        return self._response.getheader(name, default)
+
+    def read(self, amt=None):
+        if self._decoder is None:
+            data = self._response.read(amt)
+            self._count(len(data), len(data))
+        else:
+            data = self._decode(amt)
+        if self._response.isclosed(): self._release()
+        return data
+
+    def _count(self, raw, decoded):
+        self.raw_bytes += raw
+        self.decoded_bytes += decoded
+        if self.metrics is not None:
+            self.metrics['response_bytes'] += raw
+            self.metrics['decoded_bytes'] = self.decoded_bytes
+
+    def _decode(self, amt):
+        """
+        Read and decompress up to 'amt' bytes of the body (all of it, if
+        'amt' is None).  Returns b'' only at the end of the body.
+        """
+        import zlib
+
+        output = []
+        size = 0
+        while amt is None or size == 0:
+            data = self._decoder.unconsumed_tail
+            raw = 0
+            if not data and not self._response.isclosed():
+                data = self._response.read(amt)
+                raw = len(data)
+            try:
+                if data: chunk = self._inflate(data, amt or 0)
+                else:    chunk = self._decoder.flush()
+            except zlib.error as err:
+                raise Exception('url error: bad %s data: %s'
+                    % (self.encoding, err))
+            output.append(chunk)
+            size += len(chunk)
+            self._count(raw, len(chunk))
+            if not data:
+                if self.raw_bytes and not self._decoder.eof:
+                    raise Exception('url error: truncated %s data'
+                        % self.encoding)
+                break
+        return b''.join(output)
+
+    def _inflate(self, data, limit):
+        """
+        Decompress some data.  'deflate' is meant to be zlib-wrapped, but
+        some servers send raw deflate data instead, so we hold on to the
+        start of the body until we can check for the zlib header.
+        """
+        if self._head is not None:
+            import zlib
+            data = self._head + data
+            if len(data) < 2 and not self._response.isclosed():
+                self._head = data
+                return b''
+            self._head = None
+            if len(data) < 2 or data[0] & 0x0f != 8 \
+                    or (data[0] * 256 + data[1]) % 31:
+                self._decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self._decoder.decompress(data, limit)
+
+    def close(self):
+        if self._conn is None: return
+        if not self._response.isclosed():
+            self._response.close()
+            self._conn.close()
+            self._conn = None
+            self._finish()
+        else:
+            self._release()
+
+    def _release(self):
+        if self._conn is None: return
+        self._session._release(self._key, self._conn)
+        self._conn = None
+        self._finish()
+
+    def _finish(self):
+        if self.metrics is not None and 'total' not in self.metrics:
+            self.metrics['total'] = time.time() - self.metrics['time']
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class Session(object):
+    """
+    A pool of keep-alive HTTPS connections, keyed by server.  Every call
+    in this module goes through a single shared Session (see getSession()),
+    so a script that makes several requests to the same server only pays
+    for the TCP/TLS handshake once per pooled connection.
+
+        pool_size        Idle connections to keep per server.
+        timeout          Seconds to wait for a response.
+        connect_timeout  Seconds to wait while connecting.
+        compress         Ask for gzip/deflate compressed responses?
+    """
+    def __init__(self, pool_size=pool_size_default, timeout=timeout_default,
+                 connect_timeout=connect_timeout_default, compress=True):
+        self.pool_size = int(pool_size)
+        self.timeout = float(timeout)
+        self.connect_timeout = float(connect_timeout)
+        self.compress = bool(compress)
+        self._context = None
+        self._idle = {}
+        self._timeouts = {}
+        self._lock = threading.Lock()
+
+    def setTimeout(self, server, timeout):
+        """
+        Wait at most 'timeout' seconds (while connecting, and for each
+        read) on the given server, if that's shorter than the usual
+        timeouts.  Used by fanOut() for the per-site timeout.
+        """
+        with self._lock:
+            self._timeouts[server] = float(timeout)
+
+    def serverTimeout(self, server):
+        """
+        The response timeout for the given server (see setTimeout()).
+        """
+        return min(self.timeout, self._timeouts.get(server, self.timeout))
+
+    def _connection(self, key):
+        """
+        Returns an idle connection for the (scheme, server) key (if we
+        have one) and whether it has been used before.
+        """
+        scheme, server = key
+        timeout = self.serverTimeout(server)
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                conn = idle.pop()
+                if _idleClosed(conn.sock):
+                    conn.close()
+                    continue
+                if conn.timeout != timeout:
+                    conn.timeout = timeout
+                    conn.sock.settimeout(timeout)
+                return conn, True
+        connect_timeout = min(self.connect_timeout, timeout)
+        if scheme == 'http':
+            conn = _connectionClass(scheme)(server, connect_timeout,
+                timeout=timeout)
+            return conn, False
+        if self._context is None:
+            import ssl
+            self._context = ssl.create_default_context()
+        conn = _connectionClass(scheme)(server, connect_timeout,
+            timeout=timeout, context=self._context)
+        return conn, False
+
+    def _release(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if conn.sock is not None and len(idle) < self.pool_size:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def request(self, url, request_string):
+        """
+        POST the request string to the given URL, and return the response
+        wrapped as a _PooledResponse.  If a re-used connection turns out
+        to have been closed by the server, we retry once on a new one -
+        but only if it failed while sending the request, or the request
+        only reads (see readOnlyRequest()); otherwise the server may have
+        run it already.
+        """
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise Exception('url error: unsupported scheme %s' % parts.scheme)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path
+        if parts.query: path = "%s?%s" % (path, parts.query)
+        body = request_string.encode('utf-8')
+        headers = {
+            'Content-Type': 'application/x-www-form-urlencoded',
+            'User-Agent':   'omdclient',
+        }
+        if self.compress: headers['Accept-Encoding'] = 'gzip, deflate'
+
+        import http.client
+
+        metrics = None
+        if _profile is not None: metrics = _profile.start(parts, body)
+
+        retry = True
+        while True:
+            conn, reused = self._connection(key)
+            conn.timing = {}
+            sent = False
+            try:
+                conn.request('POST', path, body, headers)
+                sent = True
+                response = conn.getresponse()
+                break
+            except (http.client.RemoteDisconnected, ConnectionResetError,
+                    BrokenPipeError) as err:
+                conn.close()
+                if reused and retry \
+                        and (not sent or readOnlyRequest(parts)):
+                    retry = False
+                    continue
+                if metrics is not None: _profile.failed(metrics, err)
+                raise Exception('url error: %s' % err)
+            except (http.client.HTTPException, OSError) as err:
+                conn.close()
+                if metrics is not None: _profile.failed(metrics, err)
+                raise Exception('url error: %s' % err)
+
+        if metrics is not None:
+            metrics.update(conn.timing)
+            metrics['reused'] = reused
+            metrics['first_byte'] = time.time() - metrics['time']
+            metrics['status'] = response.status
+
+        pooled = _PooledResponse(self, key, conn, response, metrics)
+        if response.status >= 300:
+            pooled.read()
+            if response.status == 404:
+                raise Exception('Page not found')
+            elif response.status == 403:
+                raise Exception('Access Denied')
+            else:
+                raise Exception('http error, code %s' % response.status)
+
+        return pooled
+
+    def close(self):
+        """
+        Close all idle connections.
+        """
+        with self._lock:
+            for idle in self._idle.values():
+                for conn in idle: conn.close()
+            self._idle = {}
+
+def _idleClosed(sock):
+    """
+    Has the server closed an idle pooled connection (or sent something on
+    it, which it shouldn't)?  Either way, we can't use it.
+    """
+    import select
+    if sock is None: return True
+    poller = select.poll()
+    poller.register(sock, select.POLLIN)
+    return bool(poller.poll(0))
+
+## The WATO actions that only read, and so can safely be sent again.
+read_only_actions = ('get_host', 'get_all_hosts')
+
+def readOnlyRequest(parts):
+    """
+    Does the request to the (split) URL only read - a read-only WATO
+    action, or a Multisite view listing rather than a command?
+    """
+    query = urllib.parse.parse_qs(parts.query)
+    if '_do_actions' in query: return False
+    if 'action' in query:
+        return query['action'][0] in read_only_actions
+    return True
+
+def getSession():
+    """
+    Return the shared Session, creating it from the 'pool_size',
+    'timeout', 'connect_timeout' and 'compress' settings in config.yaml
+    (as loaded by loadCfg()) if necessary.
+    """
+    global _session
+    if _session is None:
+        _session = Session(
+            pool_size=config.get('pool_size', pool_size_default),
+            timeout=config.get('timeout', timeout_default),
+            connect_timeout=config.get('connect_timeout',
+                connect_timeout_default),
+            compress=config.get('compress', True))
+    return _session
+
+#########################################################################
+### Daemon Client #######################################################
+#########################################################################
+## If omdclientd (see omdclient.daemon) is running, loadCfg() and
+## loadUrl() go through it: it keeps the parsed configuration, the
+## connections to the servers and (with 'cache_ttl') the host list
+## between runs of the scripts, so a script only has to talk to a local
+## socket.  If it isn't running, everything works as before.
+##
+## The protocol, one request per connection: a JSON line from the client
+## ({"op": "request"|"config"|"stats", ...}), a JSON line back (with an
+## "error", or the answer); for requests, the body follows in chunks (a
+## line with the size in hex, then that many bytes; size 0 ends it), and
+## then a JSON line with the transfer details.
+
+daemon_socket_default = '~/.cache/omdclient/omdclientd.sock'
+
+## How long loadCfg() waits on the daemon for a configuration file before
+## parsing it itself.
+daemon_config_timeout = 2
+
+## The top-level 'daemon' and 'daemon_socket' lines of a config.yaml.
+_daemon_setting = re.compile(r'^(daemon|daemon_socket)[ \t]*:[ \t]*'
+    r'(.*?)[ \t]*(?:#.*)?$', re.MULTILINE)
+
+## The DaemonClient, or False if we're not using the daemon; None until
+## we've looked (see getDaemon()).
+_daemon = None
+
+def daemonSocket(cfg=None):
+    """
+    The path of the omdclientd socket: $OMDCLIENT_SOCKET, 'daemon_socket'
+    in config.yaml (or 'cfg'), or ~/.cache/omdclient/omdclientd.sock.
+    """
+    if cfg is None: cfg = config
+    return os.path.expanduser(os.environ.get('OMDCLIENT_SOCKET', '')
+        or cfg.get('daemon_socket', None) or daemon_socket_default)
+
+def daemonDisabled():
+    """
+    True if the daemon is turned off for this run: $OMDCLIENT_NO_DAEMON
+    is set, or --no_daemon is on the command line (which loadCfg() sees
+    before the options are parsed).
+    """
+    return bool(os.environ.get('OMDCLIENT_NO_DAEMON', '')) \
+        or '--no_daemon' in sys.argv[1:]
+
+def configDaemonSocket(config_file):
+    """
+    The socket to ask for the parsed 'config_file', or None if we're not
+    to use the daemon.  That is up to the file itself ('daemon' and
+    'daemon_socket'), so we pick those two top-level settings out of it
+    without a YAML parser first; if the file can't be read, None.
+    """
+    if daemonDisabled(): return None
+    try:
+        with open(config_file, 'r') as fh:
+            settings = dict((key, value.strip('\'"')) for key, value
+                in _daemon_setting.findall(fh.read()))
+    except (IOError, UnicodeDecodeError):
+        return None
+    if settings.get('daemon', '').lower() in ('false', 'no', 'off'):
+        return None
+    return daemonSocket(settings)
+
+def getDaemon():
+    """
+    Returns the DaemonClient if omdclientd seems to be running (and the
+    'daemon' setting in config.yaml isn't false), otherwise False.
+    """
+    global _daemon
+    if _daemon is None:
+        _daemon = False
+        path = daemonSocket()
+        if config.get('daemon', True) and not daemonDisabled() \
+                and os.path.exists(path):
+            _daemon = DaemonClient(path)
+    return _daemon
+
+def disableDaemon():
+    """
+    Talk to the servers directly from now on, even if omdclientd is
+    running.
+    """
+    global _daemon
+    _daemon = False
+
+def _daemonOption(option, opt_str, value, parser):
+    """
+    optparse callback for --no_daemon.
+    """
+    disableDaemon()
+
+class DaemonClient(object):
+    """
+    Talks to omdclientd over its Unix socket, using a new connection for
+    each request (which costs next to nothing locally).
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def call(self, message, timeout=None):
+        """
+        Send a message to the daemon and read the JSON line that comes
+        back.  Returns the socket, its file object, and the answer; or
+        None if the daemon isn't there (we couldn't connect).  Raises an
+        Exception if it went away afterwards.
+        """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(self.path)
+        except OSError:
+            sock.close()
+            return None
+
+        try:
+            sock.sendall(json.dumps(message).encode() + b'\n')
+            fh = sock.makefile('rb')
+            line = fh.readline()
+            if not line: raise Exception('connection closed')
+            return sock, fh, json.loads(line.decode())
+        except Exception as e:
+            sock.close()
+            raise Exception('url error: omdclientd: %s' % e)
+
+    def config(self, config_file, timeout=10):
+        """
+        Ask the daemon for the parsed contents of a configuration file.
+        Returns None if it can't give us one within 'timeout' seconds (so
+        we load it ourselves).
+        """
+        try:
+            result = self.call({'op': 'config',
+                'file': os.path.abspath(config_file)}, timeout)
+        except Exception:
+            return None
+        if result is None: return None
+        sock, fh, answer = result
+        sock.close()
+        if 'error' in answer: return None
+        return answer['config']
+
+    def request(self, url, request_string, cache=False):
+        """
+        Have the daemon make a request (see Session.request()).  Returns
+        the response, as a _DaemonResponse, or None if the daemon isn't
+        there.
+        """
+        parts = urllib.parse.urlsplit(url)
+        metrics = None
+        if _profile is not None:
+            metrics = _profile.start(parts, request_string.encode('utf-8'))
+            metrics['daemon'] = True
+
+        session = getSession()
+        timeout = session.connect_timeout + session.serverTimeout(parts.netloc)
+        try:
+            result = self.call({'op': 'request', 'url': url,
+                'body': request_string, 'cache': cache}, timeout)
+        except Exception as e:
+            if metrics is not None: _profile.failed(metrics, e)
+            raise
+        if result is None:
+            if metrics is not None: _profile.discard(metrics)
+            return None
+
+        sock, fh, answer = result
+        if 'error' in answer:
+            sock.close()
+            if metrics is not None: _profile.failed(metrics, answer['error'])
+            raise Exception(answer['error'])
+        if metrics is not None:
+            metrics['first_byte'] = time.time() - metrics['time']
+            metrics['status'] = answer['status']
+        return _DaemonResponse(sock, fh, answer, metrics)
+
+class _DaemonResponse(object):
+    """
+    A response from DaemonClient.request(); works like _PooledResponse.
+    The body has already been decompressed by the daemon; 'encoding',
+    'raw_bytes' and 'decoded_bytes' describe how it came from the server,
+    and are filled in once the whole body has been read.  If 'cached' is
+    set, the daemon answered from its host cache, with a copy that it
+    loaded at 'started'.
+    """
+    def __init__(self, sock, fh, answer, metrics=None):
+        self._sock = sock
+        self._file = fh
+        self._left = 0
+        self.status = answer['status']
+        self.cached = answer.get('cached', False)
+        self.started = answer.get('started', None)
+        self.encoding = None
+        self.raw_bytes = 0
+        self.decoded_bytes = 0
+        self.metrics = metrics
+        if metrics is not None and self.cached: metrics['cached'] = True
+
+    def read(self, amt=None):
+        output = []
+        try:
+            while self._sock is not None and (amt is None or not output):
+                if not self._left:
+                    line = self._file.readline()
+                    if not line: raise EOFError('connection closed')
+                    self._left = int(line, 16)
+                    if not self._left:
+                        self._finish()
+                        break
+                size = self._left
+                if amt is not None: size = min(size, amt)
+                data = self._file.read(size)
+                if len(data) < size: raise EOFError('connection closed')
+                self._left -= size
+                self.decoded_bytes += size
+                output.append(data)
+        except (OSError, ValueError, EOFError) as e:
+            self.close()
+            raise Exception('url error: omdclientd: %s' % e)
+        return b''.join(output)
+
+    def _finish(self):
+        trailer = json.loads(self._file.readline().decode() or '{}')
+        self.close()
+        self.encoding = trailer.get('encoding', None)
+        self.raw_bytes = trailer.get('raw_bytes', self.decoded_bytes)
+        if self.metrics is not None:
+            self.metrics['response_bytes'] = self.raw_bytes
+            self.metrics['decoded_bytes'] = self.decoded_bytes
+            if self.encoding: self.metrics['encoding'] = self.encoding
+            self.metrics['total'] = time.time() - self.metrics['time']
+        if 'error' in trailer:
+            raise Exception(trailer['error'])
+
+    def close(self):
+        if self._sock is None: return
+        self._sock.close()
+        self._sock = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+#########################################################################
+### Profiling ###########################################################
+#########################################################################
+
+_profile = None
+
+class Profile(object):
+    """
+    Per-request metrics.  When profiling is enabled (see enableProfile()),
+    every request made through the Session gets a record (a dict) with
+    these keys, in seconds and bytes:
+
+        time            When the request started (epoch seconds)
+        action          The WATO action, or 'view:' and the view name
+                        (plus '/ack' or '/downtime' for commands)
+        server          The server the request went to
+        reused          Did we re-use a pooled connection?
+        dns             DNS lookup (new connections only)
+        connect         TCP connection (new connections only)
+        tls             TLS handshake (new connections only)
+        first_byte      Time until the response headers arrived
+        total           Time until the response was read
+        request_bytes   Size of the URL and request body
+        response_bytes  Size of the response body, as sent
+        decoded_bytes   Size of the response body after decompression
+        daemon          Did the request go through omdclientd?
+        cached          Did omdclientd answer from its host cache?
+        encoding        Content-Encoding of the response, if compressed
+        decode          Time spent parsing JSON
+        status          HTTP status code
+        result_code     WATO result code
+        error           Connection error, if any
+
+    Nothing is printed until report(), which enableProfile() arranges to
+    run when the script exits.
+    """
+    def __init__(self, filename=None):
+        self.records = []
+        self._lock = threading.Lock()
+        self._file = None
+        if filename: self._file = open(filename, 'a')
+
+    def start(self, parts, body):
+        """
+        Start the record for a request to the given (split) URL.
+        """
+        query = urllib.parse.parse_qs(parts.query)
+        if 'action' in query:
+            action = query['action'][0]
+        else:
+            action = 'view:%s' % query.get('view_name', [''])[0]
+            if '_acknowledge' in query:     action += '/ack'
+            elif '_down_comment' in query:  action += '/downtime'
+            elif '_down_remove' in query:   action += '/downtime'
+
+        record = {
+            'time':           time.time(),
+            'action':         action,
+            'server':         parts.netloc,
+            'request_bytes':  len(parts.path) + len(parts.query) + len(body),
+            'response_bytes': 0,
+        }
+        with self._lock: self.records.append(record)
+        return record
+
+    def discard(self, record):
+        """
+        Forget a record; the request was never made.
+        """
+        with self._lock:
+            self.records = [i for i in self.records if i is not record]
+
+    def failed(self, record, error):
+        record['error'] = '%s' % error
+        record['total'] = time.time() - record['time']
+
+    def report(self):
+        """
+        Write the records to the JSON lines file, or (if we don't have
+        one) print a summary table to STDERR.
+        """
+        with self._lock:
+            records = list(self.records)
+            self.records = []
+        if self._file is not None:
+            for record in records:
+                self._file.write(json.dumps(record, sort_keys=True) + '\n')
+            self._file.flush()
+            return
+
+        actions = {}
+        for record in records:
+            actions.setdefault(record['action'], []).append(record)
+
+        format = "%-32s %5s %4s %8s %8s %8s %8s %8s %8s %10s %10s"
+        sys.stderr.write(format % ('action', 'count', 'err', 'mean ms',
+            'p95 ms', 'conn ms', 'ttfb ms', 'json ms', 'kb out', 'kb in',
+            'kb dec') + '\n')
+        for action in sorted(actions):
+            rows = actions[action]
+            totals = sorted(row.get('total', 0) for row in rows)
+            errors = [row for row in rows if 'error' in row
+                or row.get('status', 200) >= 300
+                or row.get('result_code', 0) != 0]
+
+            def ms(key):
+                return '%.1f' % (1000 * sum(row.get(key, 0)
+                    for row in rows) / len(rows))
+
+            sys.stderr.write(format % (action[:32], len(rows), len(errors),
+                '%.1f' % (1000 * sum(totals) / len(totals)),
+                '%.1f' % (1000 * totals[-(-len(totals) * 95 // 100) - 1]),
+                '%.1f' % (1000 * sum(row.get('dns', 0) + row.get('connect', 0)
+                    + row.get('tls', 0) for row in rows) / len(rows)),
+                ms('first_byte'), ms('decode'),
+                '%.1f' % (sum(row['request_bytes'] for row in rows) / 1024.0),
+                '%.1f' % (sum(row['response_bytes'] for row in rows) / 1024.0),
+                '%.1f' % (sum(row.get('decoded_bytes', row['response_bytes'])
+                    for row in rows) / 1024.0))
+                + '\n')
+
+def enableProfile(filename=None):
+    """
+    Start recording metrics for every request (see Profile), and report
+    on them when the script exits: as JSON lines appended to 'filename',
+    or as a summary table on STDERR.  Returns the Profile object.
+    """
+    global _profile
+    if _profile is None:
+        import atexit
+        _profile = Profile(filename)
+        atexit.register(_profile.report)
+    return _profile
+
+def _profileOption(option, opt_str, value, parser):
+    """
+    optparse callback for --profile and --profile_file.
+    """
+    try:
+        enableProfile(value)
+    except IOError as e:
+        parser.error('could not open profile file: %s' % e)
+
 #########################################################################
 ### URL Management ######################################################
 #########################################################################
 
+def urlScheme(args):
+    """
+    Which URL scheme to use: 'scheme' from the argument dict or
+    config.yaml, or 'https'.  Plain 'http' is only meant for test servers
+    (see t/mockserver.py).
+    """
+    return args.get('scheme', config.get('scheme', 'https'))
+
 def generateUrl(action, args):
     """
     Generate the URL used to interact with the server.
@@ -90,8 +1096,12 @@ def generateUrl(action, args):
 
            activate_changes
            add_host
+           add_hosts
            delete_host
+           delete_hosts
            discover_services
+           edit_host
+           edit_hosts
            get_all_hosts
            get_host
 
@@ -106,13 +1116,13 @@ def generateUrl(action, args):
 
            effective_attributes      For 'get_host'
            foreign_ok                For 'activate_changes'
-           create_folders            For 'add_host'
+           create_folders            For 'add_host' and 'add_hosts'
 
     If 'debug' is set, we'll print the URL to stdout (with the password
     blanked out).
     """
-    baseurl = 'https://%s/%s/check_mk/webapi.py?_username=%s' % \
-        (args['server'], args['site'], args['user'])
+    baseurl = '%s://%s/%s/check_mk/webapi.py?_username=%s' % \
+        (urlScheme(args), args['server'], args['site'], args['user'])
     url_parts = [baseurl]
 
     if action == 'activate_changes':
@@ -126,12 +1136,23 @@ def generateUrl(action, args):
         if 'create_folders' in list(args.keys()):
             if args['create_folders']: url_parts.append('create_folders=0')
 
+    elif action == 'add_hosts':
+        url_parts.append('action=add_hosts')
+        if 'create_folders' in list(args.keys()):
+            if args['create_folders']: url_parts.append('create_folders=0')
+
     elif action == 'delete_host':
         url_parts.append('action=delete_host')
 
+    elif action == 'delete_hosts':
+        url_parts.append('action=delete_hosts')
+
     elif action == 'edit_host':
         url_parts.append('action=edit_host')
 
+    elif action == 'edit_hosts':
+        url_parts.append('action=edit_hosts')
+
     elif action == 'discover_services':
         url_parts.append('action=discover_services')
         if 'tabula_rasa' in list(args.keys()):
@@ -158,22 +1179,21 @@ def generateUrl(action, args):
 
     return '&'.join(url_parts)
 
-def loadUrl(url, request_string):
+def loadUrl(url, request_string, cache=False):
     """
-    Load the URL and request string pair.  Returns a urllib2 response.
+    Load the URL and request string pair.  Returns a response object
+    (see Session.request()); the underlying connection goes back into the
+    pool once the response has been fully read.
+
+    If omdclientd is running, the request goes through it instead (see
+    getDaemon()); 'cache' says that it may answer from its host cache.
     """
-    try:
-        response = urllib.request.urlopen(url, request_string.encode('utf-8'))
-    except urllib.error.HTTPError as err:
-        if err.code == 404:
-            raise Exception('Page not found')
-        elif err.code == 403:
-            raise Exception('Access Denied')
-        else:
-            raise Exception('http error, code %s' % err.code)
-    except urllib.error.URLError as err:
-        raise Exception('url error: %s' % err.reason)
-    return response
+    daemon = getDaemon()
+    if daemon:
+        response = daemon.request(url, request_string, cache)
+        if response is not None: return response
+        disableDaemon()
+    return getSession().request(url, request_string)
 
 def processUrlResponse(response, debug):
     """
@@ -186,16 +1206,21 @@ def processUrlResponse(response, debug):
     """
 
     data = response.read().decode()
+    metrics = getattr(response, 'metrics', None)
+    if debug: debugTransfer(response)
 
     try:
-        jsonresult = json.loads(data)
-        if debug: pprint(jsonresult)
+        start = time.time()
+        jsonresult = jsonLoads(data)
+        if metrics is not None:
+            metrics['decode'] = time.time() - start
+            metrics['result_code'] = jsonresult.get('result_code')
+        if debug: debugPrint(jsonresult)
     except ValueError:
-        soup = BeautifulSoup(data, 'lxml')
-        div1 = soup.find('div', attrs={'class': 'error'})
-        if div1 is not None:
+        error = errorText(data)
+        if error is not None:
             print("Error returned")
-            print(div1.string)
+            print(error)
             return False, None
         else:
             print("ValueError.  Invalid JSON object returned, and could not extract error.  Full response was:")
@@ -210,38 +1235,574 @@ def processUrlResponse(response, debug):
 
     return False, jsonresult
 
+## Responses bigger than this are parsed by jsonLoads() a piece at a time,
+## of about json_piece_size characters each.
+json_big_size = 1048576
+json_piece_size = 65536
+
+def jsonLoads(text, depth=2):
+    """
+    json.loads(), except that a big document (more than json_big_size
+    characters) is parsed a piece at a time: the objects in the top
+    'depth' levels are split between their members - for get_all_hosts,
+    a few hundred hosts at a time.  json.loads() holds the GIL for the
+    whole document; this way, other threads (say, the event loop of
+    omdclient.aio) get to run in between.
+    """
+    if len(text) <= json_big_size: return json.loads(text)
+    decoder = json.JSONDecoder()
+    value, pos = _jsonValue(decoder, text, _jsonSpace(text, 0), depth)
+    if _jsonSpace(text, pos) != len(text):
+        raise ValueError('Extra data at %d' % pos)
+    return value
+
+_json_space = re.compile(r'[ \t\n\r]*')
+
+## Where one member of an object ends, and the next one (whose value is
+## an object too) starts.
+_json_cut = re.compile(r'\}[ \t\n\r]*,[ \t\n\r]*'
+    r'(?="(?:[^"\\]|\\.)*"[ \t\n\r]*:[ \t\n\r]*\{)')
+
+def _jsonSpace(text, pos):
+    return _json_space.match(text, pos).end()
+
+def _jsonCut(text, start, end):
+    """
+    The last _json_cut in text[start:end], or None.
+    """
+    end = text.rfind('}', start, end)
+    while end > start:
+        cut = _json_cut.match(text, end)
+        if cut is not None: return cut
+        end = text.rfind('}', start, end)
+    return None
+
+def _jsonPiece(text, pos, cut):
+    try:
+        return json.loads('{%s}' % text[pos:cut.start() + 1])
+    except ValueError:
+        return None
+
+def _jsonValue(decoder, text, pos, depth):
+    """
+    Parse the JSON value at text[pos:]; returns the value and where it
+    ends.  An object is parsed a member at a time, down to 'depth' levels;
+    in the last of those, as many members as fit in json_piece_size go to
+    json.loads() at once.
+
+    The pieces are cut at a '}' followed by the next key and a '{'.  If
+    that was inside a string, or inside a member, the quotes or braces
+    won't balance and json.loads() fails; then we go back to the cut
+    before, and failing that, parse one member on its own.
+    """
+    if depth == 0 or not text.startswith('{', pos):
+        return decoder.raw_decode(text, pos)
+    result = {}
+    pos = _jsonSpace(text, pos + 1)
+    if text.startswith('}', pos): return result, pos + 1
+    while True:
+        if depth == 1:
+            cut = _jsonCut(text, pos, pos + json_piece_size)
+            if cut is not None:
+                piece = _jsonPiece(text, pos, cut)
+                if piece is None:
+                    cut = _jsonCut(text, pos, cut.start())
+                    if cut is not None: piece = _jsonPiece(text, pos, cut)
+                if piece is not None:
+                    result.update(piece)
+                    pos = cut.end()
+                    continue
+
+        if not text.startswith('"', pos):
+            raise ValueError('Expecting property name at %d' % pos)
+        key, pos = json.decoder.scanstring(text, pos + 1)
+        pos = _jsonSpace(text, pos)
+        if not text.startswith(':', pos):
+            raise ValueError("Expecting ':' delimiter at %d" % pos)
+        result[key], pos = _jsonValue(decoder, text,
+            _jsonSpace(text, pos + 1), depth - 1)
+        pos = _jsonSpace(text, pos)
+        if text.startswith('}', pos): return result, pos + 1
+        if not text.startswith(',', pos):
+            raise ValueError("Expecting ',' delimiter at %d" % pos)
+        pos = _jsonSpace(text, pos + 1)
+
+## Matches the <div class="error"> on a check_mk error page.
+_error_div = re.compile(
+    r"""<div[^>]*\bclass=["']?(?:[^"'>]*\s)?error(?=[\s"'>])[^>]*>(.*?)</div>""",
+    re.IGNORECASE | re.DOTALL)
+
+def errorText(data):
+    """
+    Pull the error message out of an HTML error page (the contents of
+    <div class="error">).  Returns None if there isn't one.
+
+    A regular expression handles the pages that check_mk actually sends;
+    we only load BeautifulSoup (which is slow to import) if that fails.
+    """
+    match = _error_div.search(data)
+    if match:
+        import html
+        return html.unescape(re.sub('<[^>]*>', '', match.group(1))).strip()
+
+    if '<' not in data: return None
+    try:
+        from bs4 import BeautifulSoup
+    except ImportError:
+        return None
+    soup = BeautifulSoup(data, 'lxml')
+    div1 = soup.find('div', attrs={'class': 'error'})
+    if div1 is None: return None
+    return div1.string
+
+def debugPrint(data):
+    """
+    Pretty-print a response for --debug.
+    """
+    import pprint
+    pprint.pprint(data)
+
+def debugTransfer(response):
+    """
+    Print how big a response was on the wire and after decompression (see
+    _PooledResponse), for --debug.
+    """
+    encoding = getattr(response, 'encoding', None) or 'uncompressed'
+    raw = getattr(response, 'raw_bytes', 0)
+    decoded = getattr(response, 'decoded_bytes', 0)
+    if encoding != 'uncompressed' and decoded:
+        print("transfer: %d bytes %s, %d bytes decoded (%.1f%%)"
+            % (raw, encoding, decoded, 100.0 * raw / decoded))
+    else:
+        print("transfer: %d bytes %s" % (raw, encoding))
+
 #########################################################################
-### WATO API Interactions ###############################################
+### Request Steps #######################################################
 #########################################################################
+## The calls that take more than one request (or that the asyncio client
+## in omdclient.aio shares) are written once, as generators of "steps":
+## the generator yields what it needs next, is sent the answer, and in the
+## end returns its result.  runSteps() runs them here; omdclient.aio runs
+## the same generators on asyncio.  The steps are:
+##
+##   Request(url, request_string, cache)
+##       The response from loadUrl().  If that raises an Exception, it is
+##       raised at the yield instead.
+##   Parallel(steps, workers)
+##       Run a list of step generators at once ('workers' at a time, or
+##       all of them if that's None).  The answer is a list of (ok,
+##       result) pairs, one per generator: what it returned if 'ok' is
+##       True, or the Exception it raised.
+##   Sleep(seconds)
+##       Wait; the answer is None.
+##   Lock(fh)
+##       Wait for an exclusive flock() on an open file; the answer is None.
+
+Request = collections.namedtuple('Request', 'url request_string cache')
+Request.__new__.__defaults__ = (False,)
+Parallel = collections.namedtuple('Parallel', 'steps workers')
+Sleep = collections.namedtuple('Sleep', 'seconds')
+Lock = collections.namedtuple('Lock', 'fh')
+
+def advanceSteps(steps, answer=None, error=None):
+    """
+    Send a step generator the answer to its last step (or raise 'error'
+    in it).  Returns two objects: whether it has finished, and its next
+    step (or its result, if it has finished).
+    """
+    try:
+        if error is None: return False, steps.send(answer)
+        return False, steps.throw(error)
+    except StopIteration as stop:
+        return True, stop.value
 
-def activateChanges(arghash):
+def runSteps(steps):
     """
-    Activate changes.  This can be slow.
+    Run a step generator, with blocking requests (see loadUrl()) and
+    threads for Parallel steps, and return its result.
     """
-    url = generateUrl('activate_changes', arghash)
-    response = loadUrl(url, '')
-    return processUrlResponse(response, arghash['debug'])
+    answer, error = None, None
+    while True:
+        done, step = advanceSteps(steps, answer, error)
+        if done: return step
+        answer, error = None, None
+        try:
+            answer = _runStep(step)
+        except Exception as e:
+            error = e
+
+def _runStep(step):
+    if isinstance(step, Request):
+        return loadUrl(step.url, step.request_string, step.cache)
+    elif isinstance(step, Parallel):
+        import concurrent.futures
+        workers = step.workers or max(len(step.steps), 1)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) \
+                as pool:
+            jobs = [pool.submit(runSteps, steps) for steps in step.steps]
+            return [_jobResult(job) for job in jobs]
+    elif isinstance(step, Sleep):
+        time.sleep(step.seconds)
+    elif isinstance(step, Lock):
+        fcntl.flock(step.fh, fcntl.LOCK_EX)
+    else:
+        raise Exception('unknown step: %s' % (step,))
 
-def createHost(host, arghash):
+def _jobResult(job):
+    try:
+        return True, job.result()
+    except Exception as e:
+        return False, e
+
+#########################################################################
+### Host Cache ##########################################################
+#########################################################################
+## An optional on-disk copy of the get_all_hosts results, one per
+## server/site, used by listHosts().  It is enabled by setting 'cache_ttl'
+## (in seconds) in config.yaml.  Writes that go through this module are
+## appended to a small '.changes' file next to the cache, and replayed on
+## top of it when it is loaded, so we don't have to re-write (or re-load)
+## the whole inventory every time a host changes.
+
+cache_dir_default = '~/.cache/omdclient'
+
+## Parsed cache files, by filename; see loadHostCache().
+_host_cache = {}
+
+def hostCacheFile(arghash):
     """
-    Create a host entry.
+    Returns the path of the host cache file for the server/site in the
+    argument hash.
+    """
+    cache_dir = os.path.expanduser(config.get('cache_dir', cache_dir_default))
+    name = re.sub('[^A-Za-z0-9.-]', '_',
+        'hosts-%s-%s' % (arghash['server'], arghash['site']))
+    return os.path.join(cache_dir, '%s.json' % name)
 
-        folder      Default: omdclient-api
-        role
-        instance
-        extra
+def hostCacheEnabled():
+    """
+    Is the host cache turned on?
+    """
+    return float(config.get('cache_ttl', 0)) > 0
 
-    Note that `tag_role` and `tag_instance` are tags used locally to tie
-    together local local puppet instance and our OMD folders.  You don't
-    have to use them and may cheerfully ignore them.
+def loadHostCache(arghash):
     """
+    Load the cached host list, with any local changes applied.  Returns
+    None if the cache is disabled, missing, or older than 'cache_ttl'
+    seconds, or if 'refresh' is set in the argument hash.
 
-    request = {}
-    request['hostname'] = host
+    The parsed cache is kept in memory, so later calls in the same process
+    only have to read any new local changes.
+    """
+    if not hostCacheEnabled() or arghash.get('refresh', False): return None
 
-    if 'folder' in arghash: request['folder'] = arghash['folder']
-    else:                   request['folder'] = 'omdclient-api'
+    filename = hostCacheFile(arghash)
+    try:
+        mtime = os.stat(filename).st_mtime
+        memo = _host_cache.get(filename, None)
+        if memo is None or memo['mtime'] != mtime:
+            with open(filename, 'r') as fh:
+                cache = json.load(fh)
+            memo = {'mtime': mtime, 'time': cache['time'],
+                'hosts': cache['hosts'], 'offset': 0}
+            _host_cache[filename] = memo
+    except (IOError, OSError, ValueError):
+        return None
+
+    if time.time() - memo['time'] > float(config['cache_ttl']): return None
+    if arghash['debug']: print("using host cache %s" % filename)
+
+    changes, memo['offset'] = _readHostChanges(filename, memo['offset'])
+    for change in changes:
+        if change['time'] < memo['time']: continue
+        _applyHostChange(memo['hosts'], change)
+    return memo['hosts']
+
+def saveHostCache(arghash, hosts, started):
+    """
+    Write out a new host cache.  'started' is the time that we started
+    loading the host list from the server; local changes older than that
+    are already part of 'hosts', and are thrown away.
+    """
+    if not hostCacheEnabled(): return
 
+    filename = hostCacheFile(arghash)
+    try:
+        os.makedirs(os.path.dirname(filename), mode=0o700, exist_ok=True)
+        import tempfile
+        fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(filename))
+        with os.fdopen(fd, 'w') as fh:
+            json.dump({'time': started, 'hosts': hosts}, fh)
+        os.rename(tmpfile, filename)
+
+        with open('%s.changes' % filename, 'a+') as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            fh.seek(0)
+            keep = [line for line in fh
+                if json.loads(line)['time'] >= started]
+            fh.seek(0)
+            fh.truncate()
+            fh.writelines(keep)
+
+        _host_cache[filename] = {'mtime': os.stat(filename).st_mtime,
+            'time': started, 'hosts': hosts, 'offset': 0}
+    except (IOError, OSError, ValueError) as exc:
+        if arghash['debug']: print("could not write host cache: %s" % exc)
+
+def updateHostCache(arghash, changes):
+    """
+    Record local changes to the host cache.  'changes' is a list of
+    (action, hostname, entry) tuples, where action is one of:
+
+        create    'entry' is the add_host request ('folder' and
+                  'attributes')
+        update    'entry' is the edit_host request ('attributes', and
+                  optionally a list of 'unset_attributes')
+        delete    'entry' is ignored
+    """
+    if not hostCacheEnabled() or not changes: return
+
+    ## even with no cache file yet: a listHosts() that started before
+    ## this change may be about to write one without it
+    filename = hostCacheFile(arghash)
+    now = time.time()
+    lines = []
+    for action, host, entry in changes:
+        lines.append("%s\n" % json.dumps({'time': now, 'action': action,
+            'host': host, 'entry': entry}))
+    try:
+        os.makedirs(os.path.dirname(filename), mode=0o700, exist_ok=True)
+        with open('%s.changes' % filename, 'a') as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            fh.writelines(lines)
+    except (IOError, OSError) as exc:
+        ## if we can't record the change, the cache is no good any more
+        if arghash['debug']: print("removing host cache: %s" % exc)
+        try:
+            os.unlink(filename)
+        except OSError:
+            pass
+
+def _readHostChanges(filename, offset):
+    """
+    Read the local changes recorded after 'offset' bytes.  Returns the
+    changes and the new offset.
+    """
+    try:
+        with open('%s.changes' % filename, 'rb') as fh:
+            fcntl.flock(fh, fcntl.LOCK_SH)
+            fh.seek(offset)
+            data = fh.read()
+        changes = [json.loads(line) for line in data.splitlines()
+            if line.strip()]
+        return changes, offset + len(data)
+    except (IOError, ValueError):
+        return [], offset
+
+def _applyHostChange(hosts, change):
+    host = change['host']
+    entry = change['entry']
+    if change['action'] == 'create':
+        hosts[host] = {'hostname': host, 'path': entry.get('folder', ''),
+            'attributes': entry.get('attributes', {})}
+    elif change['action'] == 'delete':
+        hosts.pop(host, None)
+    elif change['action'] == 'update' and host in hosts:
+        attributes = hosts[host].setdefault('attributes', {})
+        attributes.update(entry.get('attributes', {}))
+        for attribute in entry.get('unset_attributes', []):
+            attributes.pop(attribute, None)
+
+#########################################################################
+### Job Journal #########################################################
+#########################################################################
+## An optional record of the progress of a long bulk job, so that it can
+## be resumed after a failure without redoing the finished work (see
+## omd-bulkimport --journal).  Pass the Journal in the argument hash as
+## 'journal', and batchRequest(), updateHosts() and discoverServicesHosts()
+## record their work in it as they go.
+
+class Journal(object):
+    """
+    An append-only journal file, of JSON lines:
+
+        {"event": "start", "job": JOB, "params": {...}, "time": ...}
+        {"event": "plan", "op": OP, "host": HOST, "time": ...}
+        {"event": "done", "op": OP, "host": HOST, "ok": true,
+            "result": ..., "time": ...}
+        {"event": "resume", "time": ...}
+        {"event": "finish", "ok": true, "time": ...}
+
+    'params' holds whatever the job needs to start over (its input).
+    'op' is a WATO action ('add_hosts', 'discover_services', ...) or a
+    step of the job itself, and 'result' is the processUrlResponse()
+    result, or the error.  A host with a 'plan' but no 'done' for an op
+    was in flight when the job stopped, and we can't know if it happened.
+
+    With 'resume', we read the records of the job so far (raising an
+    Exception if the file doesn't hold a 'job' job) and append to them;
+    otherwise we start a new journal, unless the file holds a job that
+    hasn't finished.  Each call writes its records with one unbuffered
+    write(), so they survive the process being killed; the file is only
+    fsync()ed on close().
+    """
+    def __init__(self, filename, job, params=None, resume=False):
+        self.filename = filename
+        self.job = job
+        self._fd = None
+        self._lock = threading.Lock()
+
+        if resume:
+            self._load()
+            flags = os.O_WRONLY | os.O_APPEND
+        else:
+            if os.path.exists(filename) and os.path.getsize(filename):
+                old = self._load(any_job=True)
+                if not self.finished:
+                    raise Exception('%s holds an unfinished %s job; use '
+                        '--resume, or remove it' % (filename, old))
+            self._reset(params)
+            flags = os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_TRUNC
+
+        self._fd = os.open(filename, flags, 0o600)
+        if resume and self._cut: os.write(self._fd, b'\n')
+        if resume: self._write([{'event': 'resume'}])
+        else:      self._write([{'event': 'start', 'job': job,
+                       'params': self.params}])
+
+    def _reset(self, params=None):
+        self.params = params or {}
+        self.finished = False
+        self._cut = False
+        self._plans = {}
+        self._pending = {}
+        self._results = {}
+
+    def _load(self, any_job=False):
+        """
+        Read the journal so far, and return the name of its job.  A last
+        line that was cut off (the job was killed mid-write) is skipped,
+        and ended before we append to it.
+        """
+        self._reset()
+        try:
+            with open(self.filename, 'r') as fh:
+                lines = fh.readlines()
+        except (IOError, OSError) as exc:
+            raise Exception('%s' % exc)
+
+        self._cut = bool(lines) and not lines[-1].endswith('\n')
+        records = []
+        for line in lines:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                pass
+        if not records or records[0].get('event') != 'start':
+            raise Exception('%s is not a journal' % self.filename)
+        job = records[0].get('job')
+        if job != self.job and not any_job:
+            raise Exception('%s is a journal for %s, not %s'
+                % (self.filename, job, self.job))
+        self.params = records[0].get('params', {})
+        for record in records[1:]: self._replay(record)
+        return job
+
+    def _replay(self, record):
+        event = record.get('event')
+        key = (record.get('op'), record.get('host'))
+        if event == 'plan':
+            self._plans.setdefault(key[1], []).append(key[0])
+            self._pending.setdefault(key[1], set()).add(key[0])
+        elif event == 'done':
+            self._results[key] = (record.get('ok', False),
+                record.get('result'))
+            self._pending.get(key[1], set()).discard(key[0])
+        self.finished = event == 'finish' and record.get('ok', False)
+
+    def _write(self, records):
+        now = time.time()
+        data = []
+        for record in records:
+            record['time'] = now
+            data.append(json.dumps(record, default=str))
+        data = ('%s\n' % '\n'.join(data)).encode()
+        with self._lock:
+            for record in records: self._replay(record)
+            while data:
+                data = data[os.write(self._fd, data):]
+
+    def plan(self, op, hosts):
+        """
+        Record that we're about to do 'op' to each of 'hosts'.
+        """
+        if hosts:
+            self._write([{'event': 'plan', 'op': op, 'host': host}
+                for host in hosts])
+
+    def done(self, op, results):
+        """
+        Record the outcome of 'op' for a list of (host, ok, result).
+        """
+        if results:
+            self._write([{'event': 'done', 'op': op, 'host': host,
+                'ok': bool(ok), 'result': result}
+                for host, ok, result in results])
+
+    def finish(self, ok):
+        """
+        Record the end of the job, and close the journal.  A job that
+        finished 'ok' can be overwritten by the next one.
+        """
+        self._write([{'event': 'finish', 'ok': bool(ok)}])
+        self.close()
+
+    def close(self):
+        if self._fd is None: return
+        os.fsync(self._fd)
+        os.close(self._fd)
+        self._fd = None
+
+    def planned(self, host):
+        """
+        The ops that were planned for this host, oldest first.
+        """
+        return self._plans.get(host, [])
+
+    def inFlight(self, host):
+        """
+        The ops that were planned for this host but never finished.
+        """
+        return sorted(self._pending.get(host, ()))
+
+    def result(self, op, host):
+        """
+        The last (ok, result) pair recorded for 'op' on this host, or None.
+        """
+        return self._results.get((op, host), None)
+
+    def isDone(self, op, host):
+        """
+        Did 'op' succeed on this host?
+        """
+        result = self._results.get((op, host), None)
+        return result is not None and result[0]
+
+#########################################################################
+### WATO API Interactions ###############################################
+#########################################################################
+
+## Default number of hosts to send per add_hosts/edit_hosts/delete_hosts
+## request; can be overridden with 'batch_size' in config.yaml.
+batch_size_default = 100
+
+def hostAttributes(arghash):
+    """
+    Convert the role/instance/ip/extra settings from the argument hash
+    into a WATO attributes dictionary.  Settings of 'UNSET' are skipped.
+
+    See createHost() for a note on `tag_role` and `tag_instance`.
+    """
     attributes = {}
     if 'role' in arghash:
         if arghash['role'] != 'UNSET':
@@ -256,105 +1817,623 @@ def createHost(host, arghash):
         if arghash['extra'] != 'UNSET' and '=' in arghash['extra']:
             import shlex
             attributes.update(dict(token.split('=') for token in shlex.split(arghash['extra'])))
-    request['attributes'] = attributes
+    return attributes
+
+def activateChanges(arghash):
+    """
+    Activate changes.  This can be slow.
+    """
+    return runSteps(_activateChangesSteps(arghash))
 
+def _activateChangesSteps(arghash):
+    url = generateUrl('activate_changes', arghash)
+    response = yield Request(url, '')
+    return processUrlResponse(response, arghash['debug'])
+
+## How long to wait for other activation requests to come in before
+## activating (see activateChangesCoalesced()); can be overridden with
+## 'activate_window' in config.yaml.
+activate_window_default = 5
+
+def activationFile(arghash):
+    """
+    Returns the path of the activation state file for the server/site in
+    the argument hash.  It lives in 'cache_dir' (see hostCacheFile()).
+    """
+    cache_dir = os.path.expanduser(config.get('cache_dir', cache_dir_default))
+    name = re.sub('[^A-Za-z0-9.-]', '_',
+        'activate-%s-%s' % (arghash['server'], arghash['site']))
+    return os.path.join(cache_dir, '%s.json' % name)
+
+def activateChangesCoalesced(arghash, window=None):
+    """
+    Activate changes, sharing the work with any other process on this
+    machine that wants to do the same at about the same time.  Returns
+    the same thing as activateChanges().
+
+    Every caller first waits 'window' seconds (default: 'activate_window'
+    from config.yaml, or 5) for more requests to come in, and then queues
+    up on a lock on the activation state file.  Whoever gets the lock
+    first runs a single activate_changes, and records when it started and
+    what it returned.  The rest find that an activation started after
+    they asked for one, so it covered their changes too, and just return
+    its result - unless it failed, in which case the first of them tries
+    once more (see activationCovered()).  Nobody sleeps with the lock
+    held.
+    """
+    return runSteps(_activateChangesCoalescedSteps(arghash, window))
+
+def _activateChangesCoalescedSteps(arghash, window=None):
+    if window is None:
+        window = config.get('activate_window', activate_window_default)
+    requested = time.time()
+    yield Sleep(float(window))
+
+    filename = activationFile(arghash)
+    os.makedirs(os.path.dirname(filename), mode=0o700, exist_ok=True)
+    with open(filename, 'a+') as fh:
+        yield Lock(fh)
+        state, retry = activationCovered(fh, requested)
+        if state is not None:
+            if arghash['debug']:
+                print("changes were activated by pid %s" % state.get('pid'))
+            return state.get('value', False), state.get('result', None)
+
+        started = time.time()
+        try:
+            value, result = yield from _activateChangesSteps(arghash)
+        except Exception as e:
+            value, result = False, '%s' % e
+        saveActivation(fh, started, value, result, retry)
+
+    return value, result
+
+def activationCovered(fh, requested):
+    """
+    Read the activation state file (open and locked, see
+    activateChangesCoalesced()), for a caller that asked for an activation
+    at time 'requested'.  Returns two objects: the recorded state, if an
+    activation that started since then covers the caller (else None); and
+    whether the caller's own activation will be a retry.
+
+    A covering activation that failed only counts if it was already a
+    retry: the first caller to find the failure activates again itself
+    (as a retry), instead of handing the failure on to everybody.
+    """
+    fh.seek(0)
+    try:
+        state = json.loads(fh.read() or '{}')
+    except ValueError:
+        state = {}
+    if state.get('started', 0) < requested: return None, False
+    if state.get('value', False) or state.get('retry', False):
+        return state, False
+    return None, True
+
+def saveActivation(fh, started, value, result, retry=False):
+    """
+    Record an activation in the (open and locked) activation state file.
+    """
+    fh.seek(0)
+    fh.truncate()
+    json.dump({'started': started, 'finished': time.time(),
+        'pid': os.getpid(), 'value': value, 'result': result,
+        'retry': retry}, fh)
+    fh.flush()
+
+def createHost(host, arghash):
+    """
+    Create a host entry.
+
+        folder      Default: omdclient-api
+        role
+        instance
+        extra
+
+    Note that `tag_role` and `tag_instance` are tags used locally to tie
+    together local local puppet instance and our OMD folders.  You don't
+    have to use them and may cheerfully ignore them.
+    """
+    return runSteps(_createHostSteps(host, arghash))
+
+def _createHostSteps(host, arghash):
+    request = createHostRequest(host, arghash)
     url = generateUrl('add_host', arghash)
 
     request_string = "request=%s" % json.dumps(request)
     if arghash['debug']: print(request_string)
 
-    response = loadUrl(url, request_string)
-    return processUrlResponse(response, arghash['debug'])
+    response = yield Request(url, request_string)
+    value, result = processUrlResponse(response, arghash['debug'])
+    if value: updateHostCache(arghash, [('create', host, request)])
+    return value, result
+
+def createHostRequest(host, arghash):
+    """
+    The add_host/add_hosts request entry for a host, with the settings in
+    the argument hash (see createHost()).
+    """
+    request = {}
+    request['hostname'] = host
+    if 'folder' in arghash: request['folder'] = arghash['folder']
+    else:                   request['folder'] = 'omdclient-api'
+    request['attributes'] = hostAttributes(arghash)
+    return request
 
 def readHost(host, arghash):
     """
     Get information about a host.
     """
-    url = generateUrl('get_host', arghash)
+    return runSteps(_readHostSteps(host, arghash))
 
+def _readHostSteps(host, arghash):
+    url = generateUrl('get_host', arghash)
     request_string = 'request={"hostname" : "%s"}' % (host)
-    response = loadUrl(url, request_string)
+    response = yield Request(url, request_string)
     return processUrlResponse(response, arghash['debug'])
 
+def currentHost(host, arghash):
+    """
+    Get the current WATO entry for a host - from the host cache if it's
+    enabled and has the host, otherwise with readHost().  Returns None if
+    the host does not exist.
+    """
+    return runSteps(_currentHostSteps(host, arghash))
+
+def _currentHostSteps(host, arghash):
+    hosts = loadHostCache(arghash)
+    if hosts is not None and host in hosts: return hosts[host]
+
+    value, result = yield from _readHostSteps(host, arghash)
+    if value: return result
+    return None
+
+def hostDelta(current, attributes, unset):
+    """
+    Compare a host's current WATO entry against the attributes we want it
+    to have, and a list of attributes we want to have unset.  Returns the
+    attributes that actually need to be changed, and the attributes that
+    actually need to be unset.
+    """
+    existing = current.get('attributes', {}) or {}
+    changed = {}
+    for attribute in attributes:
+        if existing.get(attribute, None) != attributes[attribute]:
+            changed[attribute] = attributes[attribute]
+    unset = [attribute for attribute in unset if attribute in existing]
+    return changed, unset
+
 def updateHost(host, arghash):
     """
     Update information from a host.  If the host does not already exist,
     we'll call createHost instead.
+
+    We compare the requested attributes against the host's current ones
+    (see currentHost()) and only send the ones that changed; if nothing
+    changed, we don't send an edit at all.  On success, the second return
+    value says which of these happened: 'created', 'updated' or
+    'unchanged'.
     """
+    return runSteps(_updateHostSteps(host, arghash))
 
-    if readHost(host, arghash): pass
-    else:
-        return createHost(host, arghash)
+def _updateHostSteps(host, arghash):
+    current = yield from _currentHostSteps(host, arghash)
+    if current is None:
+        value, result = yield from _createHostSteps(host, arghash)
+        if value: result = 'created'
+        return value, result
+
+    request = editHostRequest(host, current, arghash)
+    if request is None:
+        if arghash['debug']: print("%s: no changes" % host)
+        return True, 'unchanged'
 
     url = generateUrl('edit_host', arghash)
+    request_string = "request=%s" % json.dumps(request)
+    if arghash['debug']: print(request_string)
+
+    response = yield Request(url, request_string)
+    value, result = processUrlResponse(response, arghash['debug'])
+    if value:
+        updateHostCache(arghash, [('update', host, request)])
+        result = 'updated'
+    return value, result
+
+def editHostRequest(host, current, arghash):
+    """
+    The edit_host/edit_hosts request entry that gives a host with the
+    WATO entry 'current' the settings in the argument hash: only the
+    attributes that change, and the 'unset' attribute if it is set.
+    Returns None if nothing would change.
+    """
+    unset = []
+    if 'unset' in arghash: unset = [arghash['unset']]
+    attributes, unset = hostDelta(current, hostAttributes(arghash), unset)
+    if not attributes and not unset: return None
 
     request = {}
     request['hostname'] = host
-
-    attributes = {}
-    if 'role' in arghash:
-        if arghash['role'] != 'UNSET':
-            attributes['tag_role'] = arghash['role']
-    if 'instance' in arghash:
-        if arghash['instance'] != 'UNSET':
-            attributes['tag_instance'] = arghash['instance']
-    if 'ip' in arghash:
-        if arghash['ip'] != 'UNSET':
-            attributes['ipaddress'] = arghash['ip']
-    if 'extra' in arghash:
-        if arghash['extra'] != 'UNSET' and '=' in arghash['extra']:
-            import shlex
-            attributes.update(dict(token.split('=') for token in shlex.split(arghash['extra'])))
     request['attributes'] = attributes
-
-    if 'unset' in arghash:
-        request['unset_attributes'] = [arghash['unset']]
-
-    request_string = "request=%s" % json.dumps(request)
-    if arghash['debug']: print(request_string)
-
-    response = loadUrl(url, request_string)
-    return processUrlResponse(response, arghash['debug'])
+    if unset: request['unset_attributes'] = unset
+    return request
 
 def listHosts(arghash):
     """
-    List all hosts.
+    List all hosts.  If the host cache is enabled (see loadHostCache()),
+    we'll use that instead of asking the server.
     """
+    return runSteps(_listHostsSteps(arghash))
+
+def _listHostsSteps(arghash):
+    hosts = loadHostCache(arghash)
+    if hosts is not None: return True, hosts
+
+    started = time.time()
     url = generateUrl('get_all_hosts', arghash)
-    response = loadUrl(url, '')
-    return processUrlResponse(response, arghash['debug'])
+    response = yield Request(url, '', not arghash.get('refresh', False))
+    if getattr(response, 'cached', False): started = response.started
+    value, result = processUrlResponse(response, arghash['debug'])
+    if value: saveHostCache(arghash, result, started)
+    return value, result
 
 def listHostsFiltered(filter, arghash):
     """
-    List all hosts filtered by site.
+    List all hosts filtered by site.  See hostInventory() for more
+    complicated queries.
     """
-    url = generateUrl('get_all_hosts', arghash)
-    response = loadUrl(url, '')
-    status, response = processUrlResponse(response, arghash['debug'])
-    response_filtered = dict(response)
-    for h in response:
-        if response[h].get('attributes', {}).get('site', '') != filter:
-            del response_filtered[h]
-    return status, response_filtered
+    return runSteps(_listHostsFilteredSteps(filter, arghash))
+
+def _listHostsFilteredSteps(filter, arghash):
+    status, response = yield from _hostInventorySteps(arghash)
+    if not status: return status, response
+    return status, dict((h, response[h]) for h in response.query(site=filter))
 
 def deleteHost(host, arghash):
     """
     Remove a host from check_mk.
     """
+    return runSteps(_deleteHostSteps(host, arghash))
+
+def _deleteHostSteps(host, arghash):
     url = generateUrl('delete_host', arghash)
     request_string = 'request={"hostname" : "%s"}' % (host)
-    response = loadUrl(url, request_string)
-    return processUrlResponse(response, arghash['debug'])
+    response = yield Request(url, request_string)
+    value, result = processUrlResponse(response, arghash['debug'])
+    if value: updateHostCache(arghash, [('delete', host, None)])
+    return value, result
+
+def hostArgs(hosts, arghash):
+    """
+    Normalize the 'hosts' argument of the createHosts()/updateHosts()
+    family.  That can either be a list of hostnames, all of which use the
+    settings in arghash, or a dict mapping hostnames to their own
+    settings (which override those in arghash).  Returns a list of
+    (hostname, settings) pairs.
+    """
+    if isinstance(hosts, dict):
+        pairs = []
+        for host in hosts:
+            args = dict(arghash)
+            args.update(hosts[host])
+            pairs.append((host, args))
+        return pairs
+    return [(host, arghash) for host in hosts]
+
+def batchRequest(action, key, entries, arghash):
+    """
+    Send a list of (hostname, request entry) pairs to one of the bulk
+    WATO actions ('add_hosts', 'edit_hosts', 'delete_hosts'), in batches
+    of 'batch_size' (from arghash or config.yaml).  The entries are sent
+    as a list under the request key 'key'.
+
+    Returns two objects: did every host succeed, and a dictionary with
+    the keys 'succeeded_hosts' (a list of hostnames) and 'failed_hosts'
+    (a dict mapping hostnames to their error).
+
+    If there's a 'journal' in arghash (see Journal), each batch is
+    recorded there before it is sent, and its outcome after.
+    """
+    return runSteps(_batchRequestSteps(action, key, entries, arghash))
+
+def _batchRequestSteps(action, key, entries, arghash):
+    size = int(arghash.get('batch_size',
+        config.get('batch_size', batch_size_default)))
+    url = generateUrl(action, arghash)
+    journal = arghash.get('journal', None)
+
+    succeeded = []
+    failed = {}
+    for i in range(0, len(entries), size):
+        batch = entries[i:i + size]
+        request = {key: [entry for host, entry in batch]}
+        request_string = "request=%s" % json.dumps(request)
+        if arghash['debug']: print(request_string)
+        if journal is not None:
+            journal.plan(action, [host for host, entry in batch])
+
+        try:
+            response = yield Request(url, request_string)
+            value, result = processUrlResponse(response, arghash['debug'])
+        except Exception as e:
+            value, result = False, '%s' % e
+        batchResult(action, batch, value, result, succeeded, failed, journal)
+
+    return len(failed) == 0, \
+        {'succeeded_hosts': succeeded, 'failed_hosts': failed}
+
+def batchResult(action, batch, value, result, succeeded, failed,
+        journal=None):
+    """
+    Sort out the answer to one batch of batchRequest(): the (value,
+    result) pair from processUrlResponse(), or (False, error).  The hosts
+    are added to the 'succeeded' list or the 'failed' dict, and recorded
+    in the journal, if there is one.
+    """
+    if not value:
+        for host, entry in batch:
+            if result is None: failed[host] = 'unknown error'
+            else:              failed[host] = result
+        if journal is not None:
+            journal.done(action, [(host, False, failed[host])
+                for host, entry in batch])
+        return
+
+    errors = {}
+    if isinstance(result, dict):
+        errors = result.get('failed_hosts', {}) or {}
+    for host, entry in batch:
+        if host in errors: failed[host] = errors[host]
+        else:              succeeded.append(host)
+    if journal is not None:
+        if isinstance(result, dict):
+            result = dict((key, result[key]) for key in result
+                if key != 'failed_hosts') or None
+        journal.done(action, [(host, host not in errors,
+            errors.get(host, result)) for host, entry in batch])
+
+def createHosts(hosts, arghash):
+    """
+    Create many host entries at once with the 'add_hosts' action.  See
+    hostArgs() for the format of 'hosts', and batchRequest() for the
+    return values.  Each host takes the same settings as createHost().
+    """
+    return runSteps(_createHostsSteps(hosts, arghash))
+
+def _createHostsSteps(hosts, arghash):
+    entries = [(host, createHostRequest(host, args))
+        for host, args in hostArgs(hosts, arghash)]
+    value, result = yield from _batchRequestSteps('add_hosts', 'hosts',
+        entries, arghash)
+    done = set(result['succeeded_hosts'])
+    updateHostCache(arghash, [('create', host, request)
+        for host, request in entries if host in done])
+    return value, result
+
+def updateHosts(hosts, arghash):
+    """
+    Update many host entries at once with the 'edit_hosts' action.  Like
+    updateHost(), hosts that do not already exist are created instead
+    (with createHosts()), and only changed attributes are sent.  See
+    hostArgs() for the format of 'hosts', and batchRequest() for the
+    return values; the result also lists 'created_hosts' and
+    'unchanged_hosts' (which are counted as successes).
+    """
+    return runSteps(_updateHostsSteps(hosts, arghash))
+
+def _updateHostsSteps(hosts, arghash):
+    value, existing = yield from _listHostsSteps(arghash)
+    if not value: return False, updateHostsFailed(hosts, existing, arghash)
+
+    creates, unchanged, entries = updateHostsPlan(hosts, existing, arghash)
+    value, result = yield from _batchRequestSteps('edit_hosts', 'hosts',
+        entries, arghash)
+    done = set(result['succeeded_hosts'])
+    updateHostCache(arghash, [('update', host, request)
+        for host, request in entries if host in done])
+    result['created_hosts'] = []
+    result['unchanged_hosts'] = unchanged
+    result['succeeded_hosts'].extend(unchanged)
+    if creates:
+        value1, result1 = yield from _createHostsSteps(creates, arghash)
+        value = value and value1
+        result['created_hosts'] = result1['succeeded_hosts']
+        result['succeeded_hosts'].extend(result1['succeeded_hosts'])
+        result['failed_hosts'].update(result1['failed_hosts'])
+
+    return value, result
+
+def updateHostsFailed(hosts, error, arghash):
+    """
+    The updateHosts() result when the host list couldn't be loaded: every
+    host failed, with that error.
+    """
+    if error is None: error = 'unknown error'
+    return {'succeeded_hosts': [], 'failed_hosts': dict((host, error)
+        for host, args in hostArgs(hosts, arghash))}
+
+def updateHostsPlan(hosts, existing, arghash):
+    """
+    Sort the 'hosts' for updateHosts() against the 'existing' host list.
+    Returns the hosts to create (hostname -> settings), the hosts that
+    don't need changing (which are recorded in the journal, if there is
+    one), and the (hostname, request) entries for edit_hosts.
+    """
+    creates = {}
+    unchanged = []
+    entries = []
+    for host, args in hostArgs(hosts, arghash):
+        if host not in existing:
+            creates[host] = args
+            continue
+        request = editHostRequest(host, existing[host], args)
+        if request is None: unchanged.append(host)
+        else:               entries.append((host, request))
+
+    if arghash.get('journal', None) is not None:
+        arghash['journal'].done('edit_hosts', [(host, True, 'unchanged')
+            for host in unchanged])
+    return creates, unchanged, entries
+
+def deleteHosts(hosts, arghash):
+    """
+    Remove many hosts from check_mk at once with the 'delete_hosts'
+    action.  'hosts' is a list of hostnames; see batchRequest() for the
+    return values.
+    """
+    return runSteps(_deleteHostsSteps(hosts, arghash))
+
+def _deleteHostsSteps(hosts, arghash):
+    entries = [(host, host) for host in hosts]
+    value, result = yield from _batchRequestSteps('delete_hosts', 'hostnames',
+        entries, arghash)
+    updateHostCache(arghash, [('delete', host, None)
+        for host in result['succeeded_hosts']])
+    return value, result
 
 def discoverServicesHost(host, arghash):
     """
     Scan a host for services.
     """
+    return runSteps(_discoverServicesHostSteps(host, arghash))
+
+def _discoverServicesHostSteps(host, arghash):
     url = generateUrl('discover_services', arghash)
     request_string = 'request={"hostname" : "%s"}' % (host)
-    response = loadUrl(url, request_string)
+    response = yield Request(url, request_string)
     return processUrlResponse(response, arghash['debug'])
 
+def discoverServicesHosts(hosts, arghash):
+    """
+    Scan many hosts for services, running up to 'workers' (from arghash or
+    config.yaml) discoveries at once.  This is a generator; it returns a
+    (host, value, result, seconds) tuple for each host, in the same order
+    as 'hosts', as soon as that host (and all of the ones before it) are
+    done.  'seconds' is the wall-clock time of that host's discovery.
+
+    If there's a 'journal' in arghash (see Journal), each discovery is
+    recorded there as soon as it finishes.
+    """
+    import concurrent.futures
+
+    journal = arghash.get('journal', None)
+    if journal is not None: journal.plan('discover_services', hosts)
+
+    workers = int(arghash.get('workers',
+        config.get('workers', workers_default)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        jobs = [(host, pool.submit(runSteps,
+            _discoverTimedSteps(host, arghash, journal))) for host in hosts]
+        for host, job in jobs:
+            value, result, seconds = job.result()
+            yield host, value, result, seconds
+
+def _discoverTimedSteps(host, arghash, journal):
+    """
+    One discovery for discoverServicesHosts(): returns the value, the
+    result, and how long it took.
+    """
+    start = time.time()
+    try:
+        value, result = yield from _discoverServicesHostSteps(host, arghash)
+    except Exception as e:
+        value, result = False, '%s' % e
+    if journal is not None:
+        journal.done('discover_services', [(host, value, result)])
+    return value, result, time.time() - start
+
+#########################################################################
+### Host Inventory ######################################################
+#########################################################################
+
+class HostInventory(object):
+    """
+    The results of listHosts() (hostname -> host data), indexed so that
+    they can be searched by folder, site and tag without rescanning the
+    whole list for every question.  Usage:
+
+        inventory = HostInventory(hosts)
+        inventory.query(folder='linux/web', tags={'role': 'apache'})
+
+    The indexes are built once, when the object is created.  Hosts
+    without a 'site' attribute are monitored by the default site, and are
+    indexed under ''.
+    """
+    def __init__(self, hosts):
+        self.hosts = hosts
+        self.index = {'folder': {}, 'site': {}}
+        for name in hosts:
+            h = hosts[name] or {}
+            attributes = h.get('attributes', {}) or {}
+            self._add('folder', h.get('path', ''), name)
+            self._add('site', attributes.get('site', ''), name)
+            for key in attributes:
+                if key.startswith('tag_'):
+                    self._add(key, attributes[key], name)
+
+    def __contains__(self, name):
+        return name in self.hosts
+
+    def __getitem__(self, name):
+        return self.hosts[name]
+
+    def __iter__(self):
+        return iter(self.hosts)
+
+    def __len__(self):
+        return len(self.hosts)
+
+    def _add(self, field, value, name):
+        self.index.setdefault(field, {}).setdefault(value, set()).add(name)
+
+    def folder(self, name):
+        """
+        Returns the folder (path) of the given host, or None if we don't
+        know about that host.
+        """
+        if name not in self.hosts: return None
+        return (self.hosts[name] or {}).get('path', '')
+
+    def values(self, field):
+        """
+        List the values of an indexed field ('folder', 'site', or a tag
+        like 'tag_role' or just 'role').
+        """
+        if field not in self.index: field = 'tag_%s' % field
+        return sorted(self.index.get(field, {}))
+
+    def query(self, folder=None, site=None, tags=None):
+        """
+        Find the hosts matching all of the given settings.  'tags' is a
+        dict of tag names (with or without the 'tag_' prefix) to values.
+        Returns a sorted list of hostnames.
+        """
+        lookups = []
+        if folder is not None: lookups.append(('folder', folder))
+        if site is not None:   lookups.append(('site', site))
+        for key in (tags or {}):
+            if not key.startswith('tag_'): field = 'tag_%s' % key
+            else:                          field = key
+            lookups.append((field, tags[key]))
+        if not lookups: return sorted(self.hosts)
+
+        matches = [self.index.get(field, {}).get(value, set())
+            for field, value in lookups]
+        matches.sort(key=len)
+        return sorted(matches[0].intersection(*matches[1:]))
+
+def hostInventory(arghash):
+    """
+    Load the host list with listHosts(), and index it.  Returns a pair: a
+    True/False status, and the HostInventory object (or, on failure, the
+    error).
+    """
+    return runSteps(_hostInventorySteps(arghash))
+
+def _hostInventorySteps(arghash):
+    status, response = yield from _listHostsSteps(arghash)
+    if not status: return status, response
+    return status, HostInventory(response)
+
 #########################################################################
 ### Nagios API Commands #################################################
 #########################################################################
@@ -367,7 +2446,9 @@ def generateNagiosUrl(action, args):
            ack
            downtime
            hostreport
+           hostsearch
            svcreport
+           svcsearch
 
        args     Argument dict.  You must have at least these keys:
 
@@ -389,6 +2470,9 @@ def generateNagiosUrl(action, args):
                     hours of downtime.  Used if we don't have a set
                     'end' time.
             host    Associated with 'downtime' and 'ack': hostname.
+                    If not set, the command goes to every host or
+                    service matching the filters below, through the
+                    'bulk_views' (there must be at least one filter).
             service Associated with 'downtime' and 'ack': service name.
             start   Associated with 'downtime'; a datetime object
                     indicating the start of the work.  If not offered,
@@ -396,10 +2480,20 @@ def generateNagiosUrl(action, args):
             type    Associated with 'ack' or 'downtime'; must be one of
                     'host' or 'service'.
 
+    The reports, the searches and the bulk commands also take filters
+    (see nagiosFilterArgs()), which are passed to Multisite so that the
+    server only returns (or acts on) the matching rows:
+
+            host_regex      regular expression on the hostname
+            service_regex   regular expression on the service name
+            states          list of states ('CRIT', 'DOWN', etc)
+            hostgroup       host group name
+
     If 'debug' is set, we'll print the URL to stdout (with the password
     blanked out).
     """
-    baseurl = 'https://%s/%s/check_mk/view.py' % (args['server'], args['site'])
+    baseurl = '%s://%s/%s/check_mk/view.py' % (urlScheme(args),
+        args['server'], args['site'])
     url_parts = {}
     url_parts['_username'] = args['user']
     url_parts['_secret'] = args['apikey']
@@ -409,6 +2503,7 @@ def generateNagiosUrl(action, args):
         url_parts['view_name'] = 'hostproblems_expanded'
         if 'ack' in list(args.keys()):
             url_parts['is_host_acknowledged'] = args['ack']
+        url_parts.update(nagiosFilterArgs('host', args))
 
     elif action == 'svcreport':
         url_parts['view_name'] = 'svcproblems_expanded'
@@ -416,6 +2511,14 @@ def generateNagiosUrl(action, args):
             url_parts['is_service_acknowledged'] = args['ack']
         if 'all' in list(args.keys()):
             url_parts['is_service_acknowledged'] = args['all']
+        url_parts.update(nagiosFilterArgs('service', args))
+
+    elif action == 'hostsearch' or action == 'svcsearch':
+        if action == 'hostsearch': type = 'host'
+        else:                      type = 'service'
+        url_parts['view_name'] = bulk_views[type]
+        url_parts['limit'] = 'none'
+        url_parts.update(nagiosFilterArgs(type, args))
 
     elif action == 'downtime':
         url_parts['_transid'] = '-1'
@@ -426,6 +2529,7 @@ def generateNagiosUrl(action, args):
             url_parts['_remove_downtimes'] = 'Remove'
             url_parts['_down_remove'] = 'Remove'
         else:
+            import datetime
             if 'start' in list(args.keys()): start = args['start']
             else:                      start = datetime.datetime.now()
             if 'end' in list(args.keys()):   end = args['end']
@@ -439,15 +2543,7 @@ def generateNagiosUrl(action, args):
             url_parts['_down_to_time'] = end.strftime('%H:%M')
             url_parts['_down_comment'] = args['comment']
 
-        if args['type'] == 'host':
-            url_parts['host'] = args['host']
-            url_parts['view_name'] = 'hoststatus'
-        elif args['type'] == 'svc' or args['type'] == 'service':
-            url_parts['host'] = args['host']
-            url_parts['service'] = args['service']
-            url_parts['view_name'] = 'service'
-        else:
-            raise Exception('invalid downtime type: %s' % args['type'])
+        url_parts.update(nagiosTargetArgs('downtime', args))
 
     elif action == 'ack':
         url_parts['_transid'] = '-1'
@@ -456,15 +2552,7 @@ def generateNagiosUrl(action, args):
 
         url_parts['_ack_comment'] = args['comment']
         url_parts['_acknowledge'] = 'Acknowledge'
-        if args['type'] == 'host':
-            url_parts['host'] = args['host']
-            url_parts['view_name'] = 'hoststatus'
-        elif args['type'] == 'svc' or args['type'] == 'service':
-            url_parts['host'] = args['host']
-            url_parts['service'] = args['service']
-            url_parts['view_name'] = 'service'
-        else:
-            raise Exception('invalid ack type: %s' % args['type'])
+        url_parts.update(nagiosTargetArgs('ack', args))
 
     elif action == 'get_host':
         url_parts['action'] = 'get_host'
@@ -482,30 +2570,568 @@ def generateNagiosUrl(action, args):
     return url
 
 
+## Multisite filter variables for each host and service state; see
+## nagiosFilterArgs().
+host_state_vars = {'UP': 'hst0', 'DOWN': 'hst1', 'UNREACH': 'hst2',
+    'PEND': 'hstp'}
+service_state_vars = {'OK': 'st0', 'WARN': 'st1', 'CRIT': 'st2',
+    'UNKN': 'st3', 'PEND': 'stp'}
+
+## The views that bulk commands are sent to, and that their targets are
+## listed from.  These are the standard Multisite search views, which
+## have all of the filters that nagiosFilterArgs() uses.
+bulk_views = {'host': 'searchhost', 'service': 'searchsvc'}
+
+def nagiosFilterArgs(type, args):
+    """
+    Convert the filters in 'args' (see generateNagiosUrl()) into Multisite
+    view filter variables, for a 'host' or 'service' view.  Returns a
+    dictionary of URL parameters, which is empty if there are no filters.
+    Raises an Exception on a state that Multisite doesn't know.
+
+    Multisite only applies the filters that the view has configured (as
+    shown or hidden filters), and silently ignores the rest; see
+    reportFilter() for checking the results.
+    """
+    url_parts = {}
+    if args.get('host_regex'):
+        url_parts['host_regex'] = args['host_regex']
+    if args.get('service_regex') and type == 'service':
+        url_parts['service_regex'] = args['service_regex']
+    if args.get('hostgroup'):
+        url_parts['opthost_group'] = args['hostgroup']
+
+    states = args.get('states', None)
+    if states:
+        if type == 'host': vars = host_state_vars
+        else:              vars = service_state_vars
+
+        ## once 'filled_in' is set, Multisite treats every state checkbox
+        ## that isn't there as unchecked - including the host state
+        ## checkboxes on service views - so we turn those all on
+        url_parts['filled_in'] = 'filter'
+        if type == 'service':
+            for var in host_state_vars.values(): url_parts[var] = 'on'
+        for state in states:
+            if state.upper() not in vars:
+                raise Exception('invalid %s state: %s' % (type, state))
+            url_parts[vars[state.upper()]] = 'on'
+
+    return url_parts
+
+def nagiosTargetArgs(action, args):
+    """
+    Work out the view and filters for an 'ack' or 'downtime' command.  If
+    'host' is set, the command is for that one host (or service on that
+    host); otherwise it's for everything matching the filters, through
+    the 'bulk_views'.  Returns a dictionary of URL parameters.
+    """
+    url_parts = {}
+    if args['type'] == 'host':
+        type = 'host'
+    elif args['type'] == 'svc' or args['type'] == 'service':
+        type = 'service'
+    else:
+        raise Exception('invalid %s type: %s' % (action, args['type']))
+
+    if args.get('host', None):
+        url_parts['host'] = args['host']
+        if type == 'host':
+            url_parts['view_name'] = 'hoststatus'
+        else:
+            url_parts['service'] = args['service']
+            url_parts['view_name'] = 'service'
+    else:
+        url_parts = nagiosFilterArgs(type, args)
+        if not url_parts:
+            raise Exception('no host or filters for %s' % action)
+        url_parts['view_name'] = bulk_views[type]
+        url_parts['limit'] = 'none'
+    return url_parts
+
 def nagiosAck(params):
     """
     Acknowledge an alert in Nagios.  Returns a report, but the report may
     not be very helpful.
     """
-    url = generateNagiosUrl('ack', params)
-    response = loadUrl(url, '')
-    return processNagiosReport(response, params['debug'])
+    return runSteps(_nagiosActionSteps('ack', params))
 
 def nagiosDowntime(params):
     """
     Schedule downtime in Nagios.  Returns a report, but the report may
     not be very helpful.
     """
-    url = generateNagiosUrl('downtime', params)
-    response = loadUrl(url, '')
+    return runSteps(_nagiosActionSteps('downtime', params))
+
+def _nagiosActionSteps(action, params):
+    url = generateNagiosUrl(action, params)
+    response = yield Request(url, '')
     return processNagiosReport(response, params['debug'])
 
-def nagiosReport(type, argdict):
+## Multisite's answer to a command, e.g. 'MESSAGE: Successfully sent 3
+## commands.'
+_command_message = re.compile(r'^MESSAGE: .*?(\d+) command', re.MULTILINE)
+
+## The filters that nagiosBulkCommand() sets itself.
+_target_filters = ('host_regex', 'service_regex', 'states', 'hostgroup',
+    'ack')
+
+def nagiosCommand(action, params):
     """
-    Generate a nagios report.  Type can be one of 'svc_ack', 'svc_unack',
-    'host_ack', or 'host_unack'.
+    Send an 'ack' or 'downtime' command (see generateNagiosUrl()) and read
+    the answer.  Returns two objects: the number of commands that
+    Multisite says it sent (None if it didn't say, which means that the
+    command failed), and the message or error text.
+    """
+    return runSteps(_nagiosCommandSteps(action, params))
+
+def _nagiosCommandSteps(action, params):
+    url = generateNagiosUrl(action, params)
+    response = yield Request(url, '')
+    return commandAnswer(response, params['debug'])
+
+def commandAnswer(response, debug):
+    """
+    Read the answer to a command from loadUrl(), for nagiosCommand().
+    """
+    data = response.read().decode('utf-8', 'replace')
+    if debug:
+        debugTransfer(response)
+        debugPrint(data)
+
+    match = _command_message.search(data)
+    if match: return int(match.group(1)), match.group(0)
+    error = errorText(data)
+    if error is None: error = data.strip().split('\n')[0] or 'no response'
+    return None, error
+
+def nagiosTargets(type, filters, argdict, problems=False):
+    """
+    List the hosts or services (type 'host' or 'service') that match
+    'filters' (see generateNagiosUrl()), as (host, service) pairs for
+    nagiosBulkCommand(); the service is None for hosts.  If 'problems' is
+    set we only list the current problems, otherwise everything in the
+    'bulk_views'.  Raises an Exception if the list could not be loaded.
+    """
+    return runSteps(_nagiosTargetsSteps(type, filters, argdict, problems))
+
+def _nagiosTargetsSteps(type, filters, argdict, problems=False):
+    report = _targetReport(type, problems)
+    rows = yield from _reportRowsSteps(report, argdict, header=True,
+        filters=filters)
+    return _targetList(type, report, rows)
+
+def _targetReport(type, problems):
+    """
+    The report that nagiosTargets() lists.
+    """
+    if problems and type == 'host':   return 'host'
+    elif problems:                    return 'hostservice'
+    elif type == 'host':              return 'hostsearch'
+    else:                             return 'svcsearch'
+
+def _targetList(type, report, rows):
+    """
+    Turn the rows of a report (with its header) into nagiosTargets()
+    targets.
+    """
+    if next(rows, None) is None:
+        raise Exception('could not load the %s list' % report)
+    if type == 'host':
+        return [(row.get('host'), None) for row in rows]
+    return [(row.get('host'), row.get('service_description')) for row in rows]
+
+def _regexEscape(text):
+    """
+    Escape a string for use in a (POSIX extended) regular expression, as
+    used by the Multisite filters.
+    """
+    return re.sub(r'([\\.^$|?*+()\[\]{}])', r'\\\1', text)
+
+def _targetBatches(targets, size):
+    """
+    Group (host, service) targets for nagiosBulkCommand(): hosts together,
+    and services by service name, in batches of at most 'size'.  Returns
+    a list of (filters, targets) pairs, where the filters match exactly
+    the hosts or services in that batch.
+    """
+    groups = {}
+    for host, service in targets:
+        groups.setdefault(service, []).append((host, service))
+
+    batches = []
+    for service in groups:
+        group = groups[service]
+        for i in range(0, len(group), size):
+            batch = group[i:i + size]
+            filters = {'host_regex': '^(%s)$' % '|'.join(_regexEscape(host)
+                for host, service in batch)}
+            if service is not None:
+                filters['service_regex'] = '^%s$' % _regexEscape(service)
+            batches.append((filters, batch))
+    return batches
+
+def nagiosBulkCommand(action, targets, params):
+    """
+    Send an 'ack' or 'downtime' command for many hosts and services at
+    once.  'targets' is a list of (host, service) pairs, where service is
+    None for a host; 'params' has the rest of the settings, as for
+    nagiosAck() or nagiosDowntime().
+
+    The targets are grouped (hosts together, services by name) and sent
+    'batch_size' at a time (from params or config.yaml), each batch as a
+    single command on one of the 'bulk_views', with filters that match
+    just those targets; up to 'workers' batches are sent at once.
+    Multisite tells us how many commands it sent: if that is one per
+    target, the whole batch worked; if not, we list the view to see which
+    targets it doesn't know about (too few), or which ones it went to
+    that nobody asked for (too many - the whole batch is then an error).
+    If the server turns the command down (an HTTP error, or no command
+    sent, say because the view doesn't exist), nothing was done, and we
+    fall back to one request per target.  If we don't know whether it
+    was done (a timeout, or a connection error), the batch fails, and is
+    not sent again - sending a downtime twice schedules it twice.
+
+    A command goes to every row of the view, so before sending any, we
+    list the view with the first batch's filters; if it returns anything
+    else (the view doesn't have those filters configured), all of the
+    targets of that type go one request at a time instead.
+
+    Returns two objects, as with batchRequest(): did every target
+    succeed, and a dictionary with the keys 'succeeded_targets' (a list
+    of targets) and 'failed_targets' (a dict of target -> error).  The
+    dictionary also has 'batch_errors', a dict of target -> error for the
+    targets whose batch command failed outright, and so were retried one
+    at a time.
+    """
+    return runSteps(_nagiosBulkCommandSteps(action, targets, params))
+
+def _nagiosBulkCommandSteps(action, targets, params):
+    params, targets, batches, workers = _bulkSetup(action, targets, params)
+
+    def single(target):
+        type, args = _singleArgs(params, target)
+        try:
+            count, message = yield from _nagiosCommandSteps(action, args)
+        except Exception as e:
+            return '%s' % e
+        return _singleError(type, count, message)
+
+    def filtered(filters, batch):
+        ## the raw rows, without reportFilter() in the way
+        report, args = _filteredArgs(params, filters, batch)
+        rows = yield from _reportRowsSteps(report, args, header=True)
+        if next(rows, None) is None: return False
+        try:
+            return _onlyTargets(rows, batch)
+        finally:
+            rows.close()
+
+    def bulk(filters, batch):
+        type, args = _bulkArgs(params, filters, batch)
+        try:
+            count, message = yield from _nagiosCommandSteps(action, args)
+        except Exception as e:
+            return _bulkError(batch, e)
+        result = _bulkOutcome(batch, count, message)
+        if result is not None: return result
+        known = yield from _nagiosTargetsSteps(type, filters, params)
+        return _bulkKnown(type, batch, count, known)
+
+    first = _firstBatches(batches)
+    types = list(first)
+    checks = yield Parallel([filtered(*first[type]) for type in types],
+        workers)
+    usable = dict((type, ok and check is True)
+        for type, (ok, check) in zip(types, checks))
+
+    errors = {}
+    batch_errors = {}
+    fallback = []
+    jobs = []
+    for filters, batch in batches:
+        if usable[_batchType(batch)]: jobs.append((filters, batch))
+        else:                         fallback.extend(batch)
+    results = yield Parallel([bulk(filters, batch)
+        for filters, batch in jobs], workers)
+    for (filters, batch), (ok, result) in zip(jobs, results):
+        if not ok: result = dict.fromkeys(batch, '%s' % result)
+        _bulkResult(batch, result, errors, batch_errors, fallback,
+            params['debug'])
+
+    results = yield Parallel([single(target) for target in fallback],
+        workers)
+    for target, (ok, error) in zip(fallback, results):
+        if ok: errors[target] = error
+        else:  errors[target] = '%s' % error
+
+    return _bulkSummary(targets, errors, batch_errors)
+
+## The pieces of nagiosBulkCommand() that don't talk to the server.
+
+def _bulkSetup(action, targets, params):
+    """
+    Returns the params for the commands (without the target filters, and
+    with a fixed downtime start), the unique targets, their batches (see
+    _targetBatches()), and how many requests to run at once.
+    """
+    params = dict((key, params[key]) for key in params
+        if key not in _target_filters)
+    if action == 'downtime' and not params.get('remove', False) \
+            and 'start' not in params:
+        ## every batch gets the same window
+        import datetime
+        params['start'] = datetime.datetime.now()
+
+    targets = list(dict.fromkeys(targets))
+    size = int(params.get('batch_size',
+        config.get('batch_size', batch_size_default)))
+    workers = int(params.get('workers',
+        config.get('workers', workers_default)))
+    return params, targets, _targetBatches(targets, size), workers
+
+def _batchType(batch):
+    if batch[0][1] is None: return 'host'
+    return 'service'
+
+def _firstBatches(batches):
+    """
+    The first batch of each type, to check the view with.
+    """
+    first = {}
+    for filters, batch in batches:
+        first.setdefault(_batchType(batch), (filters, batch))
+    return first
+
+def _singleArgs(params, target):
+    host, service = target
+    type = _batchType([target])
+    return type, dict(params, host=host, service=service, type=type)
+
+def _singleError(type, count, message):
+    if count is None: return message
+    if count == 0:    return 'no matching %s' % type
+    return None
+
+def _filteredArgs(params, filters, batch):
+    if _batchType(batch) == 'host': report = 'hostsearch'
+    else:                           report = 'svcsearch'
+    return report, dict(params, **filters)
+
+def _onlyTargets(rows, batch):
+    """
+    Are the report rows (after the header) all targets of the batch?
+    """
+    wanted = set(batch)
+    for row in rows:
+        if batch[0][1] is None: target = (row.get('host'), None)
+        else: target = (row.get('host'), row.get('service_description'))
+        if target not in wanted: return False
+    return True
+
+def _bulkArgs(params, filters, batch):
+    type = _batchType(batch)
+    return type, dict(params, host=None, service=None, type=type, **filters)
+
+## The errors from Session.request() for an HTTP error status: the server
+## answered, and didn't run the command.
+_status_errors = ('Page not found', 'Access Denied', 'http error, code')
+
+def _bulkOutcome(batch, count, message):
+    """
+    Sort out the answer to a batch command: target -> error if it went to
+    exactly the batch, the error if the command was turned down, or None
+    if we have to list the targets to see what it went to (see
+    _bulkKnown()).
+    """
+    if count is None:         return message or 'unknown error'
+    if count == len(batch):   return dict.fromkeys(batch)
+    return None
+
+def _bulkError(batch, error):
+    """
+    The outcome of a batch command that raised 'error': the error, to
+    fall back to one request per target, if the server turned it down;
+    otherwise we can't tell whether it was done, so every target of the
+    batch fails.
+    """
+    error = '%s' % error
+    if error.startswith(_status_errors): return error
+    return dict.fromkeys(batch, 'batch not confirmed, not resent: %s'
+        % error)
+
+def _bulkKnown(type, batch, count, known):
+    """
+    Sort out a batch command that Multisite says went to 'count' targets
+    rather than one per target of the batch, from the 'known' targets of
+    the batch's filters.  Too few: the targets it doesn't know failed.
+    Too many: unless the view lists the same targets more than once (and
+    no others), it went to targets that nobody asked for, so the whole
+    batch fails, naming them.
+    """
+    wanted = set(batch)
+    extra = [target for target in known if target not in wanted]
+    if extra or count > max(len(batch), len(known)):
+        error = 'command went to %d %ss, not %d' % (count, type, len(batch))
+        if extra:
+            error += '; also: %s' % ', '.join(targetName(target)
+                for target in extra)
+        return dict.fromkeys(batch, error)
+    known = set(known)
+    return dict((target, target not in known and 'no matching %s' % type
+        or None) for target in batch)
+
+def _bulkResult(batch, result, errors, batch_errors, fallback, debug):
+    """
+    File the result of bulk(): the target errors go into 'errors'; if
+    the command failed outright, the batch goes into 'fallback', and its
+    error into 'batch_errors'.
+    """
+    if isinstance(result, dict):
+        errors.update(result)
+        return
+    if debug:
+        print("batch of %d failed, sending one at a time: %s"
+            % (len(batch), result))
+    batch_errors.update(dict.fromkeys(batch, result))
+    fallback.extend(batch)
+
+def _bulkSummary(targets, errors, batch_errors):
+    succeeded = [target for target in targets if errors.get(target) is None]
+    failed = dict((target, errors[target]) for target in targets
+        if errors.get(target) is not None)
+    return len(failed) == 0, {'succeeded_targets': succeeded,
+        'failed_targets': failed, 'batch_errors': batch_errors}
+
+## How much of a Multisite report to read at a time.
+report_chunk_size = 65536
+
+## Report columns holding free text, which isn't worth interning (see
+## reportRowClass()).
+report_free_text = re.compile('output|comment|perfometer', re.IGNORECASE)
+
+_row_classes = {}
+
+def reportRowClass(fields):
+    """
+    Returns the row class for a report with the given header row.  Rows
+    are named tuples, with one field per column: they are as small as
+    plain tuples, can be used by field name (row.host, row.service_state)
+    and still work by position (row[0]).  Header names that aren't valid
+    identifiers are renamed (see collections.namedtuple); row.get() takes
+    the original names, and row._header is the original header.
+
+    Classes are cached by header, so every report from the same view has
+    the same row class.
+    """
+    key = tuple('%s' % field for field in fields)
+    if key not in _row_classes:
+        import collections
+
+        class ReportRow(collections.namedtuple('ReportRow', key,
+                rename=True)):
+            __slots__ = ()
+            columns = dict((field, i) for i, field in
+                reversed(list(enumerate(key))))
+            _header = key
+
+            def get(self, field, default=None):
+                i = self.columns.get(field, None)
+                if i is None: return default
+                return self[i]
+
+        ## _load() builds a row from a list of values, interning the
+        ## strings in all but the free text columns.
+        interned = tuple(i for i, field in enumerate(key)
+            if not report_free_text.search(field))
+        new = tuple.__new__
+        intern = sys.intern
+
+        def load(row):
+            row = list(row)
+            for i in interned:
+                value = row[i]
+                if type(value) is str: row[i] = intern(value)
+            return new(ReportRow, row)
+
+        ReportRow._load = staticmethod(load)
+
+        _row_classes[key] = ReportRow
+    return _row_classes[key]
+
+def reportRows(rows, header=False):
+    """
+    Convert parsed report rows (a header row, then lists of values) into
+    row objects (see reportRowClass()).  This is a generator; if 'header'
+    is set, the header row is returned first.
+
+    Strings are interned (except in free text columns like the plugin
+    output), so the state, host and service names that repeat on every
+    row of a large view are only stored once.
+    """
+    fields = next(rows, None)
+    if fields is None: return
+    if header: yield fields
+
+    cls = reportRowClass(fields)
+    load = cls._load
+    count = len(fields)
+    for row in rows:
+        if len(row) != count:
+            raise ValueError('report row has %d fields, expected %d'
+                % (len(row), count))
+        yield load(row)
+
+def reportFilter(filters):
+    """
+    Returns a function that checks whether a report row matches the
+    'host_regex', 'service_regex' and 'states' filters in 'filters' (see
+    generateNagiosUrl()), the same way that Multisite would; or None, if
+    there's nothing there that we can check.  The host group and the
+    acknowledgement aren't in the rows, so they can't be checked.
+
+    This is for views that don't have all of the filters configured, and
+    so return rows that don't match.  We can't tell that from the rows,
+    so nagiosReport() and iterNagiosReport() check every row unless
+    'view_filters' in config.yaml says that the views have the filters
+    (see reportMatch()).
+    """
+    checks = []
+    if filters.get('host_regex'):
+        host = re.compile(filters['host_regex'], re.IGNORECASE).search
+        checks.append(lambda row: host('%s' % row.get('host', '')))
+    if filters.get('service_regex'):
+        service = re.compile(filters['service_regex'], re.IGNORECASE).search
+        checks.append(lambda row: 'service_description' not in row.columns
+            or service('%s' % row.get('service_description')))
+    if filters.get('states'):
+        states = set(state.upper() for state in filters['states'])
+        checks.append(lambda row: ('%s' % row.get('service_state',
+            row.get('host_state', ''))).upper() in states)
+
+    if not checks: return None
+    return lambda row: all(check(row) for check in checks)
+
+def reportMatch(filters):
+    """
+    The row check that the report calls use for 'filters': reportFilter(),
+    unless 'view_filters' is set in config.yaml (the views have all of
+    the filters configured, so the server already did the work), or there
+    is nothing to check.  Returns None if the rows don't need checking.
+    """
+    if not filters or config.get('view_filters', False): return None
+    return reportFilter(filters)
+
+def nagiosReportArgs(type, argdict, filters=None):
+    """
+    Convert a report type into the generateNagiosUrl() action and
+    arguments.  Type can be one of 'svc_ack', 'svc_unack', 'host_ack',
+    'host_unack', 'host' or 'hostservice' (problems), or 'hostsearch' or
+    'svcsearch' (all hosts or services, from the 'bulk_views').  'filters'
+    is an optional dictionary of filters (see generateNagiosUrl()).
     """
     args = argdict.copy()
+    if filters: args.update(filters)
     if type == 'svc_ack':
         action = 'svcreport'
         args['ack'] = 1
@@ -522,20 +3148,179 @@ def nagiosReport(type, argdict):
         action = 'hostreport'
     elif type == 'hostservice':
         action = 'svcreport'
+    elif type == 'hostsearch' or type == 'svcsearch':
+        action = type
     elif type == 'get_host':
         action = 'get_host'
     else:
         raise Exception('invalid report type: %s' % type)
+    return action, args
+
+def nagiosReport(type, argdict, filters=None):
+    """
+    Generate a nagios report.  Type can be one of 'svc_ack', 'svc_unack',
+    'host_ack', or 'host_unack'.
 
+    'filters' is an optional dictionary of filters - 'host_regex',
+    'service_regex', 'states', 'hostgroup' and 'ack' - which are sent to
+    the server, so that it only returns the matching rows.  In case the
+    view doesn't have those filters, we check the rows ourselves as well
+    as we can, unless config.yaml says not to (see reportMatch()).
+    """
+    return runSteps(_nagiosReportSteps(type, argdict, filters))
+
+def _nagiosReportSteps(type, argdict, filters=None):
+    action, args = nagiosReportArgs(type, argdict, filters)
     url = generateNagiosUrl(action, args)
-    response = loadUrl(url, '')
-    return processNagiosReport(response, argdict['debug'])
+    response = yield Request(url, '')
+    rows = processNagiosReport(response, argdict['debug'])
+
+    match = reportMatch(filters)
+    if match and isinstance(rows, list):
+        rows = [row for row in rows if match(row)]
+    return rows
+
+def nagiosAlertReport(argdict, strict=False):
+    """
+    Load the current host and service problems, split into acknowledged
+    and unacknowledged alerts.  Returns a dictionary with the keys
+    'host_ack', 'host_unack', 'svc_ack' and 'svc_unack', each holding the
+    same rows that nagiosReport() would return for that type.
+
+    Normally a report that can't be loaded prints its error and comes
+    back empty, same as nagiosReport(); if 'strict' is set, we raise an
+    Exception instead, so that the caller can tell "no problems" from "no
+    answer" (see watchReports()).
+
+    If 'ack_column' is set in config.yaml, the expanded views are expected
+    to include an acknowledgement column (any field with 'acknowledged'
+    in its name; see README.md).  We then load each view only once, and
+    sort the rows locally (dropping that column, so the rows look the same
+    as always).  Otherwise - or if the column turns out to be missing - we
+    load the filtered reports in parallel.
+    """
+    return runSteps(_nagiosAlertReportSteps(argdict, strict))
+
+def _nagiosAlertReportSteps(argdict, strict=False):
+    report = {}
+    if config.get('ack_column', False):
+        views = {'host': 'host', 'svc': 'hostservice'}
+        results = yield Parallel([_listReportSteps(views[view], argdict,
+            strict) for view in views], 4)
+        for view, (ok, rows) in zip(views, results):
+            if not ok: raise rows
+            split = _splitAckRows(rows)
+            if split is None: continue
+            report['%s_ack' % view], report['%s_unack' % view] = split
+
+    types = [type for type in ('host_ack', 'host_unack', 'svc_ack',
+        'svc_unack') if type not in report]
+    if strict:
+        steps = [_listReportSteps(type, argdict, strict) for type in types]
+    else:
+        steps = [_nagiosReportSteps(type, argdict) for type in types]
+    results = yield Parallel(steps, 4)
+    for type, (ok, rows) in zip(types, results):
+        if not ok: raise rows
+        if strict: rows = rows[1:]
+        report[type] = rows
+
+    return report
+
+def _listReportSteps(type, argdict, strict=False, filters=None):
+    """
+    Load a full report, including the header row.  If 'strict' is set,
+    raise an Exception if we didn't get one (the server returned an error
+    instead of JSON).
+    """
+    rows = yield from _reportRowsSteps(type, argdict, header=True,
+        filters=filters)
+    rows = list(rows)
+    if strict and not rows:
+        raise Exception('could not load the %s report' % type)
+    return rows
+
+def _splitAckRows(rows):
+    """
+    Split a report (with its header row) on its acknowledgement column.
+    Returns a pair of lists, the acknowledged and unacknowledged rows,
+    with the column removed; or None if there is no such column.
+    """
+    if not rows: return [], []
+    column = None
+    for i, field in enumerate(rows[0]):
+        if 'acknowledged' in ('%s' % field).lower():
+            column = i
+            break
+    if column is None: return None
+
+    fields = list(rows[0])
+    del fields[column]
+    make = reportRowClass(fields)._make
+
+    ack, unack = [], []
+    for row in rows[1:]:
+        value = ('%s' % row[column]).lower()
+        row = make(row[:column] + row[column + 1:])
+        if value in ('1', 'yes', 'true', 'ack', 'acknowledged'):
+            ack.append(row)
+        else:
+            unack.append(row)
+    return ack, unack
+
+def iterNagiosReport(type, argdict, header=False, filters=None):
+    """
+    Like nagiosReport(), but a generator: rows are parsed and returned one
+    at a time as they come in from the server, so memory use stays flat
+    no matter how big the view is, and the caller can start working
+    before the download is finished.
+
+    If 'header' is set, the first row returned is the list of field
+    names.  If the server doesn't return JSON, we print the error (as
+    with processNagiosReport()) and return no rows.  Rows are returned as
+    named tuples (see reportRowClass()).  'filters' works the same as
+    with nagiosReport().
+    """
+    yield from runSteps(_reportRowsSteps(type, argdict, header, filters))
+
+def _reportRowsSteps(type, argdict, header=False, filters=None):
+    """
+    Load a report; returns a generator of its rows, which reads the
+    response as it goes (see reportResponseRows()).
+    """
+    action, args = nagiosReportArgs(type, argdict, filters)
+    url = generateNagiosUrl(action, args)
+    response = yield Request(url, '')
+    return reportResponseRows(response, argdict, header, filters)
+
+def reportResponseRows(response, argdict, header=False, filters=None):
+    """
+    The rows of a report from loadUrl(), for iterNagiosReport(): a
+    generator, which reads the response as it goes.
+    """
+    data = _firstChunk(response)
+    if not data.lstrip().startswith(b'['):
+        _nagiosReportError((data + response.read()).decode())
+        return
+
+    match = reportMatch(filters)
+    rows = reportRows(_jsonRows(response, data), header=header)
+    if header:
+        fields = next(rows, None)
+        if fields is None: return
+        yield fields
+    for row in rows:
+        if argdict['debug']: debugPrint(row)
+        if match and not match(row): continue
+        yield row
+    if argdict['debug']: debugTransfer(response)
 
 def processNagiosReport(response, debug):
     """
     Process the response from loadUrl().  Returns an array of matching
     objects, where we've trimmed off the first one (which described the
-    fields of the later objects).
+    fields of the later objects); the objects are named tuples built from
+    those fields (see reportRowClass()), e.g. row.host.
 
     If 'debug' is set, we'll print a lot of extra debugging information.
 
@@ -543,27 +3328,444 @@ def processNagiosReport(response, debug):
     isn't always returning with json, even when we ask it to.
     """
 
-    data = response.read().decode()
+    data = _firstChunk(response)
+    if not data.lstrip().startswith(b'['):
+        return _nagiosReportError((data + response.read()).decode())
 
     try:
-        jsonresult = json.loads(data)
-        if debug: pprint(jsonresult)
-    except ValueError:
-        lines = data.split('\n')
-        if re.match('^MESSAGE: .*$', lines[0]):
-            return lines[0]
-        soup = BeautifulSoup(data, 'lxml')
-        div1 = soup.find('div', attrs={'class': 'error'})
-        if div1 is not None:
-            print("Error returned")
-            print(div1.string)
-            return []
+        with _gcPaused():
+            jsonresult = list(reportRows(_jsonRows(response, data)))
+        if debug:
+            debugTransfer(response)
+            debugPrint(jsonresult)
+    except ValueError as exc:
+        print("ValueError.  Invalid JSON object returned: %s" % exc)
+        return []
+
+    return jsonresult
+
+class _gcPaused(object):
+    """
+    Turns off the cyclic garbage collector for a 'with' block.  Building
+    hundreds of thousands of rows at once makes it re-scan the growing
+    heap over and over, for nothing (rows can't hold cycles).
+    """
+    def __enter__(self):
+        import gc
+        self.collect = gc.isenabled()
+        gc.disable()
+
+    def __exit__(self, *exc):
+        import gc
+        if self.collect: gc.enable()
+
+def _nagiosReportError(data):
+    """
+    Deal with a Multisite response that wasn't JSON.  Returns the first
+    line if it was a 'MESSAGE:' line (which is what we get back from
+    commands), otherwise prints the error and returns an empty list.
+    """
+    lines = data.split('\n')
+    if re.match('^MESSAGE: .*$', lines[0]):
+        return lines[0]
+    error = errorText(data)
+    if error is not None:
+        print("Error returned")
+        print(error)
+        return []
+    else:
+        print("ValueError.  Invalid JSON object returned, and could not extract error.  Full response was:")
+        print(data)
+        return []
+
+def _firstChunk(response):
+    """
+    Read from the response until we have something other than whitespace
+    (or run out of data), so we can tell whether we got JSON back.
+    """
+    data = b''
+    while not data.strip():
+        chunk = response.read(report_chunk_size)
+        if not chunk: break
+        data += chunk
+    return data
+
+def _jsonRows(response, data):
+    """
+    Incrementally parse a JSON list of lists (which is what Multisite
+    gives us for output_format=json), yielding the inner lists one at a
+    time.  'data' is whatever has already been read from the response.
+    Raises a ValueError if the JSON is bad or truncated.
+
+    All of the complete rows in each chunk are parsed with a single
+    json.loads(), cutting the chunk at its last ']'.  If that cut wasn't
+    at the end of a row - it was inside a string, or inside a list within
+    a row, or at the end of the whole list - the brackets or quotes won't
+    balance and the parse fails, and we fall back to parsing that chunk
+    one row at a time.
+    """
+    decoder = json.JSONDecoder()
+    metrics = getattr(response, 'metrics', None)
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    if not data.strip(): data += _firstChunk(response)
+    buf = utf8.decode(data)
+    if not buf.lstrip().startswith('['):
+        raise ValueError('response is not a JSON list')
+    pos = buf.index('[') + 1
+    done = False
+    batch = True
+
+    while True:
+        ## skip to the start of the next row (or the end of the list)
+        while pos < len(buf) and buf[pos] in ' \t\r\n,': pos += 1
+        if pos < len(buf):
+            if buf[pos] == ']': return
+            start = time.time()
+            rows = None
+            cut = buf.rfind(']', pos) + 1
+            if batch and cut > pos:
+                try:
+                    rows = json.loads('[%s]' % buf[pos:cut])
+                    pos = cut
+                except ValueError:
+                    batch = False
+            if rows is None:
+                try:
+                    row, pos = decoder.raw_decode(buf, pos)
+                    rows = [row]
+                except ValueError:
+                    if done: raise
+            if metrics is not None:
+                metrics['decode'] = metrics.get('decode', 0) + \
+                    time.time() - start
+            if rows is not None:
+                for row in rows: yield row
+                continue
+
+        if done: raise ValueError('truncated JSON response')
+
+        ## we need more data; throw away what we've already parsed
+        chunk = response.read(report_chunk_size)
+        buf = buf[pos:] + utf8.decode(chunk, final=not chunk)
+        pos = 0
+        batch = True
+        if not chunk: done = True
+
+#########################################################################
+### Report Watching #####################################################
+#########################################################################
+
+## Report columns that make a problem count as "changed" between polls in
+## reportChanges().  The ages, check times and plugin output change all
+## the time, so they aren't compared.
+report_watch_fields = re.compile('(^|_)state$|comments|acknowledged',
+    re.IGNORECASE)
+
+def _reportKeys(rows):
+    """
+    Returns two iterators over a list of report rows (all of the same
+    class): their keys, as (host, service) pairs - the service is None for
+    host problems - and the values of the columns that we compare.  The
+    work is all done by map() and zip(), to keep it out of Python.
+    """
+    import itertools, operator
+
+    columns = getattr(type(rows[0]), 'columns', {})
+    host = columns.get('host', 0)
+    if 'service_description' in columns:
+        keys = map(operator.itemgetter(host, columns['service_description']),
+            rows)
+    else:
+        keys = zip(map(operator.itemgetter(host), rows),
+            itertools.repeat(None))
+
+    watched = [columns[field] for field in columns
+        if report_watch_fields.search(field)]
+    if watched: values = map(operator.itemgetter(*watched), rows)
+    else:       values = itertools.repeat(None, len(rows))
+    return keys, values
+
+def reportSnapshot(reports):
+    """
+    Index the rows of one or more reports by host and service, so that
+    two polls can be compared with reportChanges().  'reports' is a
+    dictionary of report name -> rows, e.g. from nagiosAlertReport().
+
+    Returns a pair of dictionaries, both keyed on (host, service) (the
+    service is None for host problems): one of rows, and one of (name,
+    compared values) for reportChanges().
+    """
+    import itertools
+
+    rows, values = {}, {}
+    with _gcPaused():
+        for name in reports:
+            report = reports[name]
+            if not report: continue
+            classes = set(map(type, report))
+            if len(classes) == 1: groups = [report]
+            else: groups = [[row for row in report if type(row) is cls]
+                for cls in classes]
+
+            for group in groups:
+                keys, watched = _reportKeys(group)
+                keys = list(keys)
+                rows.update(zip(keys, group))
+                values.update(zip(keys, zip(itertools.repeat(name),
+                    watched)))
+    return rows, values
+
+def reportChanges(old, new):
+    """
+    Compare two snapshots from reportSnapshot().  Returns three lists:
+    the new problems and the cleared problems, as (name, row) pairs, and
+    the changed problems, as (old, new) pairs of those - the ones that
+    moved to a different report (e.g. they were acknowledged) or whose
+    state or comments changed.  Each list is sorted by host and service.
+
+    Problems are only compared by key and by a few columns (see
+    'report_watch_fields'); if nothing changed, that's a single dict
+    comparison, and otherwise only the problems that differ are turned
+    into rows.
+    """
+    old_rows, old_values = old
+    new_rows, new_values = new
+    if old_values == new_values: return [], [], []
+
+    previous = old_values.get
+    appeared = [key for key, value in new_values.items()
+        if previous(key) != value]
+    added = [key for key in appeared if key not in old_values]
+    changed = [key for key in appeared if key in old_values]
+
+    ## every old key is either still there or cleared, so we only need to
+    ## look for cleared problems if the numbers say there are some
+    if len(old_values) - len(new_values) + len(added):
+        cleared = old_values.keys() - new_values.keys()
+    else:
+        cleared = []
+
+    order = lambda key: (key[0], key[1] or '')
+    entry = lambda rows, values, key: (values[key][0], rows[key])
+    return ([entry(new_rows, new_values, key)
+            for key in sorted(added, key=order)],
+        [entry(old_rows, old_values, key)
+            for key in sorted(cleared, key=order)],
+        [(entry(old_rows, old_values, key), entry(new_rows, new_values, key))
+            for key in sorted(changed, key=order)])
+
+def watchReports(load, interval):
+    """
+    Poll for problems forever.  load() is called every 'interval' seconds
+    and returns a dictionary of report name -> rows (e.g. a call to
+    nagiosAlertReport() with 'strict' set); it should raise an Exception
+    if it couldn't get an answer, rather than return no rows, or every
+    known problem will look like it has cleared.
+
+    This is a generator.  The first poll yields (reports, None); every
+    later poll yields (reports, changes), where changes are the three
+    lists from reportChanges().  A poll that fails prints the error to
+    STDERR, and the next poll is compared against the last good one.
+    Connections are kept open between polls (see Session), so each poll
+    is one or a few requests on an existing connection.
+    """
+    snapshot = None
+    while True:
+        start = time.time()
+        try:
+            reports = load()
+        except Exception as e:
+            sys.stderr.write("poll failed: %s\n" % e)
+            sys.stderr.flush()
         else:
-            print("ValueError.  Invalid JSON object returned, and could not extract error.  Full response was:")
-            print(data)
-            return []
+            current = reportSnapshot(reports)
+            if snapshot is None: yield reports, None
+            else:                yield reports, reportChanges(snapshot, current)
+            snapshot = current
+        time.sleep(max(interval - (time.time() - start), 0))
 
-    if len(jsonresult) <= 1: return []
+#########################################################################
+### Multiple Sites ######################################################
+#########################################################################
+## config.yaml can describe several OMD sites, each with its own server,
+## site name and credentials:
+##
+##     sites:
+##       east:
+##         server: 'omd-east.example.com'
+##       west:
+##         server: 'omd-west.example.com'
+##         site: 'prod'
+##         apikey: 'other-secret'
+##
+## Anything a site doesn't set comes from the usual settings; the site
+## name defaults to the name of the entry.  fanOut() runs a call against
+## a set of these sites at once, and the *Sites() functions merge the
+## results, tagged by site.
+
+## How long to wait for each site, by default; can be overridden with
+## 'site_timeout' in config.yaml.
+site_timeout_default = 30
+
+## The per-site settings that siteArgs() copies into the argument dict.
+site_keys = ('server', 'site', 'user', 'apikey', 'scheme')
+
+def siteArgs(argdict, names='all'):
+    """
+    Returns a dictionary of site name -> argument dict, one for each of
+    the 'sites' in config.yaml listed in 'names' (a list, or a string of
+    comma-separated names; 'all' means every site), in that order.  Each
+    argument dict is a copy of 'argdict' with that site's settings.
+    Raises an Exception if there are no sites, or an unknown one.
+    """
+    sites = config.get('sites', None) or {}
+    if not sites: raise Exception('no sites in the configuration file')
+
+    if isinstance(names, str): names = names.split(',')
+    names = [name.strip() for name in names if name.strip()]
+    if 'all' in names: names = list(sites)
+
+    result = {}
+    for name in names:
+        if name not in sites: raise Exception('unknown site: %s' % name)
+        args = argdict.copy()
+        args['site'] = name
+        settings = sites[name] or {}
+        for key in site_keys:
+            if key in settings: args[key] = settings[key]
+        result[name] = args
+    return result
+
+def fanOut(func, sites, timeout=None):
+    """
+    Call func(argdict) for each of the sites from siteArgs() at once, each
+    in its own thread.  This is a generator: it yields (site, ok, result)
+    as each site finishes, where 'result' is what func() returned if 'ok'
+    is True, or the error if it raised an Exception.
+
+    Sites that haven't answered after 'timeout' seconds (default: the
+    'site_timeout' setting from config.yaml, or 30) are given up on, and
+    yielded last with a 'timed out' error.  Their threads are left to
+    finish on their own; the connections to each site's server use the
+    same timeout (see Session.setTimeout()), so a server that has stopped
+    answering doesn't hold up the end of the script either.
+    """
+    import queue
+
+    if timeout is None:
+        timeout = config.get('site_timeout', site_timeout_default)
+    timeout = float(timeout)
+
+    session = getSession()
+    for name in sites:
+        if sites[name].get('server'):
+            session.setTimeout(sites[name]['server'], timeout)
+
+    done = queue.Queue()
+    def run(name, args):
+        try:
+            done.put((name, True, func(args)))
+        except Exception as e:
+            done.put((name, False, '%s' % e))
+
+    for name in sites:
+        thread = threading.Thread(target=run, args=(name, sites[name]))
+        thread.daemon = True
+        thread.start()
+
+    deadline = time.time() + timeout
+    waiting = set(sites)
+    while waiting:
+        try:
+            name, ok, result = done.get(
+                timeout=max(deadline - time.time(), 0))
+        except queue.Empty:
+            break
+        waiting.discard(name)
+        yield name, ok, result
+
+    for name in sites:
+        if name in waiting:
+            yield name, False, 'timed out after %g seconds' % timeout
+
+def _fanOutAll(func, sites, timeout=None):
+    """
+    Run fanOut() to the end.  Returns two dictionaries: site -> result for
+    the sites that worked, in the same order as 'sites', and site -> error
+    for the rest.
+    """
+    results, failed = {}, {}
+    for name, ok, result in fanOut(func, sites, timeout):
+        if ok: results[name] = result
+        else:  failed[name] = result
+    return dict((name, results[name]) for name in sites
+        if name in results), failed
+
+def listHostsSites(sites, timeout=None):
+    """
+    listHosts() on each of the sites from siteArgs() at once.  Returns
+    two dictionaries: (site, hostname) -> host data, for every host on
+    every site that answered; and site -> error, for the ones that
+    didn't (see fanOut()).
+    """
+    results, failed = _fanOutAll(lambda args: runSteps(_siteHostsSteps(args)),
+        sites, timeout)
+    return _siteHosts(results), failed
 
-    jsonresult.pop(0)
-    return jsonresult
+def nagiosReportSites(type, sites, filters=None, timeout=None):
+    """
+    nagiosReport() on each of the sites from siteArgs() at once.  Returns
+    a list of (site, row) pairs, the rows of each site in turn (in the
+    order of 'sites'); and a dictionary of site -> error for the sites
+    that couldn't be loaded (see fanOut()).
+    """
+    results, failed = _fanOutAll(
+        lambda args: runSteps(_siteRowsSteps(type, args, filters)), sites,
+        timeout)
+    return _siteRows(results), failed
+
+def nagiosAlertReportSites(sites, timeout=None):
+    """
+    nagiosAlertReport() on each of the sites from siteArgs() at once.
+    Returns the same dictionary of reports, but with (site, row) pairs
+    instead of rows (each site in turn, in the order of 'sites'); and a
+    dictionary of site -> error for the sites that couldn't be loaded
+    (see fanOut()).
+    """
+    results, failed = _fanOutAll(
+        lambda args: runSteps(_nagiosAlertReportSteps(args, strict=True)),
+        sites, timeout)
+    return _siteAlertReport(results), failed
+
+## What the *Sites() functions load from each site, here and in
+## omdclient.aio.
+
+def _siteHostsSteps(args):
+    value, result = yield from _listHostsSteps(args)
+    if not value: raise Exception(result)
+    return result
+
+def _siteRowsSteps(type, args, filters=None):
+    rows = yield from _listReportSteps(type, args, strict=True,
+        filters=filters)
+    return rows[1:]
+
+## Merging the results of each site (site -> result, in order), for the
+## *Sites() functions here and in omdclient.aio.
+
+def _siteHosts(results):
+    hosts = {}
+    for name in results:
+        for host in results[name]:
+            hosts[(name, host)] = results[name][host]
+    return hosts
+
+def _siteRows(results):
+    return [(name, row) for name in results for row in results[name]]
+
+def _siteAlertReport(results):
+    report = {}
+    for type in ('host_ack', 'host_unack', 'svc_ack', 'svc_unack'):
+        report[type] = [(name, row) for name in results
+            for row in results[name][type]]
+    return report
@@ -0,0 +1,604 @@
+"""
+Asyncio interface to omdclient.  Usage:
+
+    import asyncio, omdclient, omdclient.aio
+
+    async def main(hosts, argdict):
+        async with omdclient.aio.AsyncClient(argdict) as client:
+            return await asyncio.gather(
+                *[client.readHost(host) for host in hosts])
+
+Every call returns the same thing as the matching omdclient function -
+for the WATO calls, the (ok, result) pair from processUrlResponse().
+
+The requests are made on asyncio itself: AsyncSession keeps a pool of
+keep-alive HTTP/1.1 connections over asyncio streams, with a limit on
+how many requests are in flight at once.  Everything else is the same
+code as in omdclient - the calls are its step generators (see
+omdclient.runSteps()), run with the parsing and file I/O in worker
+threads - so the results (and the host cache, journal and profiling) are
+the same.  The differences: each response body is read into memory (as
+it came over the wire) before it is parsed, and omdclientd is not used.
+"""
+
+#########################################################################
+### Declarations ########################################################
+#########################################################################
+
+import asyncio, fcntl, itertools, time, urllib.parse, omdclient
+
+## How much of a response to read at a time.
+read_size = 65536
+
+## How often to try for a Lock step (see AsyncClient._step()).
+lock_poll = 0.1
+
+## How many report rows to parse at a time (see iterNagiosReport()).
+report_batch = 1000
+
+#########################################################################
+### AsyncSession ########################################################
+#########################################################################
+
+class _Closed(Exception):
+    """
+    The server closed the connection before it answered; 'sent' says
+    whether it could have got the request first.
+    """
+    def __init__(self, message, sent):
+        Exception.__init__(self, message)
+        self.sent = sent
+
+class _Body(object):
+    """
+    A response that has been read in full, with just enough of the
+    http.client.HTTPResponse interface for omdclient._PooledResponse
+    (which decompresses the body and counts the bytes).
+    """
+    def __init__(self, status, headers, data):
+        self.status = status
+        self._headers = headers
+        self._data = data
+        self._pos = 0
+
+    def getheader(self, name, default=None):
+        return self._headers.get(name.lower(), default)
+
+    def read(self, amt=None):
+        end = len(self._data)
+        if amt is not None and amt >= 0: end = min(self._pos + amt, end)
+        data = self._data[self._pos:end]
+        self._pos = end
+        return data
+
+    def isclosed(self):
+        return self._pos >= len(self._data)
+
+    def close(self):
+        self._pos = len(self._data)
+
+class AsyncSession(object):
+    """
+    A pool of keep-alive HTTP/1.1 connections over asyncio streams, keyed
+    by server, like omdclient.Session.  At most 'limit' requests are in
+    flight at once (so no more than 'limit' connections are open), and up
+    to 'limit' idle connections are kept per server.  'timeout',
+    'connect_timeout' and 'compress' default to the settings in
+    config.yaml (see omdclient.getSession()).
+    """
+    def __init__(self, limit, timeout=None, connect_timeout=None,
+            compress=None):
+        if timeout is None:
+            timeout = omdclient.config.get('timeout',
+                omdclient.timeout_default)
+        if connect_timeout is None:
+            connect_timeout = omdclient.config.get('connect_timeout',
+                omdclient.connect_timeout_default)
+        if compress is None:
+            compress = omdclient.config.get('compress', True)
+        self.limit = int(limit)
+        self.timeout = float(timeout)
+        self.connect_timeout = float(connect_timeout)
+        self.compress = compress
+        self._slots = asyncio.Semaphore(self.limit)
+        self._idle = {}
+        self._ssl = None
+
+    async def _wait(self, future, timeout=None):
+        if timeout is None: timeout = self.timeout
+        return await asyncio.wait_for(future, timeout)
+
+    async def _connect(self, parts, metrics):
+        ssl = None
+        if parts.scheme == 'https':
+            if self._ssl is None:
+                import ssl
+                self._ssl = ssl.create_default_context()
+            ssl = self._ssl
+        port = parts.port
+        if port is None: port = parts.scheme == 'https' and 443 or 80
+
+        start = time.time()
+        conn = await self._wait(asyncio.open_connection(parts.hostname, port,
+            ssl=ssl), self.connect_timeout)
+        if metrics is not None: metrics['connect'] = time.time() - start
+        return conn
+
+    def _connection(self, key):
+        """
+        Returns an idle (reader, writer) pair for the server, and True; or
+        None and False if there isn't one.
+        """
+        idle = self._idle.get(key, [])
+        while idle:
+            reader, writer = idle.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                return (reader, writer), True
+            writer.close()
+        return None, False
+
+    def _release(self, key, conn):
+        idle = self._idle.setdefault(key, [])
+        if len(idle) < self.limit: idle.append(conn)
+        else:                      conn[1].close()
+
+    def _discard(self, conn):
+        if conn is not None: conn[1].close()
+
+    async def request(self, url, request_string):
+        """
+        POST the request string to the given URL, and return the response
+        wrapped as an omdclient._PooledResponse, the same as
+        omdclient.Session.request().  If a re-used connection turns out to
+        have been closed by the server, we retry once on a new one - but
+        only if it failed while sending the request, or the request only
+        reads (see omdclient.readOnlyRequest()).
+        """
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise Exception('url error: unsupported scheme %s' % parts.scheme)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path
+        if parts.query: path = "%s?%s" % (path, parts.query)
+        body = request_string.encode('utf-8')
+        head = [
+            'POST %s HTTP/1.1' % path,
+            'Host: %s' % parts.netloc,
+            'Content-Type: application/x-www-form-urlencoded',
+            'User-Agent: omdclient',
+            'Content-Length: %d' % len(body),
+        ]
+        if self.compress: head.append('Accept-Encoding: gzip, deflate')
+        message = ('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body
+
+        profile = omdclient._profile
+        metrics = None
+        if profile is not None: metrics = profile.start(parts, body)
+
+        async with self._slots:
+            retry = True
+            while True:
+                conn, reused = self._connection(key)
+                try:
+                    if conn is None: conn = await self._connect(parts, metrics)
+                    status, headers, data, keep = \
+                        await self._exchange(conn, message, metrics)
+                    break
+                except _Closed as err:
+                    self._discard(conn)
+                    if reused and retry and (not err.sent
+                            or omdclient.readOnlyRequest(parts)):
+                        retry = False
+                        continue
+                    if metrics is not None: profile.failed(metrics, err)
+                    raise Exception('url error: %s' % err)
+                except (OSError, EOFError, ValueError,
+                        asyncio.TimeoutError) as err:
+                    self._discard(conn)
+                    err = '%s' % err or 'timed out'
+                    if metrics is not None: profile.failed(metrics, err)
+                    raise Exception('url error: %s' % err)
+                except asyncio.CancelledError:
+                    self._discard(conn)
+                    raise
+            if keep: self._release(key, conn)
+            else:    self._discard(conn)
+
+        if metrics is not None:
+            metrics['reused'] = reused
+            metrics['status'] = status
+            metrics['total'] = time.time() - metrics['time']
+
+        response = omdclient._PooledResponse(None, None, None,
+            _Body(status, headers, data), metrics)
+        if status >= 300:
+            response.read()
+            if status == 404:
+                raise Exception('Page not found')
+            elif status == 403:
+                raise Exception('Access Denied')
+            else:
+                raise Exception('http error, code %s' % status)
+
+        return response
+
+    async def _exchange(self, conn, message, metrics):
+        """
+        Send the request, and read the answer.  Returns the status, the
+        headers (with lower-case names), the body, and whether we can keep
+        the connection.
+        """
+        reader, writer = conn
+        try:
+            writer.write(message)
+            await self._wait(writer.drain())
+        except ConnectionError as err:
+            raise _Closed(err, False)
+        try:
+            line = await self._wait(reader.readline())
+        except (ConnectionError, asyncio.IncompleteReadError) as err:
+            raise _Closed(err, True)
+        if not line:
+            raise _Closed('Remote end closed connection without response',
+                True)
+
+        while True:
+            version, status = self._statusLine(line)
+            headers = await self._headers(reader)
+            if status >= 200 or status < 100: break
+            line = await self._wait(reader.readline())
+        if metrics is not None:
+            metrics['first_byte'] = time.time() - metrics['time']
+
+        keep = version == 'HTTP/1.1' \
+            and headers.get('connection', '').lower() != 'close'
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            data = await self._chunked(reader)
+        elif 'content-length' in headers:
+            data = await self._read(reader, int(headers['content-length']))
+        else:
+            data = await self._read(reader, None)
+            keep = False
+        return status, headers, data, keep
+
+    def _statusLine(self, line):
+        fields = line.decode('latin-1').split(None, 2)
+        if len(fields) < 2 or not fields[0].startswith('HTTP/') \
+                or not fields[1].isdigit():
+            raise ValueError('bad status line: %r' % line)
+        return fields[0], int(fields[1])
+
+    async def _headers(self, reader):
+        headers = {}
+        while True:
+            line = await self._wait(reader.readline())
+            if not line: raise EOFError('connection closed in the headers')
+            if line in (b'\r\n', b'\n'): return headers
+            name, _, value = line.decode('latin-1').partition(':')
+            name = name.strip().lower()
+            if name in headers: headers[name] += ', ' + value.strip()
+            else:               headers[name] = value.strip()
+
+    async def _read(self, reader, length):
+        """
+        Read 'length' bytes of the body, or all of it until the server
+        closes the connection if 'length' is None.
+        """
+        data = []
+        while length is None or length > 0:
+            size = read_size
+            if length is not None: size = min(size, length)
+            chunk = await self._wait(reader.read(size))
+            if not chunk:
+                if length is None: break
+                raise EOFError('connection closed in the body')
+            data.append(chunk)
+            if length is not None: length -= len(chunk)
+        return b''.join(data)
+
+    async def _chunked(self, reader):
+        data = []
+        while True:
+            line = await self._wait(reader.readline())
+            if not line: raise EOFError('connection closed in the body')
+            size = int(line.split(b';')[0].strip(), 16)
+            if size == 0: break
+            data.append(await self._read(reader, size))
+            await self._read(reader, 2)
+        while True:
+            line = await self._wait(reader.readline())
+            if line in (b'\r\n', b'\n', b''): break
+        return b''.join(data)
+
+    async def close(self):
+        """
+        Close all idle connections.
+        """
+        idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for reader, writer in conns:
+                writer.close()
+                try:
+                    await writer.wait_closed()
+                except Exception:
+                    pass
+
+#########################################################################
+### AsyncClient #########################################################
+#########################################################################
+
+class AsyncClient(object):
+    """
+    Coroutine versions of the omdclient functions, bound to an argument
+    hash (as from omdclient.parserArgDict()).  Each method takes the same
+    arguments as the omdclient function of the same name, except that the
+    argument hash is optional and defaults to the one offered here.
+
+    The methods run the same step generators as omdclient does (see
+    omdclient.runSteps()).  The requests go through one AsyncSession, so
+    at most 'concurrency' of them are in flight at once (default: 'workers'
+    from config.yaml).  Everything in between - parsing the answers, the
+    host cache, the journal - runs in a worker thread (see
+    asyncio.to_thread()), so a big host list or view doesn't hold up the
+    event loop.
+    """
+    def __init__(self, arghash, concurrency=None):
+        if concurrency is None:
+            concurrency = omdclient.config.get('workers',
+                omdclient.workers_default)
+        self.arghash = arghash
+        self.concurrency = int(concurrency)
+        self.session = AsyncSession(self.concurrency)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        """
+        Close the idle connections.
+        """
+        await self.session.close()
+
+    async def _run(self, steps):
+        """
+        The asyncio version of omdclient.runSteps().
+        """
+        answer, error = None, None
+        while True:
+            done, step = await asyncio.to_thread(omdclient.advanceSteps,
+                steps, answer, error)
+            if done: return step
+            answer, error = None, None
+            try:
+                answer = await self._step(step)
+            except Exception as e:
+                error = e
+
+    async def _step(self, step):
+        if isinstance(step, omdclient.Request):
+            return await self.session.request(step.url, step.request_string)
+        elif isinstance(step, omdclient.Parallel):
+            slots = asyncio.Semaphore(step.workers or max(len(step.steps), 1))
+            async def run(steps):
+                async with slots:
+                    try:
+                        return True, await self._run(steps)
+                    except Exception as e:
+                        return False, e
+            return await asyncio.gather(*[run(steps)
+                for steps in step.steps])
+        elif isinstance(step, omdclient.Sleep):
+            await asyncio.sleep(step.seconds)
+        elif isinstance(step, omdclient.Lock):
+            ## don't block the event loop waiting for the lock
+            while True:
+                try:
+                    fcntl.flock(step.fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return
+                except BlockingIOError:
+                    await asyncio.sleep(lock_poll)
+        else:
+            raise Exception('unknown step: %s' % (step,))
+
+    ## WATO ################################################################
+
+    async def activateChanges(self, arghash=None):
+        return await self._run(omdclient._activateChangesSteps(
+            arghash or self.arghash))
+
+    async def activateChangesCoalesced(self, arghash=None, window=None):
+        return await self._run(omdclient._activateChangesCoalescedSteps(
+            arghash or self.arghash, window))
+
+    async def createHost(self, host, arghash=None):
+        return await self._run(omdclient._createHostSteps(host,
+            arghash or self.arghash))
+
+    async def readHost(self, host, arghash=None):
+        return await self._run(omdclient._readHostSteps(host,
+            arghash or self.arghash))
+
+    async def currentHost(self, host, arghash=None):
+        return await self._run(omdclient._currentHostSteps(host,
+            arghash or self.arghash))
+
+    async def updateHost(self, host, arghash=None):
+        return await self._run(omdclient._updateHostSteps(host,
+            arghash or self.arghash))
+
+    async def deleteHost(self, host, arghash=None):
+        return await self._run(omdclient._deleteHostSteps(host,
+            arghash or self.arghash))
+
+    async def listHosts(self, arghash=None):
+        return await self._run(omdclient._listHostsSteps(
+            arghash or self.arghash))
+
+    async def listHostsFiltered(self, filter, arghash=None):
+        return await self._run(omdclient._listHostsFilteredSteps(filter,
+            arghash or self.arghash))
+
+    async def hostInventory(self, arghash=None):
+        return await self._run(omdclient._hostInventorySteps(
+            arghash or self.arghash))
+
+    async def batchRequest(self, action, key, entries, arghash=None):
+        return await self._run(omdclient._batchRequestSteps(action, key,
+            entries, arghash or self.arghash))
+
+    async def createHosts(self, hosts, arghash=None):
+        return await self._run(omdclient._createHostsSteps(hosts,
+            arghash or self.arghash))
+
+    async def updateHosts(self, hosts, arghash=None):
+        return await self._run(omdclient._updateHostsSteps(hosts,
+            arghash or self.arghash))
+
+    async def deleteHosts(self, hosts, arghash=None):
+        return await self._run(omdclient._deleteHostsSteps(hosts,
+            arghash or self.arghash))
+
+    async def discoverServicesHost(self, host, arghash=None):
+        return await self._run(omdclient._discoverServicesHostSteps(host,
+            arghash or self.arghash))
+
+    async def discoverServicesHosts(self, hosts, arghash=None):
+        """
+        An async generator, otherwise the same as
+        omdclient.discoverServicesHosts(); 'concurrency' takes the place
+        of 'workers'.
+        """
+        arghash = arghash or self.arghash
+        journal = arghash.get('journal', None)
+        if journal is not None:
+            await asyncio.to_thread(journal.plan, 'discover_services', hosts)
+
+        jobs = [(host, asyncio.ensure_future(self._run(
+            omdclient._discoverTimedSteps(host, arghash, journal))))
+            for host in hosts]
+        try:
+            for host, job in jobs:
+                value, result, seconds = await job
+                yield host, value, result, seconds
+        finally:
+            for host, job in jobs: job.cancel()
+
+    ## Multisite/Nagios ####################################################
+
+    async def nagiosAck(self, params=None):
+        return await self._run(omdclient._nagiosActionSteps('ack',
+            params or self.arghash))
+
+    async def nagiosDowntime(self, params=None):
+        return await self._run(omdclient._nagiosActionSteps('downtime',
+            params or self.arghash))
+
+    async def nagiosCommand(self, action, params=None):
+        return await self._run(omdclient._nagiosCommandSteps(action,
+            params or self.arghash))
+
+    async def nagiosTargets(self, type, filters, argdict=None,
+            problems=False):
+        return await self._run(omdclient._nagiosTargetsSteps(type, filters,
+            argdict or self.arghash, problems))
+
+    async def nagiosBulkCommand(self, action, targets, params=None):
+        return await self._run(omdclient._nagiosBulkCommandSteps(action,
+            targets, params or self.arghash))
+
+    async def nagiosReport(self, type, argdict=None, filters=None):
+        return await self._run(omdclient._nagiosReportSteps(type,
+            argdict or self.arghash, filters))
+
+    async def iterNagiosReport(self, type, argdict=None, header=False,
+            filters=None):
+        """
+        An async generator, otherwise the same as
+        omdclient.iterNagiosReport().  The response is read in full, and
+        then parsed 'report_batch' rows at a time in a worker thread.
+        """
+        rows = await self._run(omdclient._reportRowsSteps(type,
+            argdict or self.arghash, header, filters))
+        while True:
+            batch = await asyncio.to_thread(_take, rows, report_batch)
+            if not batch: return
+            for row in batch: yield row
+
+    async def nagiosAlertReport(self, argdict=None, strict=False):
+        return await self._run(omdclient._nagiosAlertReportSteps(
+            argdict or self.arghash, strict))
+
+    ## Sites ###############################################################
+
+    async def fanOut(self, func, sites, timeout=None):
+        """
+        An async generator, otherwise the same as omdclient.fanOut():
+        await func(argdict) for each of the sites from omdclient.siteArgs()
+        at once, and yield (site, ok, result) as each one finishes.  Sites
+        that haven't answered after 'timeout' seconds are cancelled, and
+        yielded last with a 'timed out' error.
+        """
+        if timeout is None:
+            timeout = omdclient.config.get('site_timeout',
+                omdclient.site_timeout_default)
+        timeout = float(timeout)
+
+        async def run(name):
+            try:
+                return name, True, await func(sites[name])
+            except Exception as e:
+                return name, False, '%s' % e
+
+        jobs = [asyncio.ensure_future(run(name)) for name in sites]
+        waiting = set(sites)
+        try:
+            for job in asyncio.as_completed(jobs, timeout=timeout):
+                try:
+                    name, ok, result = await job
+                except asyncio.TimeoutError:
+                    break
+                waiting.discard(name)
+                yield name, ok, result
+        finally:
+            for job in jobs: job.cancel()
+
+        for name in sites:
+            if name in waiting:
+                yield name, False, 'timed out after %g seconds' % timeout
+
+    async def _fanOutAll(self, steps, sites, timeout=None):
+        """
+        Run fanOut() to the end, with the step generators from
+        steps(argdict); see omdclient._fanOutAll().
+        """
+        results, failed = {}, {}
+        async for name, ok, result in self.fanOut(
+                lambda args: self._run(steps(args)), sites, timeout):
+            if ok: results[name] = result
+            else:  failed[name] = result
+        return dict((name, results[name]) for name in sites
+            if name in results), failed
+
+    async def listHostsSites(self, sites, timeout=None):
+        results, failed = await self._fanOutAll(omdclient._siteHostsSteps,
+            sites, timeout)
+        return omdclient._siteHosts(results), failed
+
+    async def nagiosReportSites(self, type, sites, filters=None,
+            timeout=None):
+        results, failed = await self._fanOutAll(
+            lambda args: omdclient._siteRowsSteps(type, args, filters), sites,
+            timeout)
+        return omdclient._siteRows(results), failed
+
+    async def nagiosAlertReportSites(self, sites, timeout=None):
+        results, failed = await self._fanOutAll(
+            lambda args: omdclient._nagiosAlertReportSteps(args, strict=True),
+            sites, timeout)
+        return omdclient._siteAlertReport(results), failed
+
+def _take(rows, count):
+    return list(itertools.islice(rows, count))
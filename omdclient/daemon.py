@@ -0,0 +1,276 @@
+"""
+omdclientd, the resident omdclient server.  Usage (see usr/bin/omdclientd):
+
+    import omdclient, omdclient.daemon
+
+    omdclient.loadCfg(config_file)
+    daemon = omdclient.daemon.Daemon(omdclient.daemonSocket())
+    daemon.serve_forever()
+
+The daemon listens on a Unix socket, and makes requests for the omdclient
+scripts over its own connection pool (see omdclient.Session), so the
+connections to the servers stay open between runs of the scripts.  It
+also hands out parsed configuration files, and (if 'cache_ttl' is set)
+keeps the get_all_hosts results in memory.  See the "Daemon Client"
+section of omdclient for the protocol.
+
+Only clients running as the same user as the daemon (or root) are
+served.
+"""
+
+#########################################################################
+### Declarations ########################################################
+#########################################################################
+
+import json, os, socket, socketserver, struct, sys, threading, time, \
+    urllib.parse, omdclient
+
+#########################################################################
+### Configuration #######################################################
+#########################################################################
+
+## How much of the body to pass along at a time.
+chunk_size = 65536
+
+## WATO actions that change the host list, and so clear the host cache
+## for that site.
+host_write_actions = ('add_host', 'add_hosts', 'edit_host', 'edit_hosts',
+    'delete_host', 'delete_hosts')
+
+#########################################################################
+### Daemon ##############################################################
+#########################################################################
+
+class Handler(socketserver.StreamRequestHandler):
+    """
+    Handles one request from a client (see omdclient.DaemonClient).
+    """
+    def handle(self):
+        if not self.server.allowed(self.request):
+            self.answer({'error': 'omdclientd: permission denied'})
+            return
+        try:
+            message = json.loads(self.rfile.readline().decode())
+        except ValueError:
+            return
+
+        try:
+            op = message.get('op', None)
+            if op == 'request':  self.server.proxy(self, message)
+            elif op == 'config': self.answer(self.server.config(message))
+            elif op == 'stats':  self.answer(self.server.statistics())
+            else: self.answer({'error': 'omdclientd: unknown op %s' % op})
+        except OSError:
+            ## the client went away
+            pass
+
+    def answer(self, message):
+        """
+        Send a JSON line back to the client.
+        """
+        self.wfile.write(json.dumps(message).encode() + b'\n')
+
+    def chunk(self, data):
+        """
+        Send a chunk of the body; an empty chunk ends it.
+        """
+        self.wfile.write(b'%x\n' % len(data) + data)
+
+class Daemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    The server.  'path' is the socket to listen on; it's created with
+    mode 0600 (and its directory with 0700, if it doesn't exist).  Raises
+    an Exception if another daemon is already listening there.
+
+    'cache_ttl' is how long to keep the get_all_hosts results, in
+    seconds (default: the 'cache_ttl' setting from config.yaml; 0 turns
+    the cache off).  Any add/edit/delete through the daemon clears the
+    cache for that site.  If 'verbose' is set, we log every request to
+    STDERR.
+    """
+    daemon_threads = True
+
+    def __init__(self, path, cache_ttl=None, verbose=False):
+        if cache_ttl is None:
+            cache_ttl = omdclient.config.get('cache_ttl', 0)
+        self.path = path
+        self.cache_ttl = float(cache_ttl)
+        self.verbose = verbose
+        self.stats = {'started': time.time(), 'requests': 0, 'errors': 0,
+            'cache_hits': 0, 'configs': 0}
+        self._cache = {}
+        self._configs = {}
+        self._lock = threading.Lock()
+
+        ## we are the daemon; don't send our own requests to ourselves
+        omdclient.disableDaemon()
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+                raise Exception('already running on %s' % path)
+            except OSError:
+                os.unlink(path)
+            finally:
+                probe.close()
+
+        umask = os.umask(0o077)
+        try:
+            socketserver.UnixStreamServer.__init__(self, path, Handler)
+        finally:
+            os.umask(umask)
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def allowed(self, sock):
+        """
+        Is the client on this socket running as our user (or root)?  We
+        can only tell on Linux; elsewhere, the socket permissions have to
+        do.
+        """
+        if not hasattr(socket, 'SO_PEERCRED'): return True
+        creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+            struct.calcsize('3i'))
+        pid, uid, gid = struct.unpack('3i', creds)
+        return uid in (0, os.getuid())
+
+    def log(self, text):
+        if self.verbose:
+            sys.stderr.write("%s %s\n" % (time.strftime('%Y-%m-%d %H:%M:%S'),
+                text))
+            sys.stderr.flush()
+
+    def count(self, key):
+        with self._lock: self.stats[key] += 1
+
+    ## Requests #############################################################
+
+    def proxy(self, handler, message):
+        """
+        Make a request for a client, and stream the body back to it.
+        """
+        url, body = message['url'], message.get('body', '')
+        parts = urllib.parse.urlsplit(url)
+        site = (parts.netloc, parts.path)
+        action = urllib.parse.parse_qs(parts.query).get('action', [None])[0]
+        if action is None:
+            action = 'view:%s' % urllib.parse.parse_qs(parts.query).get(
+                'view_name', [''])[0]
+        self.count('requests')
+        start = time.time()
+
+        if action in host_write_actions:
+            with self._lock:
+                for key in [key for key in self._cache if key[0] == site]:
+                    del self._cache[key]
+
+        key = None
+        if action == 'get_all_hosts' and message.get('cache', False) \
+                and self.cache_ttl > 0:
+            key = (site, parts.query, body)
+            with self._lock: cached = self._cache.get(key, None)
+            if cached is not None and time.time() - cached[0] \
+                    < self.cache_ttl:
+                self.count('cache_hits')
+                handler.answer({'status': 200, 'cached': True,
+                    'started': cached[0]})
+                for i in range(0, len(cached[1]), chunk_size):
+                    handler.chunk(cached[1][i:i + chunk_size])
+                handler.chunk(b'')
+                handler.answer(cached[2])
+                self.log("%s %s cached" % (parts.netloc, action))
+                return
+
+        try:
+            response = omdclient.getSession().request(url, body)
+        except Exception as e:
+            self.count('errors')
+            handler.answer({'error': '%s' % e})
+            self.log("%s %s error: %s" % (parts.netloc, action, e))
+            return
+
+        handler.answer({'status': response.status})
+        saved = []
+        trailer = {}
+        try:
+            while True:
+                data = response.read(chunk_size)
+                if not data: break
+                if key is not None: saved.append(data)
+                handler.chunk(data)
+        except OSError:
+            ## the client went away; don't put the connection back
+            response.close()
+            raise
+        except Exception as e:
+            self.count('errors')
+            trailer['error'] = '%s' % e
+            key = None
+
+        trailer['raw_bytes'] = response.raw_bytes
+        if response.encoding: trailer['encoding'] = response.encoding
+        handler.chunk(b'')
+        handler.answer(trailer)
+
+        if key is not None:
+            with self._lock:
+                self._cache[key] = (start, b''.join(saved), trailer)
+        self.log("%s %s %d %d bytes %.1f ms" % (parts.netloc, action,
+            response.status, response.decoded_bytes,
+            1000 * (time.time() - start)))
+
+    ## Configuration ########################################################
+
+    def config(self, message):
+        """
+        Returns the parsed configuration file that a client asked for, as
+        an answer for the client.  Files are re-read when they change.
+        """
+        import yaml
+
+        filename = message.get('file', '')
+        try:
+            stat = os.stat(filename)
+            key = (filename, stat.st_mtime, stat.st_size)
+            with self._lock: cfg = self._configs.get(filename, None)
+            if cfg is None or cfg[0] != key:
+                with open(filename, 'r') as fh:
+                    cfg = (key, yaml.safe_load(fh))
+                with self._lock: self._configs[filename] = cfg
+                self.count('configs')
+        except Exception as e:
+            return {'error': '%s' % e}
+        return {'config': cfg[1]}
+
+    def statistics(self):
+        """
+        Returns our counters, for 'omdclientd --status'.
+        """
+        with self._lock:
+            stats = dict(self.stats)
+            stats['cached_host_lists'] = len(self._cache)
+            stats['configs_loaded'] = len(self._configs)
+        stats['uptime'] = time.time() - stats.pop('started')
+        stats['pid'] = os.getpid()
+        stats['socket'] = self.path
+        return stats
+
+def status(path):
+    """
+    Ask the daemon on the given socket for its counters (see
+    Daemon.statistics()).  Returns None if it isn't running.
+    """
+    result = omdclient.DaemonClient(path).call({'op': 'stats'}, 10)
+    if result is None: return None
+    sock, fh, answer = result
+    sock.close()
+    return answer
@@ -0,0 +1,407 @@
+"""
+A local SQLite copy of the host inventory and the current problems, for
+reports that don't need to ask the server.  Usage:
+
+    import omdclient, omdclient.snapshot
+
+    snapshot = omdclient.snapshot.Snapshot(
+        omdclient.snapshot.snapshotFile(argdict), create=True)
+    snapshot.sync(argdict)
+
+    report = snapshot.alertReport(tags={'role': 'db'})
+
+Every sync replaces the contents with what the server has now, but only
+writes what changed: hosts whose settings are the same are left alone,
+and problems that are still open keep the time they were first seen.
+The file is in WAL mode and each sync is one transaction, so readers
+always see a complete snapshot, even in the middle of a sync.
+
+The rows that come back are the same row objects that the live reports
+return (see omdclient.reportRowClass()), so the report scripts can print
+them the same way.
+"""
+
+#########################################################################
+### Declarations ########################################################
+#########################################################################
+
+import json, os, re, sqlite3, time, omdclient
+
+#########################################################################
+### Configuration #######################################################
+#########################################################################
+
+## Bump this when the tables change; older files are rebuilt on sync.
+schema_version = 1
+
+schema = '''
+    CREATE TABLE IF NOT EXISTS meta (
+        key         TEXT PRIMARY KEY,
+        value       TEXT
+    );
+    CREATE TABLE IF NOT EXISTS hosts (
+        host        TEXT PRIMARY KEY,
+        folder      TEXT NOT NULL,
+        site        TEXT NOT NULL,
+        data        TEXT NOT NULL,
+        changed     REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS hosts_folder ON hosts (folder);
+    CREATE INDEX IF NOT EXISTS hosts_site ON hosts (site);
+    CREATE TABLE IF NOT EXISTS host_tags (
+        host        TEXT NOT NULL,
+        tag         TEXT NOT NULL,
+        value       TEXT NOT NULL,
+        PRIMARY KEY (host, tag)
+    );
+    CREATE INDEX IF NOT EXISTS host_tags_value ON host_tags (tag, value);
+    CREATE TABLE IF NOT EXISTS problems (
+        kind        TEXT NOT NULL,
+        host        TEXT NOT NULL,
+        service     TEXT NOT NULL,
+        seq         INTEGER NOT NULL,
+        ack         INTEGER NOT NULL,
+        state       TEXT NOT NULL,
+        position    INTEGER NOT NULL,
+        fields      TEXT NOT NULL,
+        first_seen  REAL NOT NULL,
+        seen        INTEGER NOT NULL,
+        PRIMARY KEY (kind, host, service, seq)
+    );
+    CREATE INDEX IF NOT EXISTS problems_host ON problems (host);
+    CREATE INDEX IF NOT EXISTS problems_ack ON problems (kind, ack, position);
+    CREATE TABLE IF NOT EXISTS report_columns (
+        report      TEXT PRIMARY KEY,
+        columns     TEXT NOT NULL
+    );
+'''
+
+## The nagiosAlertReport() reports, as (kind, ack).
+report_kinds = {
+    'host_ack':   ('host', 1),
+    'host_unack': ('host', 0),
+    'svc_ack':    ('svc', 1),
+    'svc_unack':  ('svc', 0),
+}
+
+#########################################################################
+### Subroutines #########################################################
+#########################################################################
+
+def snapshotFile(arghash, filename=None):
+    """
+    Returns the path of the snapshot file: 'filename' if it's set, or
+    'snapshot_file' from config.yaml, or one per server/site in
+    'cache_dir'.
+    """
+    filename = filename or omdclient.config.get('snapshot_file', None)
+    if filename: return os.path.expanduser(filename)
+
+    cache_dir = os.path.expanduser(omdclient.config.get('cache_dir',
+        omdclient.cache_dir_default))
+    name = re.sub('[^A-Za-z0-9.-]', '_',
+        'snapshot-%s-%s' % (arghash['server'], arghash['site']))
+    return os.path.join(cache_dir, '%s.sqlite' % name)
+
+def _regexp(pattern, value):
+    """
+    The SQLite REGEXP function, matching the same way as Multisite (and
+    reportFilter()).
+    """
+    return _compile(pattern).search(value) is not None
+
+def _compile(pattern, cache={}):
+    if pattern not in cache:
+        cache[pattern] = re.compile(pattern, re.IGNORECASE)
+    return cache[pattern]
+
+def _dumps(data):
+    return json.dumps(data, sort_keys=True, separators=(',', ':'))
+
+#########################################################################
+### Snapshot ############################################################
+#########################################################################
+
+class Snapshot(object):
+    """
+    A snapshot file.  Unless 'create' is set, the file has to exist
+    already (raises an Exception otherwise).
+    """
+    def __init__(self, filename, create=False):
+        if not create and not os.path.exists(filename):
+            raise Exception('no snapshot at %s (see omd-snapshot-sync)'
+                % filename)
+        if create:
+            directory = os.path.dirname(filename)
+            if directory: os.makedirs(directory, mode=0o700, exist_ok=True)
+        self.filename = filename
+        self.db = sqlite3.connect(filename, timeout=30)
+        self.db.create_function('regexp', 2, _regexp)
+
+        if create:
+            if self.db.execute('PRAGMA user_version').fetchone()[0] \
+                    not in (0, schema_version):
+                self._drop()
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.executescript(schema)
+            self.db.execute('PRAGMA user_version=%d' % schema_version)
+            self.db.commit()
+        elif self.db.execute('PRAGMA user_version').fetchone()[0] \
+                != schema_version:
+            raise Exception('snapshot %s is from another version, please '
+                're-sync it' % filename)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _drop(self):
+        for table in ('meta', 'hosts', 'host_tags', 'problems',
+                'report_columns'):
+            self.db.execute('DROP TABLE IF EXISTS %s' % table)
+
+    def meta(self):
+        """
+        Returns the dictionary of settings stored with the snapshot:
+        'server' and 'site', and 'hosts_synced' and 'problems_synced'
+        (epoch seconds), if those parts have been synced.
+        """
+        meta = dict(self.db.execute('SELECT key, value FROM meta'))
+        for key in ('hosts_synced', 'problems_synced'):
+            if key in meta: meta[key] = float(meta[key])
+        return meta
+
+    ## Syncing ##############################################################
+
+    def sync(self, argdict, hosts=True, problems=True):
+        """
+        Load the host list (with omdclient.listHosts(), so the host cache
+        applies) and/or the current problems (omdclient.nagiosAlertReport())
+        from the server at once, and bring the snapshot up to date.
+        Raises an Exception if either can't be loaded, without changing
+        the snapshot.
+
+        Returns a dictionary of what changed: for 'hosts', the counts of
+        'added', 'changed', 'removed' and 'total' hosts; for 'problems',
+        of 'new', 'changed', 'cleared' and 'total' problems.
+        """
+        import concurrent.futures
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as pool:
+            if hosts: host_job = pool.submit(omdclient.listHosts, argdict)
+            if problems:
+                problem_job = pool.submit(omdclient.nagiosAlertReport,
+                    argdict, True)
+            if hosts:
+                status, host_list = host_job.result()
+                if not status:
+                    raise Exception('could not load hosts: %s' % host_list)
+            if problems: report = problem_job.result()
+
+        stats = {}
+        with self.db:
+            meta = {'server': argdict['server'], 'site': argdict['site']}
+            if hosts:
+                stats['hosts'] = self._syncHosts(host_list)
+                meta['hosts_synced'] = time.time()
+            if problems:
+                stats['problems'] = self._syncProblems(report)
+                meta['problems_synced'] = time.time()
+            self.db.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                [(key, '%s' % meta[key]) for key in meta])
+        return stats
+
+    def _syncHosts(self, host_list):
+        """
+        Bring the hosts and host_tags tables in line with 'host_list' (from
+        listHosts()), only touching the hosts that changed.
+        """
+        db = self.db
+        now = time.time()
+        current = dict(db.execute('SELECT host, data FROM hosts'))
+
+        added, changed = 0, 0
+        for name in host_list:
+            h = host_list[name] or {}
+            data = _dumps(h)
+            old = current.pop(name, None)
+            if old == data: continue
+            if old is None: added += 1
+            else:           changed += 1
+
+            attributes = h.get('attributes', {}) or {}
+            db.execute('INSERT OR REPLACE INTO hosts VALUES (?, ?, ?, ?, ?)',
+                (name, h.get('path', ''), attributes.get('site', ''), data,
+                now))
+            db.execute('DELETE FROM host_tags WHERE host = ?', (name,))
+            db.executemany('INSERT INTO host_tags VALUES (?, ?, ?)',
+                [(name, key, '%s' % attributes[key]) for key in attributes
+                    if key.startswith('tag_')])
+
+        ## whatever is left in 'current' is gone from the server
+        removed = [(name,) for name in current]
+        db.executemany('DELETE FROM hosts WHERE host = ?', removed)
+        db.executemany('DELETE FROM host_tags WHERE host = ?', removed)
+
+        return {'added': added, 'changed': changed, 'removed': len(removed),
+            'total': len(host_list)}
+
+    def _syncProblems(self, report):
+        """
+        Bring the problems table in line with 'report' (from
+        nagiosAlertReport()).  Problems that are still open keep their
+        'first_seen' time; the rest of each row is only re-written if it
+        changed.  Only changes of state or acknowledgement are counted as
+        'changed'.
+
+        Problems are keyed by host and service; 'seq' tells apart the
+        (normally impossible) rows that the server lists more than once.
+        """
+        db = self.db
+        now = time.time()
+        seen = (db.execute('SELECT MAX(seen) FROM problems').fetchone()[0]
+            or 0) + 1
+        current = dict(((kind, host, service, seq), (ack, state, fields))
+            for kind, host, service, seq, ack, state, fields in db.execute(
+                'SELECT kind, host, service, seq, ack, state, fields '
+                'FROM problems'))
+
+        new, updated, moved = [], [], []
+        changed = 0
+        seqs = {}
+        for name in report:
+            kind, ack = report_kinds[name]
+            if report[name]:
+                db.execute('INSERT OR REPLACE INTO report_columns '
+                    'VALUES (?, ?)', (name,
+                    json.dumps(report[name][0]._header)))
+            for position, row in enumerate(report[name]):
+                if kind == 'host':
+                    service = ''
+                    state = row.get('host_state', '')
+                else:
+                    service = row.get('service_description', '')
+                    state = row.get('service_state', '')
+                key = (kind, row.get('host', ''), '%s' % service)
+                seq = seqs[key] = seqs.get(key, -1) + 1
+                key = key + (seq,)
+                state = '%s' % state
+                fields = json.dumps(list(row))
+                old = current.get(key, None)
+                if old is None:
+                    new.append(key + (ack, state, position, fields, now,
+                        seen))
+                elif old[2] != fields or old[0] != ack:
+                    if old[:2] != (ack, state): changed += 1
+                    updated.append((ack, state, position, fields, seen)
+                        + key)
+                else:
+                    moved.append((position, seen) + key)
+
+        db.executemany('INSERT OR REPLACE INTO problems VALUES '
+            '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', new)
+        db.executemany('UPDATE problems SET ack = ?, state = ?, '
+            'position = ?, fields = ?, seen = ? WHERE kind = ? AND host = ? '
+            'AND service = ? AND seq = ?', updated)
+        db.executemany('UPDATE problems SET position = ?, seen = ? '
+            'WHERE kind = ? AND host = ? AND service = ? AND seq = ?', moved)
+        cleared = db.execute('DELETE FROM problems WHERE seen < ?',
+            (seen,)).rowcount
+
+        return {'new': len(new), 'changed': changed, 'cleared': cleared,
+            'total': len(new) + len(updated) + len(moved)}
+
+    ## Queries ##############################################################
+
+    def _hostFilter(self, folder=None, site=None, tags=None, column='host'):
+        """
+        Build the SQL (and its parameters) that limits 'column' to the
+        hosts with the given folder, site and tags, the same way that
+        HostInventory.query() does.
+        """
+        where, args = [], []
+        if folder is not None:
+            where.append('%s IN (SELECT host FROM hosts WHERE folder = ?)'
+                % column)
+            args.append(folder)
+        if site is not None:
+            where.append('%s IN (SELECT host FROM hosts WHERE site = ?)'
+                % column)
+            args.append(site)
+        for key in (tags or {}):
+            if not key.startswith('tag_'): field = 'tag_%s' % key
+            else:                          field = key
+            where.append('%s IN (SELECT host FROM host_tags WHERE tag = ? '
+                'AND value = ?)' % column)
+            args.extend([field, tags[key]])
+        return where, args
+
+    def queryHosts(self, folder=None, site=None, tags=None):
+        """
+        Find the hosts matching all of the given settings; works like
+        HostInventory.query().  Returns a sorted list of hostnames.
+        """
+        where, args = self._hostFilter(folder, site, tags)
+        sql = 'SELECT host FROM hosts'
+        if where: sql += ' WHERE %s' % ' AND '.join(where)
+        return [host for host, in self.db.execute(sql + ' ORDER BY host',
+            args)]
+
+    def _rows(self, where, args, order):
+        """
+        Load problems as report rows; returns a dictionary of report name
+        (see report_kinds) to lists of rows.
+        """
+        columns = dict((name, omdclient.reportRowClass(json.loads(value)))
+            for name, value in self.db.execute(
+                'SELECT report, columns FROM report_columns'))
+        names = dict((report_kinds[name], name) for name in report_kinds)
+
+        sql = 'SELECT kind, ack, fields FROM problems'
+        if where: sql += ' WHERE %s' % ' AND '.join(where)
+        report = dict((name, []) for name in report_kinds)
+        for kind, ack, fields in self.db.execute(sql + ' ORDER BY ' + order,
+                args):
+            name = names[(kind, ack)]
+            report[name].append(columns[name]._make(json.loads(fields)))
+        return report
+
+    def alertReport(self, folder=None, site=None, tags=None):
+        """
+        The snapshot version of omdclient.nagiosAlertReport(), for only
+        the hosts matching the given settings (see queryHosts()).  The rows
+        come back in the order the server sent them.
+        """
+        where, args = self._hostFilter(folder, site, tags)
+        return self._rows(where, args, 'kind, ack, position')
+
+    def problems(self, kind, filters=None, folder=None, site=None,
+            tags=None):
+        """
+        All of the host ('host') or service ('svc') problems, acknowledged
+        or not, sorted by host and service.  'filters' is checked the same
+        way as with nagiosReport() (see reportFilter()); the regular
+        expressions are checked in the database, so that we only have to
+        load the rows that match.
+        """
+        where, args = self._hostFilter(folder, site, tags)
+        where.insert(0, 'kind = ?')
+        args.insert(0, kind)
+        for key, column in (('host_regex', 'host'),
+                ('service_regex', 'service')):
+            if (filters or {}).get(key):
+                where.append('%s REGEXP ?' % column)
+                args.append(filters[key])
+        report = self._rows(where, args, 'host, service')
+        rows = report['%s_ack' % kind] + report['%s_unack' % kind]
+        rows.sort(key=lambda row: (row.get('host', ''),
+            '%s' % row.get('service_description', '')))
+
+        match = filters and omdclient.reportFilter(filters)
+        if match: rows = [row for row in rows if match(row)]
+        return rows
@@ -14,7 +14,7 @@ with open('omdclient.spec', 'r') as fh:
             break
 
 ## get list of files to install
-pyfiles = glob.glob(os.path.join('*', '*.py'))
+pyfiles = glob.glob(os.path.join('omdclient', '*.py'))
 pyfiles = [pyfile[:-3] for pyfile in pyfiles]
 
 scripts = glob.glob(os.path.join('usr/bin/*'))
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+"""
+Benchmark the omdclient library and the omd-* scripts against the mock
+Check_MK server in t/mockserver.py.  For each benchmark, reports the
+throughput, the latency percentiles and the peak RSS of the process.
+"""
+
+#########################################################################
+### Declarations ########################################################
+#########################################################################
+
+import json, optparse, os, resource, shutil, subprocess, sys, tempfile, time
+
+#########################################################################
+### Configuration #######################################################
+#########################################################################
+
+## Text for --help
+text = "Benchmark omdclient against a mock Check_MK server"
+usage_text = "usage: %prog [options] [BENCHMARK [BENCHMARK...]]"
+
+## Where everything lives.
+test_dir = os.path.dirname(os.path.abspath(__file__))
+base_dir = os.path.dirname(test_dir)
+bin_dir = os.path.join(base_dir, 'usr', 'bin')
+
+## A host that always exists on the mock server (see t/mockserver.py).
+known_host = 'host000001.example.com'
+
+#########################################################################
+### Library Benchmarks ##################################################
+#########################################################################
+## Each of these is run in a fresh process (so that the peak RSS belongs
+## to that benchmark alone), 'iterations' times.  setup() runs untimed
+## before each iteration, and returns the argument for run().
+
+def _hosts(prefix, count, iteration):
+    return ['%s-%d-%d-%04d.example.com' % (prefix, os.getpid(), iteration, i)
+        for i in range(count)]
+
+def _createSetup(argdict, iteration):
+    hosts = _hosts('bench', 100, iteration)
+    omdclient.createHosts(hosts, argdict)
+    return hosts
+
+def _updateRun(argdict, hosts):
+    settings = dict((host, {'role': 'bench%d' % time.time()})
+        for host in hosts)
+    return omdclient.updateHosts(settings, argdict)
+
+library = {
+    'listHosts': (None,
+        lambda argdict, x: omdclient.listHosts(argdict)),
+    'hostInventory': (None,
+        lambda argdict, x: omdclient.hostInventory(argdict)[1].query(
+            folder='linux/web', tags={'role': 'apache'})),
+    'readHost': (None,
+        lambda argdict, x: omdclient.readHost(known_host, argdict)),
+    'createHosts(100)': (
+        lambda argdict, i: _hosts('bench', 100, i),
+        lambda argdict, hosts: omdclient.createHosts(hosts, argdict)),
+    'updateHosts(100)': (_createSetup, _updateRun),
+    'deleteHosts(100)': (_createSetup,
+        lambda argdict, hosts: omdclient.deleteHosts(hosts, argdict)),
+    'discoverServicesHosts(32)': (None,
+        lambda argdict, x: list(omdclient.discoverServicesHosts(
+            ['host%06d.example.com' % i for i in range(32)], argdict))),
+    'nagiosReport(svc_unack)': (None,
+        lambda argdict, x: omdclient.nagiosReport('svc_unack', argdict)),
+    'iterNagiosReport(hostservice)': (None,
+        lambda argdict, x: sum(1 for row in
+            omdclient.iterNagiosReport('hostservice', argdict))),
+    'nagiosAlertReport': (None,
+        lambda argdict, x: omdclient.nagiosAlertReport(argdict)),
+    'nagiosAck': (None,
+        lambda argdict, x: omdclient.nagiosAck(dict(argdict, type='host',
+            host=known_host, comment='bench'))),
+}
+
+def runLibrary(name, iterations):
+    """
+    Run a library benchmark in this process, and print the results as
+    JSON for the parent process.
+    """
+    global omdclient
+    import omdclient
+
+    omdclient.loadCfg(os.environ['OMDCONFIG'])
+    argdict = {'server': omdclient.config['server'],
+        'site': omdclient.config['site'], 'user': omdclient.config['user'],
+        'apikey': omdclient.config['apikey'], 'debug': False}
+
+    setup, run = library[name]
+    times = []
+    for i in range(iterations):
+        arg = None
+        if setup: arg = setup(argdict, i)
+        start = time.time()
+        run(argdict, arg)
+        times.append(time.time() - start)
+
+    print(json.dumps({'times': times, 'maxrss': maxRss(
+        resource.getrusage(resource.RUSAGE_SELF))}))
+
+#########################################################################
+### Script Benchmarks ###################################################
+#########################################################################
+## Each of these is a command line (relative to usr/bin) and the text to
+## offer it on STDIN.
+
+scripts = {
+    'omd-nagios-hostlist': (['omd-nagios-hostlist'], None),
+    'omd-nagios-hostlist --folder --tag': (['omd-nagios-hostlist',
+        '--folder', 'linux/web', '--tag', 'role=apache'], None),
+    'omd-host-crud read': (['omd-host-crud', 'read', known_host], None),
+    'omd-reinventory (16)': (['omd-reinventory'],
+        ''.join('host%06d.example.com\n' % i for i in range(16))),
+    'omd-bulkimport --noop (200)': (['omd-bulkimport', '--noop',
+        '--no_check_dns', 'linux/web'],
+        ''.join('host%06d.example.com\n' % i for i in range(200))),
+    'omd-nagios-count': (['omd-nagios-count'], None),
+    'omd-nagios-report': (['omd-nagios-report'], None),
+    'omd-nagios-hosts-with-problem': (['omd-nagios-hosts-with-problem',
+        'CPU load'], None),
+    'omd-host-report': (['omd-host-report', 'CPU load'], None),
+}
+
+def runScript(name, iterations, env):
+    """
+    Run a script benchmark.  Returns the list of times and the peak RSS
+    (in bytes).
+    """
+    cmd, stdin = scripts[name]
+    cmd = [sys.executable, os.path.join(bin_dir, cmd[0])] + cmd[1:]
+
+    times = []
+    maxrss = 0
+    for i in range(iterations):
+        with tempfile.TemporaryFile() as input:
+            if stdin: input.write(stdin.encode())
+            input.seek(0)
+            start = time.time()
+            proc = subprocess.Popen(cmd, env=env, stdin=input,
+                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            stderr = proc.stderr.read()
+            pid, status, usage = os.wait4(proc.pid, 0)
+            times.append(time.time() - start)
+            proc.returncode = status
+        if os.WIFSIGNALED(status) or stderr:
+            raise Exception('%s failed: %s' % (name, stderr.decode()))
+        maxrss = max(maxrss, maxRss(usage))
+    return times, maxrss
+
+#########################################################################
+### Subroutines #########################################################
+#########################################################################
+
+def maxRss(usage):
+    """
+    Convert ru_maxrss to bytes; it's in kilobytes on Linux, but bytes on
+    MacOS.
+    """
+    if sys.platform == 'darwin': return usage.ru_maxrss
+    return usage.ru_maxrss * 1024
+
+def percentile(times, pct):
+    """
+    Nearest-rank percentile of a list of times.
+    """
+    ordered = sorted(times)
+    rank = max(int(round(pct / 100.0 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+def summarize(name, times, maxrss):
+    """
+    Turn a list of times into the numbers we report.
+    """
+    total = sum(times)
+    return {
+        'name':       name,
+        'iterations': len(times),
+        'per_second': total and len(times) / total or 0,
+        'p50_ms':     percentile(times, 50) * 1000,
+        'p95_ms':     percentile(times, 95) * 1000,
+        'p99_ms':     percentile(times, 99) * 1000,
+        'maxrss_mb':  maxrss / 1048576.0,
+    }
+
+def startServer(opt):
+    """
+    Start t/mockserver.py with our inventory settings; returns the process
+    and the host:port it is listening on.
+    """
+    cmd = [sys.executable, os.path.join(test_dir, 'mockserver.py'),
+        '--hosts', str(opt.hosts), '--problems', str(opt.problems),
+        '--host_problems', str(opt.host_problems),
+        '--latency', str(opt.latency),
+        '--discover_latency', str(opt.discover_latency)]
+    if opt.compress: cmd.append('--compress')
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    line = proc.stdout.readline().decode().strip()
+    if not line.startswith('listening on http://'):
+        proc.kill()
+        raise Exception('mock server failed to start')
+    return proc, line.split('//', 1)[1]
+
+def writeConfig(dir, server, opt):
+    """
+    Write a config.yaml pointing at the mock server.
+    """
+    filename = os.path.join(dir, 'config.yaml')
+    with open(filename, 'w') as f:
+        f.write("server: '%s'\n" % server)
+        f.write("site: 'mock'\n")
+        f.write("user: 'automation'\n")
+        f.write("apikey: 'secret'\n")
+        f.write("scheme: 'http'\n")
+        f.write("workers: %d\n" % opt.workers)
+        f.write("cache_ttl: %d\n" % opt.cache_ttl)
+        f.write("cache_dir: '%s'\n" % os.path.join(dir, 'cache'))
+    return filename
+
+#########################################################################
+### main () #############################################################
+#########################################################################
+
+def main():
+    p = optparse.OptionParser(usage=usage_text, description=text)
+    p.add_option('--server', dest='server', default=None,
+        help='use an already-running mock server at HOST:PORT')
+    p.add_option('--hosts', dest='hosts', type='int', default=50000,
+        help='hosts on the mock server (default: %default)')
+    p.add_option('--problems', dest='problems', type='int', default=500000,
+        help='service problems on the mock server (default: %default)')
+    p.add_option('--host_problems', dest='host_problems', type='int',
+        default=500, help='host problems on the mock server (default: %default)')
+    p.add_option('--latency', dest='latency', type='float', default=0.0,
+        help='mock server latency per request (default: %default)')
+    p.add_option('--discover_latency', dest='discover_latency',
+        type='float', default=0.1,
+        help='mock server latency per discovery (default: %default)')
+    p.add_option('--compress', dest='compress', action='store_true',
+        default=False, help='have the mock server compress its responses')
+    p.add_option('--iterations', dest='iterations', type='int', default=5,
+        help='runs per benchmark (default: %default)')
+    p.add_option('--workers', dest='workers', type='int', default=8,
+        help="'workers' setting for the client (default: %default)")
+    p.add_option('--cache_ttl', dest='cache_ttl', type='int', default=0,
+        help="'cache_ttl' setting for the client (default: %default)")
+    p.add_option('--json', dest='json', action='store_true', default=False,
+        help='print results as JSON lines')
+    p.add_option('--list', dest='list', action='store_true', default=False,
+        help='list the benchmarks and exit')
+    p.add_option('--child', dest='child', default=None,
+        help=optparse.SUPPRESS_HELP)
+    opt, args = p.parse_args()
+
+    if opt.child:
+        runLibrary(opt.child, opt.iterations)
+        return
+
+    if opt.list:
+        for name in list(library) + list(scripts): print(name)
+        return
+
+    names = args or list(library) + list(scripts)
+    for name in names:
+        if name not in library and name not in scripts:
+            print("unknown benchmark: %s" % name)
+            sys.exit(1)
+
+    proc = None
+    server = opt.server
+    if server is None: proc, server = startServer(opt)
+
+    tmpdir = tempfile.mkdtemp(prefix='omdclient-bench.')
+    env = dict(os.environ)
+    env['OMDCONFIG'] = writeConfig(tmpdir, server, opt)
+    env['PYTHONPATH'] = os.pathsep.join([base_dir] +
+        [i for i in [os.environ.get('PYTHONPATH')] if i])
+
+    format = "%-36s %5s %9s %9s %9s %9s %9s"
+    if not opt.json:
+        print(format % ('benchmark', 'runs', 'ops/s', 'p50 ms', 'p95 ms',
+            'p99 ms', 'rss MB'))
+
+    error = 0
+    try:
+        for name in names:
+            try:
+                if name in library:
+                    output = subprocess.check_output([sys.executable,
+                        os.path.abspath(__file__), '--child', name,
+                        '--iterations', str(opt.iterations)], env=env)
+                    result = json.loads(output.decode().splitlines()[-1])
+                    times, maxrss = result['times'], result['maxrss']
+                else:
+                    times, maxrss = runScript(name, opt.iterations, env)
+            except Exception as e:
+                print("%s: failed: %s" % (name, e))
+                error = 1
+                continue
+
+            stats = summarize(name, times, maxrss)
+            if opt.json:
+                print(json.dumps(stats))
+            else:
+                print(format % (name[:36], stats['iterations'],
+                    '%.2f' % stats['per_second'], '%.1f' % stats['p50_ms'],
+                    '%.1f' % stats['p95_ms'], '%.1f' % stats['p99_ms'],
+                    '%.1f' % stats['maxrss_mb']))
+            sys.stdout.flush()
+    finally:
+        if proc is not None: proc.kill()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    sys.exit(error)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+pytest fixtures: a mock Check_MK server (t/mockserver.py) on a free port,
+and an omdclient configuration that points at it.
+"""
+
+#########################################################################
+### Declarations ########################################################
+#########################################################################
+
+import os, re, subprocess, sys
+
+import pytest
+
+#########################################################################
+### Configuration #######################################################
+#########################################################################
+
+## Where everything lives.
+test_dir = os.path.dirname(os.path.abspath(__file__))
+base_dir = os.path.dirname(test_dir)
+bin_dir = os.path.join(base_dir, 'usr', 'bin')
+
+## Test against this tree, not an installed omdclient.
+sys.path.insert(0, base_dir)
+
+## Keep a running omdclientd (and its host cache) out of the tests.
+os.environ['OMDCLIENT_NO_DAEMON'] = '1'
+
+import omdclient
+
+## A small, fast inventory; discoveries don't wait.
+mock_args = ['--hosts', '50', '--host_problems', '5', '--problems', '100',
+    '--discover_latency', '0']
+
+#########################################################################
+### Fixtures ############################################################
+#########################################################################
+
+@pytest.fixture(scope='session')
+def mockserver():
+    """
+    Start the mock server with --port 0, and return its host:port.
+    """
+    proc = subprocess.Popen([sys.executable,
+        os.path.join(test_dir, 'mockserver.py'), '--port', '0'] + mock_args,
+        stdout=subprocess.PIPE, universal_newlines=True)
+    line = proc.stdout.readline()
+    match = re.search(r'http://([^/\s]+)', line)
+    if not match:
+        proc.kill()
+        raise Exception('mock server did not start: %s' % line)
+    yield match.group(1)
+    proc.terminate()
+    proc.wait()
+
+@pytest.fixture(scope='session')
+def config_file(mockserver, tmp_path_factory):
+    """
+    A config.yaml for the mock server, with the cache and activation
+    files in a temporary directory.
+    """
+    directory = tmp_path_factory.mktemp('omdclient')
+    filename = directory / 'config.yaml'
+    filename.write_text('\n'.join([
+        "server: '%s'" % mockserver,
+        "site: 'mock'",
+        "user: 'automation'",
+        "apikey: 'secret'",
+        "scheme: 'http'",
+        "cache_dir: '%s'" % (directory / 'cache'),
+        "activate_window: 0",
+        '']))
+    return str(filename)
+
+@pytest.fixture
+def argdict(config_file):
+    """
+    Load the mock server's configuration; returns the argument dict that
+    the scripts would build from it.
+    """
+    config = omdclient.loadCfg(config_file)
+    return {'server': config['server'], 'site': config['site'],
+        'user': config['user'], 'apikey': config['apikey'], 'debug': False,
+        'remove': False, 'refresh': True}
+
+@pytest.fixture
+def script(config_file):
+    """
+    Returns a function that runs one of the usr/bin scripts against the
+    mock server: script(name, *args, input=None) -> CompletedProcess.
+    """
+    env = dict(os.environ, OMDCONFIG=config_file, PYTHONPATH=base_dir,
+        PYTHONDONTWRITEBYTECODE='1')
+
+    def run(name, *args, **kwargs):
+        return subprocess.run([sys.executable, os.path.join(bin_dir, name)]
+            + list(args), input=kwargs.get('input', None), env=env,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            universal_newlines=True, timeout=120)
+    return run
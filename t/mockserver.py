@@ -0,0 +1,533 @@
+#!/usr/bin/env python3
+"""
+A stand-in for a Check_MK server, for testing and benchmarking omdclient
+without a real OMD site.  Implements the webapi.py actions used by
+omdclient.generateUrl() and the view.py views and commands used by
+omdclient.generateNagiosUrl(), over a synthetic inventory.
+"""
+
+#########################################################################
+### Declarations ########################################################
+#########################################################################
+
+import gzip, http.server, json, optparse, random, re, socketserver, sys
+import threading, time, urllib.parse, zlib
+
+#########################################################################
+### Configuration #######################################################
+#########################################################################
+
+## Text for --help
+text = "Run a mock Check_MK server with a synthetic inventory"
+usage_text = "usage: %prog [options]"
+
+## What the synthetic hosts look like.
+folders = ['linux/web', 'linux/db', 'linux/batch', 'windows', 'network']
+roles = ['apache', 'mysql', 'worker', 'dc', 'switch']
+instances = ['prod', 'dev', 'itb']
+services = ['CPU load', 'Memory', 'Filesystem /', 'Filesystem /var',
+    'NTP Time', 'Uptime', 'Interface eth0', 'Disk IO SUMMARY',
+    'Check_MK', 'Mount options of /', 'Systemd Service Summary']
+states = ['WARN', 'CRIT', 'UNKN']
+
+## The fields of the expanded views; see README.md.
+host_fields = ['host', 'host_icons', 'host_state', 'host_plugin_output',
+    'num_services_ok', 'num_services_warn', 'num_services_unknown',
+    'num_services_crit', 'num_services_pending', 'host_state_age',
+    'host_comments']
+svc_fields = ['service_state', 'host', 'service_description',
+    'service_icons', 'svc_plugin_output', 'svc_state_age',
+    'svc_check_age', 'perfometer', 'svc_comments']
+
+## The views we know about, and their fields; None for the views that
+## are only used for commands on a single host or service.
+views = {
+    'hostproblems_expanded': host_fields,
+    'svcproblems_expanded':  svc_fields,
+    'searchhost': ['host_state', 'host', 'host_icons'],
+    'searchsvc':  svc_fields[:5],
+    'hoststatus': None,
+    'service':    None,
+}
+
+## Multisite filter variables for the states.
+host_state_vars = {'UP': 'hst0', 'DOWN': 'hst1', 'UNREACH': 'hst2',
+    'PEND': 'hstp'}
+svc_state_vars = {'OK': 'st0', 'WARN': 'st1', 'CRIT': 'st2', 'UNKN': 'st3',
+    'PEND': 'stp'}
+
+## How much of a response to write at a time.
+chunk_size = 65536
+
+#########################################################################
+### Inventory ###########################################################
+#########################################################################
+
+class Inventory(object):
+    """
+    The hosts and current problems that the server knows about.  All
+    access goes through 'lock'; serialized responses are cached until the
+    next change.
+    """
+    def __init__(self, opt):
+        self.opt = opt
+        self.lock = threading.Lock()
+        self.stats = {}
+        self._cache = {}
+        self.added = 0
+        rand = random.Random(opt.seed)
+
+        self.hosts = {}
+        for i in range(opt.hosts):
+            name = hostName(i)
+            self.hosts[name] = {
+                'hostname': name,
+                'path': folders[i % len(folders)],
+                'attributes': {
+                    'tag_role': roles[i % len(roles)],
+                    'tag_instance': instances[i % len(instances)],
+                    'site': 'site%d' % (i % opt.sites + 1),
+                },
+            }
+
+        ## host problems: [row, acknowledged]
+        self.host_problems = []
+        for i in rand.sample(range(opt.hosts), min(opt.host_problems,
+                opt.hosts)):
+            row = [hostName(i), '', 'DOWN', 'CRITICAL - Host Unreachable',
+                '0', '0', '0', '0', '0', '%d min' % rand.randint(1, 999), '']
+            self.host_problems.append([row, rand.random() < opt.ack])
+
+        ## service problems
+        self.svc_problems = []
+        for i in range(opt.problems):
+            host = hostName(rand.randrange(max(opt.hosts, 1)))
+            service = services[i % len(services)]
+            if i >= len(services) * max(opt.hosts, 1):
+                service = '%s %d' % (service, i)
+            state = rand.choice(states)
+            row = [state, host, service, '',
+                '%s - synthetic problem %d' % (state, i),
+                '%d min' % rand.randint(1, 999), '%d sec' % rand.randint(1, 60),
+                '', '']
+            self.svc_problems.append([row, rand.random() < opt.ack])
+
+    def churn(self, count, rand):
+        """
+        Change, clear or add 'count' random service problems.
+        """
+        with self.lock:
+            for i in range(count):
+                action = rand.randrange(3)
+                if action == 0 and self.svc_problems:
+                    row = rand.choice(self.svc_problems)[0]
+                    row[0] = rand.choice([state for state in states
+                        if state != row[0]])
+                    row[4] = '%s - synthetic problem' % row[0]
+                elif action == 1 and self.svc_problems:
+                    self.svc_problems.pop(rand.randrange(len(
+                        self.svc_problems)))
+                else:
+                    self.added += 1
+                    state = rand.choice(states)
+                    row = [state, hostName(rand.randrange(max(self.opt.hosts,
+                        1))), 'Churn %d' % self.added, '',
+                        '%s - synthetic problem' % state, '0 min', '1 sec',
+                        '', '']
+                    self.svc_problems.append([row, False])
+            self.changed()
+
+    def count(self, name):
+        with self.lock:
+            self.stats[name] = self.stats.get(name, 0) + 1
+
+    def cached(self, key, build):
+        """
+        Returns the serialized response for 'key', building it with
+        build() if it isn't cached.
+        """
+        with self.lock:
+            if key not in self._cache: self._cache[key] = build()
+            return self._cache[key]
+
+    def changed(self):
+        """
+        Throw away the cached responses; call with 'lock' held.
+        """
+        self._cache = {}
+
+def churn(inv, count):
+    """
+    Change the service problems once a second, forever.
+    """
+    rand = random.Random(opt.seed)
+    while True:
+        time.sleep(1)
+        inv.churn(count, rand)
+
+def hostName(i):
+    return 'host%06d.example.com' % i
+
+#########################################################################
+### WATO webapi.py ######################################################
+#########################################################################
+
+def webapi(inv, query, request):
+    """
+    Handle a webapi.py action.  Returns the (result_code, result) pair.
+    """
+    action = query.get('action', '')
+    inv.count(action)
+
+    if action == 'get_all_hosts':
+        return None
+
+    elif action == 'get_host':
+        with inv.lock:
+            host = inv.hosts.get(request.get('hostname'))
+            if host is None: return 1, 'Check_MK exception: No such host'
+            return 0, host
+
+    elif action in ('add_host', 'add_hosts'):
+        if action == 'add_host': entries = [request]
+        else:                    entries = request.get('hosts', [])
+        failed = {}
+        with inv.lock:
+            for entry in entries:
+                name = entry.get('hostname')
+                if name in inv.hosts:
+                    failed[name] = 'Host %s already exists.' % name
+                    continue
+                inv.hosts[name] = {
+                    'hostname': name,
+                    'path': entry.get('folder', ''),
+                    'attributes': entry.get('attributes', {}),
+                }
+            inv.changed()
+        return bulkResult(action, failed)
+
+    elif action in ('edit_host', 'edit_hosts'):
+        if action == 'edit_host': entries = [request]
+        else:                     entries = request.get('hosts', [])
+        failed = {}
+        with inv.lock:
+            for entry in entries:
+                name = entry.get('hostname')
+                if name not in inv.hosts:
+                    failed[name] = 'No such host'
+                    continue
+                attributes = inv.hosts[name]['attributes']
+                attributes.update(entry.get('attributes', {}))
+                for key in entry.get('unset_attributes', []):
+                    attributes.pop(key, None)
+            inv.changed()
+        return bulkResult(action, failed)
+
+    elif action in ('delete_host', 'delete_hosts'):
+        if action == 'delete_host': names = [request.get('hostname')]
+        else:                       names = request.get('hostnames', [])
+        failed = {}
+        with inv.lock:
+            for name in names:
+                if inv.hosts.pop(name, None) is None:
+                    failed[name] = 'No such host'
+            inv.changed()
+        return bulkResult(action, failed)
+
+    elif action == 'discover_services':
+        with inv.lock:
+            if request.get('hostname') not in inv.hosts:
+                return 1, 'Check_MK exception: No such host'
+        time.sleep(inv.opt.discover_latency)
+        return 0, 'Service discovery successful. Added 0, Removed 0, ' \
+            'Kept %d, New Count %d' % (len(services), len(services))
+
+    elif action == 'activate_changes':
+        return 0, {'sites': {}}
+
+    return 1, 'Check_MK exception: Unknown API action %s' % action
+
+def bulkResult(action, failed):
+    """
+    Results for the add/edit/delete actions: single-host actions fail
+    outright, bulk actions list the failures.
+    """
+    if not action.endswith('s'):
+        if failed: return 1, 'Check_MK exception: %s' % \
+            list(failed.values())[0]
+        return 0, None
+    if failed: return 0, {'failed_hosts': failed}
+    return 0, None
+
+#########################################################################
+### Multisite view.py ###################################################
+#########################################################################
+
+def view(inv, query):
+    """
+    Handle a view.py request.  Returns a (content type, body) pair.
+    """
+    name = query.get('view_name', '')
+    inv.count('view:%s' % name)
+
+    if name not in views:
+        return 'text/html', ('<html><body><div class="error">Unknown view '
+            '%s</div></body></html>' % name).encode()
+
+    if query.get('_do_actions') == 'yes':
+        return 'text/plain', command(inv, name, query).encode()
+
+    if views[name] is None:
+        return 'text/html', ('<html><body><div class="error">View %s is '
+            'only for commands</div></body></html>' % name).encode()
+
+    key = (name,) + tuple(sorted((k, v) for k, v in query.items()
+        if not k.startswith('_')))
+    return 'application/json', inv.cached(key,
+        lambda: report(inv, name, query))
+
+def viewRows(inv, name):
+    """
+    All of the rows of a view, as (values, host, service, state, problem)
+    tuples; 'problem' is the [row, acknowledged] entry from the inventory
+    (or None for a host without problems).  Call with the lock held.
+    """
+    if name == 'hostproblems_expanded':
+        for problem in inv.host_problems:
+            row = problem[0]
+            yield row, row[0], None, row[2], problem
+    elif name == 'svcproblems_expanded':
+        for problem in inv.svc_problems:
+            row = problem[0]
+            yield row, row[1], row[2], row[0], problem
+    elif name in ('searchhost', 'hoststatus'):
+        problems = dict((problem[0][0], problem)
+            for problem in inv.host_problems)
+        for host in inv.hosts:
+            problem = problems.get(host, None)
+            state = problem and 'DOWN' or 'UP'
+            yield [state, host, ''], host, None, state, problem
+    elif name in ('searchsvc', 'service'):
+        for problem in inv.svc_problems:
+            row = problem[0]
+            yield row[:5], row[1], row[2], row[0], problem
+
+def matches(inv, query, host, service, state, problem):
+    """
+    Does a row pass the view filters in the query?  The exact 'host' and
+    'service' filters, and the acknowledgement filters, are always
+    applied; the others can be turned off with --ignore_filters.  Host
+    groups are named after the hosts' roles.
+    """
+    if 'host' in query and query['host'] != host: return False
+    if 'service' in query and query['service'] != service: return False
+
+    for var in ('is_host_acknowledged', 'is_service_acknowledged'):
+        ack = query.get(var, '-1')
+        if ack != '-1' and int(bool(problem and problem[1])) != int(ack):
+            return False
+
+    if opt.ignore_filters: return True
+
+    if query.get('host_regex') and not re.search(query['host_regex'], host,
+            re.IGNORECASE):
+        return False
+    if service is not None and query.get('service_regex') and \
+            not re.search(query['service_regex'], service, re.IGNORECASE):
+        return False
+    if query.get('opthost_group'):
+        attributes = inv.hosts.get(host, {}).get('attributes', {})
+        if attributes.get('tag_role') != query['opthost_group']:
+            return False
+    if query.get('filled_in'):
+        if service is None: vars = host_state_vars
+        else:               vars = svc_state_vars
+        if query.get(vars.get(state, ''), '') != 'on': return False
+    return True
+
+def report(inv, name, query):
+    """
+    Serialize a view, with its filters applied.  Call with the inventory
+    lock held.
+    """
+    header = list(views[name])
+    ack_column = opt.ack_column and name.endswith('problems_expanded')
+    if ack_column: header.append('acknowledged')
+    rows = [header]
+    for row, host, service, state, problem in viewRows(inv, name):
+        if not matches(inv, query, host, service, state, problem): continue
+        if ack_column: row = row + [problem[1] and 'yes' or 'no']
+        rows.append(row)
+    return json.dumps(rows).encode()
+
+def command(inv, name, query):
+    """
+    Acknowledge or downtime every host or service in a view that passes
+    its filters.
+    """
+    count = 0
+    with inv.lock:
+        for row, host, service, state, problem in viewRows(inv, name):
+            if not matches(inv, query, host, service, state, problem):
+                continue
+            if '_acknowledge' in query and problem is not None:
+                problem[1] = True
+                problem[0][-1] = query.get('_ack_comment', '')
+            count += 1
+        inv.changed()
+    return 'MESSAGE: Successfully sent %d commands.\n' % count
+
+#########################################################################
+### Server ##############################################################
+#########################################################################
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        parts = urllib.parse.urlsplit(self.path)
+        if parts.path == '/stats':
+            with inventory.lock: body = json.dumps(inventory.stats).encode()
+            return self.respond(200, 'application/json', body)
+        self.respond(404, 'text/plain', b'not found\n')
+
+    def do_POST(self):
+        parts = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(parts.query))
+        length = int(self.headers.get('Content-Length', 0))
+        form = urllib.parse.parse_qs(self.rfile.read(length).decode())
+
+        delay = opt.latency + random.random() * opt.jitter
+        if delay: time.sleep(delay)
+
+        if opt.secret is not None and query.get('_secret') != opt.secret:
+            return self.respond(403, 'text/plain', b'access denied\n')
+
+        if parts.path.endswith('/check_mk/webapi.py'):
+            try:
+                request = json.loads(form.get('request', ['{}'])[0])
+            except ValueError:
+                request = {}
+            result = webapi(inventory, query, request)
+            if result is None:
+                body = inventory.cached('get_all_hosts', lambda: json.dumps(
+                    {'result_code': 0, 'result': inventory.hosts}).encode())
+            else:
+                body = json.dumps({'result_code': result[0],
+                    'result': result[1]}).encode()
+            return self.respond(200, 'application/json', body)
+
+        elif parts.path.endswith('/check_mk/view.py'):
+            type, body = view(inventory, query)
+            return self.respond(200, type, body)
+
+        self.respond(404, 'text/plain', b'not found\n')
+
+    def respond(self, code, type, body):
+        encoding = None
+        if opt.compress:
+            accept = self.headers.get('Accept-Encoding', '')
+            for name in ('gzip', 'deflate'):
+                if name in accept:
+                    encoding = name
+                    body = compressed(body, name)
+                    break
+        self.send_response(code)
+        self.send_header('Content-Type', type)
+        self.send_header('Content-Length', str(len(body)))
+        if encoding: self.send_header('Content-Encoding', encoding)
+        self.end_headers()
+        for i in range(0, len(body), chunk_size):
+            self.wfile.write(body[i:i + chunk_size])
+
+    def log_message(self, *args):
+        if opt.verbose: http.server.BaseHTTPRequestHandler.log_message(
+            self, *args)
+
+## The last few compressed bodies, as (body, encoding) -> compressed; the
+## big responses are cached (see Inventory.cached()), so this saves
+## compressing them again for every request.
+_compressed = {}
+
+def compressed(body, encoding):
+    """
+    Compress a response body with 'gzip' or 'deflate' (zlib), as Apache's
+    mod_deflate would.
+    """
+    key = (id(body), encoding)
+    if key in _compressed and _compressed[key][0] is body:
+        return _compressed[key][1]
+    if encoding == 'gzip':
+        data = gzip.compress(body, 6)
+    else:
+        data = zlib.compress(body, 6)
+    if len(_compressed) > 16: _compressed.clear()
+    _compressed[key] = (body, data)
+    return data
+
+class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+#########################################################################
+### main () #############################################################
+#########################################################################
+
+def main():
+    global opt, inventory
+
+    p = optparse.OptionParser(usage=usage_text, description=text)
+    p.add_option('--port', dest='port', type='int', default=0,
+        help='port to listen on; 0 picks a free one (default: %default)')
+    p.add_option('--hosts', dest='hosts', type='int', default=1000,
+        help='number of hosts (default: %default)')
+    p.add_option('--host_problems', dest='host_problems', type='int',
+        default=50, help='number of host problems (default: %default)')
+    p.add_option('--problems', dest='problems', type='int', default=5000,
+        help='number of service problems (default: %default)')
+    p.add_option('--sites', dest='sites', type='int', default=1,
+        help='spread hosts across this many sites (default: %default)')
+    p.add_option('--ack', dest='ack', type='float', default=0.2,
+        help='fraction of problems that are acknowledged (default: %default)')
+    p.add_option('--ack_column', dest='ack_column', action='store_true',
+        default=False, help='add an acknowledged column to the views')
+    p.add_option('--latency', dest='latency', type='float', default=0.0,
+        help='seconds to wait before every response (default: %default)')
+    p.add_option('--ignore_filters', dest='ignore_filters',
+        action='store_true', default=False,
+        help='ignore the regex, state and host group view filters, like a '
+            'view without them configured')
+    p.add_option('--compress', dest='compress', action='store_true',
+        default=False, help='gzip or deflate the responses, if the client '
+            'asks for it')
+    p.add_option('--jitter', dest='jitter', type='float', default=0.0,
+        help='up to this many extra seconds of latency (default: %default)')
+    p.add_option('--discover_latency', dest='discover_latency', type='float',
+        default=0.5, help='seconds per service discovery (default: %default)')
+    p.add_option('--churn', dest='churn', type='int', default=0,
+        help='service problems to change, clear or add every second '
+            '(default: %default)')
+    p.add_option('--secret', dest='secret', default=None,
+        help='require this API secret (default: accept anything)')
+    p.add_option('--seed', dest='seed', type='int', default=1,
+        help='random seed for the inventory (default: %default)')
+    p.add_option('--verbose', dest='verbose', action='store_true',
+        default=False, help='log every request')
+    opt, args = p.parse_args()
+
+    inventory = Inventory(opt)
+    if opt.churn:
+        thread = threading.Thread(target=churn, args=(inventory, opt.churn))
+        thread.daemon = True
+        thread.start()
+    server = Server(('127.0.0.1', opt.port), Handler)
+    print("listening on http://127.0.0.1:%d" % server.server_address[1])
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,406 @@
+"""
+Tests for the omdclient library, against the mock server where they need
+one (see conftest.py).
+"""
+
+#########################################################################
+### Declarations ########################################################
+#########################################################################
+
+import json, os, re
+
+import pytest
+
+import omdclient, omdclient.snapshot
+
+#########################################################################
+### Helpers #############################################################
+#########################################################################
+
+class ChunkedResponse(object):
+    """
+    Stands in for a response object, handing out 'data' 'size' bytes at a
+    time, whatever read() asks for.
+    """
+    def __init__(self, data, size):
+        self.data = data
+        self.size = size
+
+    def read(self, amt=None):
+        chunk, self.data = self.data[:self.size], self.data[self.size:]
+        return chunk
+
+def hostName(name):
+    return '%s-%d.example.com' % (name, os.getpid())
+
+svc_fields = ['host', 'service_description', 'service_state',
+    'svc_plugin_output', 'svc_comments']
+host_fields = ['host', 'host_state', 'host_plugin_output']
+
+def svcRow(host, service, state, output='', comments=''):
+    return omdclient.reportRowClass(svc_fields)._load([host, service, state,
+        output, comments])
+
+def hostRow(host, state, output=''):
+    return omdclient.reportRowClass(host_fields)._load([host, state, output])
+
+#########################################################################
+### Host Edits ##########################################################
+#########################################################################
+
+def test_hostDelta():
+    current = {'attributes': {'tag_role': 'web', 'ipaddress': '10.0.0.1'}}
+    changed, unset = omdclient.hostDelta(current,
+        {'tag_role': 'web', 'tag_instance': 'dev'}, ['ipaddress', 'alias'])
+    assert changed == {'tag_instance': 'dev'}
+    assert unset == ['ipaddress']
+
+    assert omdclient.hostDelta({'attributes': None}, {'tag_role': 'web'},
+        ['alias']) == ({'tag_role': 'web'}, [])
+    assert omdclient.hostDelta(current, {'tag_role': 'web'}, []) == ({}, [])
+
+def test_editHostRequest():
+    current = {'attributes': {'tag_role': 'web', 'ipaddress': '10.0.0.1'}}
+    args = {'role': 'web', 'instance': 'UNSET', 'extra': 'UNSET'}
+    assert omdclient.editHostRequest('h1', current, args) is None
+
+    request = omdclient.editHostRequest('h1', current,
+        dict(args, role='db', unset='ipaddress'))
+    assert request == {'hostname': 'h1', 'attributes': {'tag_role': 'db'},
+        'unset_attributes': ['ipaddress']}
+
+    request = omdclient.editHostRequest('h1', current,
+        dict(args, unset='alias'))
+    assert request is None
+
+def test_updateHost(argdict):
+    host = hostName('update')
+    args = dict(argdict, role='web', instance='dev', extra='UNSET')
+    assert omdclient.createHost(host, args)[0]
+    try:
+        assert omdclient.updateHost(host, args) == (True, 'unchanged')
+        assert omdclient.updateHost(host, dict(args, role='db')) \
+            == (True, 'updated')
+        value, result = omdclient.readHost(host, argdict)
+        assert value and result['attributes']['tag_role'] == 'db'
+    finally:
+        omdclient.deleteHost(host, argdict)
+    assert omdclient.updateHost(host, args) == (True, 'created')
+    omdclient.deleteHost(host, argdict)
+
+#########################################################################
+### Batches #############################################################
+#########################################################################
+
+def test_batchResult_failed(tmp_path):
+    batch = [('a', {}), ('b', {})]
+    succeeded, failed = [], {}
+    omdclient.batchResult('add_hosts', batch, False, None, succeeded, failed)
+    assert succeeded == []
+    assert failed == {'a': 'unknown error', 'b': 'unknown error'}
+
+    journal = omdclient.Journal(str(tmp_path / 'journal'), 'test')
+    failed = {}
+    omdclient.batchResult('add_hosts', batch, False, 'http error, code 500',
+        succeeded, failed, journal)
+    assert failed == dict.fromkeys(['a', 'b'], 'http error, code 500')
+    assert journal.result('add_hosts', 'a') == (False, 'http error, code 500')
+    assert not journal.isDone('add_hosts', 'b')
+    journal.close()
+
+def test_batchResult_partial(tmp_path):
+    batch = [('a', {}), ('b', {}), ('c', {})]
+    succeeded, failed = [], {}
+    journal = omdclient.Journal(str(tmp_path / 'journal'), 'test')
+    omdclient.batchResult('edit_hosts', batch, True,
+        {'failed_hosts': {'b': 'no such host'}, 'note': 1}, succeeded,
+        failed, journal)
+    assert succeeded == ['a', 'c']
+    assert failed == {'b': 'no such host'}
+    assert journal.result('edit_hosts', 'a') == (True, {'note': 1})
+    assert journal.result('edit_hosts', 'b') == (False, 'no such host')
+    journal.close()
+
+def test_batchRequest_journal(argdict, tmp_path):
+    hosts = [hostName('batch%d' % i) for i in range(5)]
+    journal = omdclient.Journal(str(tmp_path / 'journal'), 'test')
+    args = dict(argdict, role='web', instance='dev', extra='UNSET',
+        batch_size=2, journal=journal)
+
+    value, result = omdclient.createHosts(hosts, args)
+    assert value and result['succeeded_hosts'] == hosts
+    assert all(journal.isDone('add_hosts', host) for host in hosts)
+
+    value, result = omdclient.updateHosts(hosts[:2],
+        dict(args, role='db'))
+    assert value and sorted(result['succeeded_hosts']) == sorted(hosts[:2])
+    value, result = omdclient.updateHosts(hosts[:2], dict(args, role='db'))
+    assert value and sorted(result['unchanged_hosts']) == sorted(hosts[:2])
+
+    value, result = omdclient.deleteHosts(hosts, args)
+    assert value and result['failed_hosts'] == {}
+    assert all(not journal.inFlight(host) for host in hosts)
+    journal.close()
+
+#########################################################################
+### Journal #############################################################
+#########################################################################
+
+def test_journal_resume(tmp_path):
+    filename = str(tmp_path / 'journal')
+    journal = omdclient.Journal(filename, 'import', {'hosts': ['a', 'b']})
+    journal.plan('add_hosts', ['a', 'b'])
+    journal.done('add_hosts', [('a', True, 'ok')])
+    journal.close()
+
+    ## the job was killed in the middle of a write
+    with open(filename, 'a') as fh: fh.write('{"event": "done", "op"')
+
+    with pytest.raises(Exception, match='unfinished'):
+        omdclient.Journal(filename, 'import', {'hosts': []})
+    with pytest.raises(Exception, match='not other'):
+        omdclient.Journal(filename, 'other', resume=True)
+
+    journal = omdclient.Journal(filename, 'import', resume=True)
+    assert journal.params == {'hosts': ['a', 'b']}
+    assert journal.isDone('add_hosts', 'a')
+    assert journal.result('add_hosts', 'a') == (True, 'ok')
+    assert journal.inFlight('a') == []
+    assert not journal.isDone('add_hosts', 'b')
+    assert journal.inFlight('b') == ['add_hosts']
+    assert journal.planned('b') == ['add_hosts']
+    assert journal.result('add_hosts', 'b') is None
+
+    journal.plan('add_hosts', ['b'])
+    journal.done('add_hosts', [('b', False, 'boom')])
+    assert journal.inFlight('b') == []
+    assert not journal.isDone('add_hosts', 'b')
+    journal.finish(False)
+
+    ## nothing written after the cut-off line was lost
+    journal = omdclient.Journal(filename, 'import', resume=True)
+    assert journal.result('add_hosts', 'b') == (False, 'boom')
+    journal.close()
+    with open(filename) as fh: lines = fh.readlines()
+    assert lines[4] == '{"event": "done", "op"\n'
+    assert [json.loads(line)['event'] for line in lines[5:]] \
+        == ['resume', 'plan', 'done', 'finish', 'resume']
+
+    ## a failed job still has to be resumed; a finished one can go
+    with pytest.raises(Exception, match='unfinished'):
+        omdclient.Journal(filename, 'import')
+    journal = omdclient.Journal(filename, 'import', resume=True)
+    journal.finish(True)
+    journal = omdclient.Journal(filename, 'other', {'x': 1})
+    assert journal.params == {'x': 1}
+    assert not journal.isDone('add_hosts', 'a')
+    journal.close()
+
+    with open(filename) as fh:
+        events = [json.loads(line)['event'] for line in fh]
+    assert events == ['start']
+
+def test_journal_not_a_journal(tmp_path):
+    filename = tmp_path / 'journal'
+    filename.write_text('hello\n')
+    with pytest.raises(Exception, match='not a journal'):
+        omdclient.Journal(str(filename), 'import', resume=True)
+
+#########################################################################
+### Activation ##########################################################
+#########################################################################
+
+def test_activationCovered(tmp_path):
+    with open(str(tmp_path / 'activate.json'), 'a+') as fh:
+        assert omdclient.activationCovered(fh, 100) == (None, False)
+
+        omdclient.saveActivation(fh, 90, True, 'ok')
+        assert omdclient.activationCovered(fh, 100) == (None, False)
+
+        omdclient.saveActivation(fh, 110, True, 'ok')
+        state, retry = omdclient.activationCovered(fh, 100)
+        assert (state['value'], state['result'], retry) == (True, 'ok', False)
+
+        ## a failure: the first caller to see it tries again...
+        omdclient.saveActivation(fh, 110, False, 'locked')
+        assert omdclient.activationCovered(fh, 100) == (None, True)
+
+        ## ...and if that fails too, everyone gets the failure
+        omdclient.saveActivation(fh, 120, False, 'locked', True)
+        state, retry = omdclient.activationCovered(fh, 100)
+        assert (state['value'], state['result'], retry) \
+            == (False, 'locked', False)
+
+        fh.seek(0)
+        fh.truncate()
+        fh.write('{"started"')
+        fh.flush()
+        assert omdclient.activationCovered(fh, 100) == (None, False)
+
+def test_activateChangesCoalesced(argdict):
+    value, result = omdclient.activateChangesCoalesced(argdict, 0)
+    assert value
+
+#########################################################################
+### Reports #############################################################
+#########################################################################
+
+def test_jsonRows_chunks():
+    rows = [['host', 'service_description', 'svc_plugin_output'],
+        ['h1', 'CPU load', 'OK - load ]], ["x"] \\"quoted\\"'],
+        ['h2', 'Mem', ['nested', ['list']]],
+        ['hé', 'Disk ☃', 'café \U0001f600'],
+        ['h4', '', None], [], [1, 2.5, True, {'a': ']'}]]
+    for text in (json.dumps(rows), json.dumps(rows, indent=1),
+            ' \n' + json.dumps(rows, ensure_ascii=False)):
+        data = text.encode('utf-8')
+        for size in (1, 2, 3, 5, 7, 16, 64, len(data)):
+            response = ChunkedResponse(data, size)
+            assert list(omdclient._jsonRows(response, b'')) == rows, size
+
+    assert list(omdclient._jsonRows(ChunkedResponse(b'[]', 1), b'')) == []
+    data = json.dumps(rows).encode()
+    assert list(omdclient._jsonRows(ChunkedResponse(data[9:], 4),
+        data[:9])) == rows
+
+def test_jsonRows_errors():
+    data = json.dumps([['a', 'b'], ['c', 'd']]).encode()
+    with pytest.raises(ValueError):
+        list(omdclient._jsonRows(ChunkedResponse(data[:-3], 4), b''))
+    with pytest.raises(ValueError):
+        list(omdclient._jsonRows(ChunkedResponse(b'{"a": 1}', 4), b''))
+    with pytest.raises(ValueError):
+        list(omdclient._jsonRows(ChunkedResponse(b'[["a", b]]', 4), b''))
+
+def test_report_chunk_size(argdict, monkeypatch):
+    rows = omdclient.nagiosReport('svc_unack', argdict)
+    assert rows
+    monkeypatch.setattr(omdclient, 'report_chunk_size', 7)
+    assert omdclient.nagiosReport('svc_unack', argdict) == rows
+
+def test_reportRowClass():
+    row = omdclient.reportRowClass(['host', 'service_state', 'x y',
+        'svc_plugin_output'])._load(['h' + '1', 'OK', None, 'out'])
+    assert row == ('h1', 'OK', None, 'out')
+    assert row.host == 'h1' and row[1] == 'OK'
+    assert row.get('x y', 'default') is None
+    assert row.get('missing', 'default') == 'default'
+    assert row.host is omdclient.sys.intern('h1')
+    assert type(row) is omdclient.reportRowClass(row._header)
+
+def test_reportChanges():
+    cpu = svcRow('h1', 'CPU load', 'CRIT', 'load 10')
+    mem = svcRow('h2', 'Memory', 'WARN', 'used 90%')
+    down = hostRow('h3', 'DOWN')
+    old = omdclient.reportSnapshot({'svc_unack': [cpu, mem],
+        'host_unack': [down], 'svc_ack': []})
+
+    assert omdclient.reportChanges(old, old) == ([], [], [])
+
+    ## acknowledged, output only, cleared, new
+    new_mem = svcRow('h2', 'Memory', 'WARN', 'used 91%')
+    disk = svcRow('h0', 'Disk', 'CRIT')
+    new = omdclient.reportSnapshot({'svc_ack': [cpu],
+        'svc_unack': [new_mem, disk], 'host_unack': []})
+    added, cleared, changed = omdclient.reportChanges(old, new)
+    assert added == [('svc_unack', disk)]
+    assert cleared == [('host_unack', down)]
+    assert changed == [(('svc_unack', cpu), ('svc_ack', cpu))]
+
+    ## a change of state or comment counts
+    newer = omdclient.reportSnapshot({'svc_ack': [cpu],
+        'svc_unack': [svcRow('h2', 'Memory', 'CRIT', 'used 99%'),
+            svcRow('h0', 'Disk', 'CRIT', '', 'working on it')]})
+    added, cleared, changed = omdclient.reportChanges(new, newer)
+    assert (added, cleared) == ([], [])
+    assert [(a[1].host, b[1].service_state) for a, b in changed] \
+        == [('h0', 'CRIT'), ('h2', 'CRIT')]
+
+#########################################################################
+### Bulk Commands #######################################################
+#########################################################################
+
+def test_regexEscape():
+    for text in ('host.example.com', 'Mem (used) [%]', 'a|b', '^$*+?{1}\\'):
+        escaped = omdclient._regexEscape(text)
+        assert re.fullmatch(escaped, text)
+    assert not re.fullmatch(omdclient._regexEscape('a.b'), 'axb')
+
+def test_targetBatches():
+    targets = [('h1', None), ('h.2', None), ('h3', None),
+        ('h1', 'CPU load'), ('h2', 'Mem (x)'), ('h3', 'CPU load')]
+    batches = omdclient._targetBatches(targets, 2)
+    assert [batch for filters, batch in batches] == [
+        [('h1', None), ('h.2', None)], [('h3', None)],
+        [('h1', 'CPU load'), ('h3', 'CPU load')], [('h2', 'Mem (x)')]]
+
+    filters = batches[0][0]
+    assert filters == {'host_regex': r'^(h1|h\.2)$'}
+    assert re.search(filters['host_regex'], 'h.2')
+    assert not re.search(filters['host_regex'], 'hx2')
+    assert not re.search(filters['host_regex'], 'h11')
+    assert batches[3][0] == {'host_regex': '^(h2)$',
+        'service_regex': r'^Mem \(x\)$'}
+    assert re.search(batches[3][0]['service_regex'], 'Mem (x)')
+
+def test_nagiosTargets(argdict):
+    targets = omdclient.nagiosTargets('service', {'host_regex':
+        '^host000001[.]example[.]com$'}, argdict)
+    assert targets
+    assert set(host for host, service in targets) \
+        == set(['host000001.example.com'])
+
+#########################################################################
+### Snapshot ############################################################
+#########################################################################
+
+def problemRows(snapshot):
+    return dict(((host, service, seq), (kind, ack, state, first_seen))
+        for kind, host, service, seq, ack, state, first_seen
+        in snapshot.db.execute('SELECT kind, host, service, seq, ack, '
+            'state, first_seen FROM problems'))
+
+def test_syncProblems(tmp_path):
+    snapshot = omdclient.snapshot.Snapshot(str(tmp_path / 's.sqlite'),
+        create=True)
+    report = {'host_ack': [], 'host_unack': [hostRow('h3', 'DOWN')],
+        'svc_ack': [], 'svc_unack': [svcRow('h1', 'CPU load', 'CRIT'),
+            svcRow('h2', 'Memory', 'WARN', 'used 90%')]}
+    with snapshot.db:
+        stats = snapshot._syncProblems(report)
+    assert stats == {'new': 3, 'changed': 0, 'cleared': 0, 'total': 3}
+    first = problemRows(snapshot)
+    assert first[('h3', '', 0)][:3] == ('host', 0, 'DOWN')
+
+    ## h1 acknowledged, h2 output only, h3 cleared, h4 listed twice
+    report = {'host_ack': [], 'host_unack': [],
+        'svc_ack': [svcRow('h1', 'CPU load', 'CRIT')],
+        'svc_unack': [svcRow('h2', 'Memory', 'WARN', 'used 91%'),
+            svcRow('h4', 'NTP', 'CRIT'), svcRow('h4', 'NTP', 'CRIT')]}
+    with snapshot.db:
+        stats = snapshot._syncProblems(report)
+    assert stats == {'new': 2, 'changed': 1, 'cleared': 1, 'total': 4}
+    second = problemRows(snapshot)
+    assert sorted(second) == [('h1', 'CPU load', 0), ('h2', 'Memory', 0),
+        ('h4', 'NTP', 0), ('h4', 'NTP', 1)]
+    assert second[('h1', 'CPU load', 0)][:3] == ('svc', 1, 'CRIT')
+    for key in (('h1', 'CPU load', 0), ('h2', 'Memory', 0)):
+        assert second[key][3] == first[key][3]
+
+    ## nothing changed
+    with snapshot.db:
+        stats = snapshot._syncProblems(report)
+    assert stats == {'new': 0, 'changed': 0, 'cleared': 0, 'total': 4}
+    snapshot.close()
+
+def test_snapshot_sync(argdict, tmp_path):
+    with omdclient.snapshot.Snapshot(str(tmp_path / 's.sqlite'),
+            create=True) as snapshot:
+        stats = snapshot.sync(argdict)
+        assert stats['hosts']['total'] >= 50
+        report = omdclient.nagiosAlertReport(argdict, True)
+        assert stats['problems']['total'] == sum(len(report[name])
+            for name in report)
+        local = snapshot.alertReport()
+        assert dict((name, len(local[name])) for name in local) \
+            == dict((name, len(report[name])) for name in report)
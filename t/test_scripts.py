@@ -0,0 +1,199 @@
+"""
+Tests for the --resume paths of the omd-bulkimport and omd-enc-sync
+scripts, against the mock server (see conftest.py).  Each test writes the
+journal that a killed run would have left behind, and resumes it.
+"""
+
+#########################################################################
+### Declarations ########################################################
+#########################################################################
+
+import json, os
+
+import omdclient
+
+#########################################################################
+### Helpers #############################################################
+#########################################################################
+
+def hostName(name):
+    return '%s-%d.example.com' % (name, os.getpid())
+
+def resumedRecords(filename):
+    """
+    The journal records written by the last resumed run.
+    """
+    with open(filename) as fh:
+        records = [json.loads(line) for line in fh]
+    events = [record['event'] for record in records]
+    return records[len(events) - events[::-1].index('resume'):]
+
+def sentHosts(records, op):
+    return [record['host'] for record in records
+        if record['event'] == 'plan' and record['op'] == op]
+
+def listHosts(argdict):
+    value, hosts = omdclient.listHosts(dict(argdict, refresh=True))
+    assert value
+    return hosts
+
+#########################################################################
+### omd-bulkimport ######################################################
+#########################################################################
+
+def test_bulkimport_resume(argdict, script, tmp_path):
+    added, lost, new = hostName('bi-added'), hostName('bi-lost'), \
+        hostName('bi-new')
+    skipped = 'host000001.example.com'
+    hosts = [added, lost, new, skipped]
+    folder = 'tests/bulkimport'
+
+    ## the add of 'added' went through; the one of 'lost' never answered,
+    ## and 'new' was never planned
+    assert omdclient.createHost(added, dict(argdict, folder=folder))[0]
+    filename = str(tmp_path / 'journal')
+    journal = omdclient.Journal(filename, 'bulkimport',
+        {'folder': folder, 'hosts': hosts})
+    journal.done('plan', [(added, True, 'add'), (lost, True, 'add'),
+        (skipped, True, 'skip')])
+    journal.plan('add_hosts', [added, lost])
+    journal.done('add_hosts', [(added, True, None)])
+    journal.close()
+
+    result = script('omd-bulkimport', '--journal', filename, '--resume',
+        '--no_check_dns')
+    assert result.returncode == 0, result.stdout
+    assert 'resuming: 2 of 4 host(s) already done, 2 to re-check' \
+        in result.stdout
+    assert 'added: 3  moved: 0  skipped: 1  failed: 0' in result.stdout
+
+    records = resumedRecords(filename)
+    assert sorted(sentHosts(records, 'add_hosts')) == sorted([lost, new])
+    assert records[-1]['event'] == 'finish' and records[-1]['ok']
+
+    existing = listHosts(argdict)
+    for host in (added, lost, new):
+        assert existing[host]['path'] == folder
+
+    ## the job is finished: resuming again does nothing
+    result = script('omd-bulkimport', '--journal', filename, '--resume',
+        '--no_check_dns')
+    assert result.returncode == 0, result.stdout
+    assert 'resuming: 4 of 4 host(s) already done, 0 to re-check' \
+        in result.stdout
+    assert sentHosts(resumedRecords(filename), 'add_hosts') == []
+
+    omdclient.deleteHosts([added, lost, new], argdict)
+
+def test_bulkimport_resume_move(argdict, script, tmp_path):
+    host = hostName('bi-move')
+    folder = 'tests/moved'
+
+    ## a move that got as far as the delete only needs the add
+    filename = str(tmp_path / 'journal')
+    journal = omdclient.Journal(filename, 'bulkimport',
+        {'folder': folder, 'hosts': [host]})
+    journal.done('plan', [(host, True, 'move')])
+    journal.plan('delete_hosts', [host])
+    journal.done('delete_hosts', [(host, True, None)])
+    journal.close()
+
+    result = script('omd-bulkimport', '--journal', filename, '--resume',
+        '--no_check_dns')
+    assert result.returncode == 0, result.stdout
+    assert 'added: 0  moved: 1  skipped: 0  failed: 0' in result.stdout
+
+    records = resumedRecords(filename)
+    assert sentHosts(records, 'delete_hosts') == []
+    assert sentHosts(records, 'add_hosts') == [host]
+    assert listHosts(argdict)[host]['path'] == folder
+
+    omdclient.deleteHost(host, argdict)
+
+def test_bulkimport_resume_wrong_job(script, tmp_path):
+    filename = str(tmp_path / 'journal')
+    omdclient.Journal(filename, 'enc-sync', {}).close()
+    result = script('omd-bulkimport', '--journal', filename, '--resume')
+    assert result.returncode == 1
+    assert 'is a journal for enc-sync, not bulkimport' in result.stdout
+
+#########################################################################
+### omd-enc-sync ########################################################
+#########################################################################
+
+def encSettings(role):
+    return {'role': role, 'instance': 'dev', 'extra': 'UNSET'}
+
+def test_enc_sync_resume(argdict, script, tmp_path):
+    edited, lost, new, deleted = hostName('enc-edited'), \
+        hostName('enc-lost'), hostName('enc-new'), hostName('enc-deleted')
+    updates = {edited: encSettings('web'), lost: encSettings('db'),
+        new: encSettings('worker')}
+
+    ## 'edited' was updated and inventoried, 'deleted' was deleted; the
+    ## add of 'lost' never answered, and 'new' was never sent
+    assert omdclient.createHost(edited,
+        dict(argdict, **encSettings('web')))[0]
+    filename = str(tmp_path / 'journal')
+    journal = omdclient.Journal(filename, 'enc-sync',
+        {'updates': updates, 'deletes': [deleted]})
+    journal.plan('delete_hosts', [deleted])
+    journal.done('delete_hosts', [(deleted, True, None)])
+    journal.plan('edit_hosts', [edited])
+    journal.done('edit_hosts', [(edited, True, None)])
+    journal.plan('add_hosts', [lost])
+    journal.plan('discover_services', [edited])
+    journal.done('discover_services', [(edited, True, 'ok')])
+    journal.close()
+
+    result = script('omd-enc-sync', '--journal', filename, '--resume')
+    assert result.returncode == 0, result.stdout
+    assert 'resuming: 2 update(s) and 0 delete(s) left' in result.stdout
+    assert '%s - host created' % lost in result.stdout
+    assert '%s - host created' % new in result.stdout
+    assert 'activate - ' in result.stdout
+
+    records = resumedRecords(filename)
+    assert sentHosts(records, 'delete_hosts') == []
+    assert sorted(sentHosts(records, 'add_hosts')) == sorted([lost, new])
+    assert sentHosts(records, 'edit_hosts') == []
+    assert sorted(sentHosts(records, 'discover_services')) \
+        == sorted([lost, new])
+    assert sentHosts(records, 'activate_changes') == [None]
+    assert records[-1]['event'] == 'finish' and records[-1]['ok']
+
+    existing = listHosts(argdict)
+    assert deleted not in existing
+    assert existing[lost]['attributes']['tag_role'] == 'db'
+    assert existing[new]['attributes']['tag_role'] == 'worker'
+
+    omdclient.deleteHosts([edited, lost, new], argdict)
+
+def test_enc_sync_resume_activate(argdict, script, tmp_path):
+    host = hostName('enc-activate')
+
+    ## everything but the activation was done
+    assert omdclient.createHost(host, dict(argdict, **encSettings('web')))[0]
+    filename = str(tmp_path / 'journal')
+    journal = omdclient.Journal(filename, 'enc-sync',
+        {'updates': {host: encSettings('web')}, 'deletes': []})
+    journal.plan('add_hosts', [host])
+    journal.done('add_hosts', [(host, True, None)])
+    journal.plan('discover_services', [host])
+    journal.done('discover_services', [(host, True, 'ok')])
+    journal.plan('activate_changes', [None])
+    journal.close()
+
+    result = script('omd-enc-sync', '--journal', filename, '--resume')
+    assert result.returncode == 0, result.stdout
+    assert 'resuming: 0 update(s) and 0 delete(s) left' in result.stdout
+    records = resumedRecords(filename)
+    assert sentHosts(records, 'discover_services') == []
+    assert sentHosts(records, 'activate_changes') == [None]
+
+    ## and once it has been, not again
+    result = script('omd-enc-sync', '--journal', filename, '--resume')
+    assert result.returncode == 0, result.stdout
+    assert sentHosts(resumedRecords(filename), 'activate_changes') == []
+
+    omdclient.deleteHost(host, argdict)